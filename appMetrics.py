@@ -0,0 +1,208 @@
+import bisect
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+# upper bounds in seconds, spotify calls and shuffle waits land in the top half, trie and ranking work in the bottom
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL_MS", 10)) / 1000
+MAX_PROFILED_STACKS = 10000 # distinct stacks kept, the rest are counted as one
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        # label values -> that series' state
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, state in series:
+            lines.extend(self.render_series(label_values, state))
+        return lines
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render_series(self, label_values, value):
+        return [f"{self.name}_total{format_labels(self.label_names, label_values)} {format_value(value)}"]
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            state = self.series.get(label_values)
+            if state is None:
+                # one count per bucket plus +Inf, then the sum
+                state = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render_series(self, label_values, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            labels = format_labels(self.label_names, label_values, [('le', format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+# Read when the metrics are rendered, collect returns (label values, value) pairs
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), collect=None):
+        super().__init__(name, help_text, label_names)
+        self.collect = collect
+
+    def render(self):
+        if self.collect is not None:
+            collected = dict(self.collect())
+            with self.lock:
+                self.series = collected
+        return super().render()
+
+    def render_series(self, label_values, value):
+        return [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}"]
+
+# Every metric this process has, in the Prometheus text format. Each worker process keeps its own,
+# so behind several workers a scrape only sees the one worker that answered it
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, label_names=()):
+        return self.register(Counter(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def gauge(self, name, help_text, label_names=(), collect=None):
+        return self.register(Gauge(name, help_text, label_names, collect))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+def get_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+# Samples every thread's stack on a timer while it's on, so a slowdown can be pinned on a function
+# without attaching a debugger. Stacks come out in the folded format flamegraph tools read
+class SamplingProfiler:
+    def __init__(self, interval=PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.num_samples = 0
+        self.started_at = None
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        with self.lock:
+            if self.is_running():
+                return
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stop_event,), daemon=True)
+            self.started_at = time.time()
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            if self.stop_event is not None:
+                self.stop_event.set()
+            self.thread = None
+
+    def reset(self):
+        with self.lock:
+            self.stacks = StackCounter()
+            self.num_samples = 0
+
+    def run(self, stop_event):
+        own_thread = threading.get_ident()
+        while not stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            stacks = [get_stack(frame) for thread_id, frame in frames.items() if thread_id != own_thread]
+            with self.lock:
+                for stack in stacks:
+                    if stack in self.stacks or len(self.stacks) < MAX_PROFILED_STACKS:
+                        self.stacks[stack] += 1
+                    else:
+                        self.stacks['(other)'] += 1
+                self.num_samples += 1
+
+    def get_status(self):
+        with self.lock:
+            return {'running': self.is_running(), 'interval': self.interval, 'num_samples': self.num_samples,
+                    'num_stacks': len(self.stacks), 'started_at': self.started_at}
+
+    def get_folded(self):
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+profiler = SamplingProfiler()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+import numpy as np
+
+# Times the trie and the read paths over synthetic histories, e.g.
+#   python benchmark.py --output bench_output.txt
+#   python benchmark.py --full --output new.json --compare bench_output.txt
+
+QUICK_TRACKS = [50, 500, 2000]
+QUICK_SHUFFLES = [10, 1000, 5000]
+FULL_TRACKS = [50, 500, 2000, 10000]
+FULL_SHUFFLES = [10, 1000, 10000, 50000]
+REGRESSION_THRESHOLD = 1.2 # p50 slower than this many times the baseline gets flagged
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark TrackTrie and the flask read paths")
+    parser.add_argument('--tracks', type=int, nargs='+', help="playlist sizes to run")
+    parser.add_argument('--shuffles', type=int, nargs='+', help="history lengths to run")
+    parser.add_argument('--full', action='store_true', help="run the full 50-10k tracks by 10-50k shuffles grid")
+    parser.add_argument('--queue-length', type=int, default=20, help="tracks per sampled queue, spotify returns about 20")
+    parser.add_argument('--queries', type=int, default=500, help="lookups timed per read operation")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the json results here")
+    parser.add_argument('--compare', help="results file from another commit to compare against")
+    return parser.parse_args()
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def summarize(durations):
+    values = np.array(durations) * 1e6
+    return {
+        'count': len(values),
+        'mean_us': round(float(values.mean()), 3),
+        'p50_us': round(float(np.percentile(values, 50)), 3),
+        'p95_us': round(float(np.percentile(values, 95)), 3),
+        'p99_us': round(float(np.percentile(values, 99)), 3),
+        'max_us': round(float(values.max()), 3)
+    }
+
+# before (untimed) runs ahead of each call, e.g. to clear a cache the call would otherwise hit
+def time_calls(fn, calls, before=None):
+    durations = []
+    for args in calls:
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        fn(*args)
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+def make_history(tracks, num_shuffles, queue_length, rng):
+    queue_length = min(queue_length, len(tracks))
+    return [rng.sample(tracks, queue_length) for _ in range(num_shuffles)]
+
+# Peak traced memory, and the memory blocks build() allocated that are still alive once it's returned
+def measure_memory(build):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = build()
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return result, {'current_bytes': current, 'peak_bytes': peak, 'retained_blocks': retained_blocks}
+
+def build_trie(history):
+    trie = TrackTrie()
+    for shuffle_id, queue in enumerate(history):
+        trie.addShuffleQueue(deque(track['id'] for track in queue), shuffle_id)
+    return trie
+
+BENCHMARK_USER_ID = "benchmark"
+
+def reset_app_state():
+    main.get_user_data(BENCHMARK_USER_ID).clear()
+
+def build_context(context_id, tracks, genres, history):
+    reset_app_state()
+    user_data = main.get_user_data(BENCHMARK_USER_ID)
+    for artist_id, artist_genres in genres.items():
+        main.cache_artist_genres(artist_id, artist_genres)
+    for track in tracks:
+        user_data.store_track(track, save=False)
+
+    context = user_data.contexts[context_id] = main.TracksInContext(user_data, context_id, {'total_tracks': len(tracks)})
+    for queue in history:
+        context.add_shuffle(queue)
+    return context
+
+def run_case(num_tracks, num_shuffles, args):
+    rng = random.Random(f"{args.seed}:{num_tracks}:{num_shuffles}")
+    context_id = f"bench{num_tracks}"
+    tracks, _, genres = spotifySimulator.make_catalog(context_id, num_tracks, seed=args.seed)
+    history = make_history(tracks, num_shuffles, args.queue_length, rng)
+    operations = {}
+
+    # addShuffleQueue, timed per call while building up the history
+    trie = TrackTrie()
+    durations = []
+    for shuffle_id, queue in enumerate(history):
+        track_ids = deque(track['id'] for track in queue)
+        started = time.perf_counter()
+        trie.addShuffleQueue(track_ids, shuffle_id)
+        durations.append(time.perf_counter() - started)
+    operations['addShuffleQueue'] = summarize(durations)
+    _, memory = measure_memory(lambda: build_trie(history))
+
+    played_ids = [track['id'] for track in tracks if track['id'] in trie.trackIndexes]
+    lookups = [(rng.choice(played_ids),) for _ in range(args.queries)]
+    operations['findAllPatterns'] = time_calls(trie.findAllPatterns, lookups)
+
+    shuffle_lookups = []
+    for _ in range(args.queries):
+        shuffle_id = rng.randrange(num_shuffles)
+        shuffle_lookups.append((shuffle_id, rng.choice(history[shuffle_id])['id']))
+    operations['getShuffleQueue'] = time_calls(trie.getShuffleQueue, shuffle_lookups)
+
+    # the same history again through TracksInContext, for the read paths the endpoints use
+    context = build_context(context_id, tracks, genres, history)
+    pages = [(rng.randrange(0, max(1, len(context.track_ranking)), main.MAX_TRACKS_TO_SEND), main.MAX_TRACKS_TO_SEND) for _ in range(args.queries)]
+    operations['get_ranked_tracks'] = time_calls(context.get_ranked_tracks, pages)
+    searches = [(0, main.MAX_TRACKS_TO_SEND, f"track {rng.randrange(num_tracks)}") for _ in range(args.queries)]
+    operations['get_ranked_tracks_search'] = time_calls(context.get_ranked_tracks, searches)
+
+    client = main.app.test_client()
+    with client.session_transaction() as sess:
+        sess['token_info'] = {'access_token': "benchmark"}
+        sess['user_id'] = BENCHMARK_USER_ID
+        sess['current_context_id'] = context_id
+    track_stats_calls = [(f"/track_stats/{track_id}",) for (track_id,) in lookups[:max(1, args.queries // 5)]]
+    # the lookups repeat track IDs, the cache is cleared so every call does the work rather than answer from it
+    operations['track_stats_endpoint'] = time_calls(client.get, track_stats_calls, before=main.response_cache.clear)
+
+    result = {
+        'num_tracks': num_tracks,
+        'num_shuffles': num_shuffles,
+        'queue_length': min(args.queue_length, num_tracks),
+        'trie_memory': memory,
+        'operations': operations
+    }
+    reset_app_state()
+    return result
+
+def compare(results, baseline):
+    baseline_cases = {(case['num_tracks'], case['num_shuffles']): case for case in baseline['results']}
+    regressions = []
+    for case in results['results']:
+        old_case = baseline_cases.get((case['num_tracks'], case['num_shuffles']))
+        if not old_case:
+            continue
+
+        for name, stats in case['operations'].items():
+            old_stats = old_case['operations'].get(name)
+            if old_stats and old_stats['p50_us'] > 0:
+                ratio = stats['p50_us'] / old_stats['p50_us']
+                line = f"{name:28} tracks={case['num_tracks']:<6} shuffles={case['num_shuffles']:<6} p50 {old_stats['p50_us']:>10.1f}us -> {stats['p50_us']:>10.1f}us ({ratio:.2f}x)"
+                print(line, file=sys.stderr)
+                if ratio > REGRESSION_THRESHOLD:
+                    regressions.append(line)
+
+        old_peak = old_case['trie_memory']['peak_bytes']
+        if old_peak and case['trie_memory']['peak_bytes'] / old_peak > REGRESSION_THRESHOLD:
+            regressions.append(f"trie peak memory tracks={case['num_tracks']} shuffles={case['num_shuffles']} {old_peak} -> {case['trie_memory']['peak_bytes']} bytes")
+
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return regressions
+
+def main_benchmark():
+    args = parse_args()
+    track_sizes = args.tracks or (FULL_TRACKS if args.full else QUICK_TRACKS)
+    shuffle_counts = args.shuffles or (FULL_SHUFFLES if args.full else QUICK_SHUFFLES)
+
+    results = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'queue_length': args.queue_length,
+        'results': []
+    }
+    for num_tracks in track_sizes:
+        for num_shuffles in shuffle_counts:
+            print(f"tracks={num_tracks} shuffles={num_shuffles}", file=sys.stderr)
+            results['results'].append(run_case(num_tracks, num_shuffles, args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    # keep the benchmark away from the real database and the on-disk metadata cache
+    os.environ['SHUFFLE_DB_PATH'] = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    os.environ['METADATA_DISK_CACHE'] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import main
+    import spotifySimulator
+    from trackTrie import TrackTrie
+    main_benchmark()
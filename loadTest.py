@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+# Pushes simulated users through the real flask endpoints against spotifySimulator,
+# e.g. python loadTest.py --users 20 --shuffles 50 --rate-limit-probability 0.02
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test the shuffle tracker against a simulated spotify")
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--shuffles', type=int, default=20, help="shuffles to collect per user")
+    parser.add_argument('--tracks', type=int, default=200, help="tracks per simulated playlist")
+    parser.add_argument('--contexts', type=int, default=1, help="playlists the users are spread over")
+    parser.add_argument('--algorithm', default='uniform', help="uniform, weighted, artist_spread or sticky")
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--propagation-ms', type=float, default=200)
+    parser.add_argument('--rate-limit-probability', type=float, default=0)
+    parser.add_argument('--requests-per-second', type=float, default=1000, help="client side rate budget")
+    parser.add_argument('--sample-interval', type=float, default=0.05)
+    parser.add_argument('--poll-interval', type=float, default=0.25, help="how often each user polls the endpoints")
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help="database path, a throwaway one by default")
+    parser.add_argument('--output', help="write the json report here as well as stdout")
+    return parser.parse_args()
+
+def configure(args):
+    # everything reads its settings at import time, so these have to be set before main is imported
+    os.environ.update({
+        'SPOTIFY_SIMULATOR': "1",
+        'SIM_TRACKS': str(args.tracks),
+        'SIM_CONTEXTS': str(args.contexts),
+        'SIM_ALGORITHM': args.algorithm,
+        'SIM_LATENCY_MS': str(args.latency_ms),
+        'SIM_PROPAGATION_MS': str(args.propagation_ms),
+        'SIM_429_PROBABILITY': str(args.rate_limit_probability),
+        'SIM_SEED': str(args.seed),
+        'SPOTIFY_REQUESTS_PER_SECOND': str(args.requests_per_second),
+        'SPOTIFY_BURST_SIZE': str(max(10, int(args.requests_per_second))),
+        'SAMPLE_INTERVAL': str(args.sample_interval),
+        'SHUFFLE_DB_PATH': args.db or os.path.join(tempfile.mkdtemp(), "load_test.db"),
+        'METADATA_DISK_CACHE': "1"
+    })
+
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+    values = np.array(latencies) * 1000
+    return {
+        'count': len(values),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3)
+    }
+
+class SimulatedUser:
+    def __init__(self, main, index, args, latencies, latencies_lock):
+        self.main = main
+        self.index = index
+        self.args = args
+        self.rng = random.Random(f"{args.seed}:{index}")
+        self.client = main.app.test_client()
+        self.latencies = latencies
+        self.latencies_lock = latencies_lock
+        self.statuses = {}
+        self.error = None
+
+        with self.client.session_transaction() as sess:
+            sess['token_info'] = {'access_token': f"sim-user-{index}"}
+
+    def request(self, name, url):
+        started = time.perf_counter()
+        response = self.client.get(url)
+        elapsed = time.perf_counter() - started
+
+        with self.latencies_lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+        self.statuses[response.status_code] = self.statuses.get(response.status_code, 0) + 1
+        return response
+
+    def get_sampler(self):
+        with self.client.session_transaction() as sess:
+            return self.main.samplers.get(sess.get('user_id'))
+
+    def run(self, deadline):
+        response = self.request('toggle', '/toggle')
+        if response.status_code != 200:
+            self.error = response.get_json().get('error')
+            return
+
+        sampler = self.get_sampler()
+        while sampler.num_samples < self.args.shuffles and time.monotonic() < deadline:
+            response = self.request('queue_data', '/queue_data')
+            if response.status_code not in (200, 429):
+                self.error = response.get_json().get('error')
+                break
+
+            # look at a track the way the frontend would after clicking it
+            tracks = response.get_json().get('queue') or []
+            if tracks:
+                track_id = self.rng.choice(tracks)['id']
+                response = self.request('track_stats', f"/track_stats/{track_id}")
+                shuffle_ids = response.get_json().get('shuffle_ids') if response.status_code == 200 else None
+                if shuffle_ids:
+                    self.request('shuffle_order', f"/shuffle_order/{self.rng.choice(shuffle_ids)}/{track_id}")
+                    self.request('shuffle_orders', f"/shuffle_orders/{track_id}?window=5")
+
+            time.sleep(self.args.poll_interval)
+
+        self.request('get_all_contexts', '/get_all_contexts')
+        self.request('toggle', '/toggle')
+        self.num_samples = sampler.num_samples
+        self.skipped_samples = sampler.skipped_samples
+
+def main():
+    args = parse_args()
+    configure(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as app_main
+
+    latencies = {}
+    latencies_lock = threading.Lock()
+    users = [SimulatedUser(app_main, i, args, latencies, latencies_lock) for i in range(args.users)]
+
+    started = time.monotonic()
+    deadline = started + args.timeout
+    threads = [threading.Thread(target=user.run, args=(deadline,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    total_samples = sum(getattr(user, 'num_samples', 0) for user in users)
+    statuses = {}
+    for user in users:
+        for status, count in user.statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+
+    # shuffles per context, summed over every user that tracked it
+    contexts = {}
+    for user_data in app_main.get_all_user_data():
+        for context_id, context in user_data.contexts.items():
+            contexts[str(context_id)] = contexts.get(str(context_id), 0) + context.num_shuffles
+
+    report = {
+        'config': vars(args),
+        'elapsed_s': round(elapsed, 3),
+        'shuffles_ingested': total_samples,
+        'shuffles_per_second': round(total_samples / elapsed, 3) if elapsed else None,
+        'skipped_samples': sum(getattr(user, 'skipped_samples', 0) for user in users),
+        'errors': [user.error for user in users if user.error],
+        'status_codes': statuses,
+        'latency': {name: summarize(values) for name, values in sorted(latencies.items())},
+        'contexts': contexts
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+if __name__ == '__main__':
+    main()
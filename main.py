@@ -1,86 +1,761 @@
 import os
-from flask import Flask, render_template, redirect, request, session, jsonify
+import sys
+from flask import Flask, Response, render_template, redirect, request, session, jsonify, send_file, g
 from spotipy.oauth2 import SpotifyOAuth
 import spotipy
+import spotifyClient
+import spotifySimulator
 from dotenv import load_dotenv
 import time
+import threading
+import uuid
+import itertools
+import functools
+import secrets
+import tempfile
+import zipfile
 from trackTrie import TrackTrie
+from trackRanking import TrackRanking
+from trackIndex import TrackSearchIndex, ArtistGenreIndex, MasterTrackIndex
+from trackSketch import SketchRanking, PairSketch, get_sketch_settings
+from shuffleStore import ShuffleStore, BATCH_SIZE
+from metadataCache import MetadataCache
+from responseCache import ResponseCache
+from shuffleSampler import ShuffleSampler, SamplerStatus, DEEP_SAMPLE_DEPTH, get_currently_playing_data
+from updateStream import UpdateBroadcaster, format_event, format_keepalive, STATUS_CHECK_INTERVAL, KEEPALIVE_INTERVAL
 from collections import deque
+import numpy as np
+import shuffleStats
+import shuffleExport
+import appMetrics
+
+# A page of the ranking's tracks, most played first, optionally only the ones matching a search
+def rank_tracks(ranking, user_data, offset, limit, search_query=""):
+    stored_tracks = user_data.stored_tracks
+
+    if search_query:
+        # the index only hands back matching tracks, so only those get ranked
+        matches = [(tid, ranking.get_frequency(tid)) for tid in user_data.track_search_index.search(search_query) if tid in ranking]
+        # ties in the same order every time, so pages don't repeat or skip tracks
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        page = matches[offset:offset + limit]
+        total_unique_tracks = len(matches)
+        total_plays_counted = sum(freq for _, freq in matches)
+    else:
+        # running totals, no need to look at every track
+        page = ranking.get_page(offset, limit)
+        total_unique_tracks = len(ranking)
+        total_plays_counted = ranking.total_plays
+
+    # only the tracks on the requested page get copied
+    ranked_tracks = [dict(stored_tracks[tid], frequency=freq) for tid, freq in page if tid in stored_tracks]
+    return ranked_tracks, total_unique_tracks, total_plays_counted
 
 class TracksInContext:
-    def __init__(self):
+    def __init__(self, user_data, context_id=None, context_info=None, saved=False):
+        # the UserData this context belongs to, its tracks and indexes are the ones used here
+        self.user_data = user_data
+        self.context_id = context_id
+        # contexts saved by a previous run get their shuffles replayed the first time they're used
+        self.needs_loading = saved
         self.num_shuffles = 0
-        self.track_freq = {}
-        self.track_trie = TrackTrie()
-        self.context_info = {}
-
-    def get_ranked_tracks(self, search_query=""):
-        result = []
-        search_query_lower = search_query.lower()
-        for tid, freq in self.track_freq.items():
-            track = stored_tracks.get(tid)
-            if not track:
-                continue
-            if search_query and not (
-                search_query_lower in track.get('name', '').lower() or
-                any(search_query_lower in artist.get('name', '').lower() for artist in track.get('artists', []))):
-                continue
-            track_copy = track.copy()
-            track_copy['frequency'] = freq
-            result.append(track_copy)
-        return sorted(result, key=lambda x: x['frequency'], reverse=True)
+        # the store's ID for the newest shuffle here, it hands out the IDs so every process agrees on them
+        self.last_shuffle_id = -1
+        self.context_info = context_info or {}
+        # streaming mode swaps the exact ranking and trie for fixed size sketches, its error bounds are kept in the
+        # context's info so every process (and the next run) builds the context the same way, see set_streaming
+        self.streaming = self.context_info.get('streaming')
+        if self.streaming:
+            self.track_ranking = SketchRanking(self.streaming)
+            self.track_trie = PairSketch(self.streaming)
+        else:
+            self.track_ranking = TrackRanking()
+            self.track_trie = TrackTrie()
+        # artist ID -> plays of that artist's tracks in this context
+        self.artist_plays = {}
+        # what comparisons need from here, see get_aggregate
+        self.aggregate = None
+        # goes up with every change, cached responses are keyed on it
+        self.version = next(versions)
+        user_data.bump_contexts_version()
+
+    # every track's plays, or in streaming mode only the most played ones
+    @property
+    def track_freq(self):
+        return self.track_ranking.track_freq
+
+    def add_track_play(self, track):
+        self.track_ranking.increment(track['id'])
+        self.user_data.master_index.add_track_play(track['id'], self.context_id)
+
+        for artist in track.get('artists', []):
+            self.artist_plays[artist['id']] = self.artist_plays.get(artist['id'], 0) + 1
+
+    def get_ranked_tracks(self, offset, limit, search_query=""):
+        with operation_seconds.time('get_ranked_tracks'):
+            return rank_tracks(self.track_ranking, self.user_data, offset, limit, search_query)
     
-    def addShuffleQueue(self, tracks_deque):
-        self.track_trie.addShuffleQueue(tracks_deque, self.num_shuffles)
+    def addShuffleQueue(self, tracks_deque, shuffle_id):
+        with operation_seconds.time('addShuffleQueue'):
+            self.track_trie.addShuffleQueue(tracks_deque, shuffle_id)
+        # any track that just became part of a pattern has to be in this queue
+        tracks_with_patterns = self.track_trie.getAllTracksWithPatterns()
+        self.user_data.master_index.add_pattern_tracks(
+            [tid for tid in dict.fromkeys(tracks_deque) if tid in tracks_with_patterns], self.context_id)
         self.num_shuffles += 1
-    
-    @staticmethod
-    def get_current_context():
-        context_id = session.get("current_context_id")
-        return all_contexts_track_info.setdefault(context_id, TracksInContext())
+        self.last_shuffle_id = shuffle_id
+
+    # Adds a shuffle that's already in the store (see ingest_sample), or one that's only ever kept in memory
+    def add_shuffle(self, tracks, shuffle_id=None):
+        if shuffle_id is None:
+            shuffle_id = self.last_shuffle_id + 1
+        track_ids = [track.get('id') for track in tracks]
+
+        for track in tracks:
+            self.add_track_play(track)
+
+        # Handle the track trie for pattern finding later
+        self.addShuffleQueue(deque(track_ids), shuffle_id)
+        self.version = next(versions)
+        self.user_data.master_version = self.version
+
+    # Plays per track (as the user's track numbers) and the patterns here, only rebuilt once the context
+    # has changed, so comparing contexts doesn't go through every one of them on each request
+    def get_aggregate(self):
+        with self.user_data.lock:
+            if self.aggregate is None or self.aggregate['version'] != self.version:
+                self.aggregate = {
+                    'version': self.version,
+                    'track_numbers': np.array(self.user_data.get_track_numbers(self.track_freq), dtype=np.int64),
+                    'counts': np.fromiter(self.track_freq.values(), dtype=np.int64, count=len(self.track_freq)),
+                    'patterns': {tuple(pattern) for pattern in self.track_trie.allPatterns.values()}
+                }
+            return self.aggregate
+
+    # Rough bytes held for this context alone, the tracks themselves belong to the UserData
+    def estimate_memory(self):
+        with self.user_data.lock:
+            ranking = self.track_ranking
+            if self.streaming:
+                size = ranking.estimate_memory()
+            else:
+                size = (sys.getsizeof(self.track_freq) + sys.getsizeof(ranking.buckets) + sys.getsizeof(ranking.lower) +
+                        sys.getsizeof(ranking.higher) + sum(sys.getsizeof(bucket) for bucket in ranking.buckets.values()))
+            size += self.track_trie.estimateMemory() + sys.getsizeof(self.artist_plays)
+            if self.aggregate is not None:
+                size += self.aggregate['track_numbers'].nbytes + self.aggregate['counts'].nbytes + sys.getsizeof(self.aggregate['patterns'])
+            return size
+
+    def set_context_info(self, context_info):
+        if self.streaming:
+            context_info = dict(context_info, streaming=self.streaming)
+        self.context_info = context_info
+        shuffle_store.save_context_info(self.user_data.user_id, self.context_id, context_info)
+        self.version = next(versions)
+        self.user_data.bump_contexts_version()
+
+    # Turns streaming mode on with the given sketch settings, or off with None. The context is built again from
+    # its stored shuffles, in this process and (through the store) every other one that has the user loaded
+    def set_streaming(self, settings):
+        user_data = self.user_data
+        with user_data.lock:
+            context_info = {key: value for key, value in self.context_info.items() if key != 'streaming'}
+            if settings:
+                context_info['streaming'] = settings
+            shuffle_store.save_context_info(user_data.user_id, self.context_id, context_info)
+            # the master index has this context's plays in it as well, so everything is loaded again
+            shuffle_store.touch_user(user_data.user_id, reload=True)
+            user_data.sync()
+
+    # What streaming mode is doing for the context, None when it's not on
+    def get_streaming_status(self):
+        if not self.streaming:
+            return None
+        return {
+            'settings': self.streaming,
+            'frequency_error_bound': self.track_ranking.get_error_bound(),
+            # the ranking only pages through the top_k, this is how many distinct tracks there are in all
+            'estimated_unique_tracks': self.track_ranking.estimate_distinct(),
+            'memory_bytes': self.estimate_memory()
+        }
+
+    def load(self):
+        if not self.needs_loading:
+            return
+
+        self.needs_loading = False
+        self.catch_up()
+
+    # Replays the stored shuffles newer than the last one here, which is all of them the first time.
+    # A batch at a time, so a long history is never all in memory at once (which matters most in streaming mode)
+    def catch_up(self):
+        user_data = self.user_data
+        shuffles = shuffle_store.iter_shuffles(user_data.user_id, self.context_id, after=self.last_shuffle_id)
+
+        while True:
+            batch = list(itertools.islice(shuffles, BATCH_SIZE))
+            if not batch:
+                return
+
+            # tracks another process stored along with its samples
+            missing_track_ids = {tid for _, track_ids in batch for tid in track_ids if tid not in user_data.stored_tracks}
+            if missing_track_ids:
+                for track in shuffle_store.load_tracks_by_id(missing_track_ids).values():
+                    user_data.store_track(track, save=False)
+
+            stored_tracks = user_data.stored_tracks
+            for shuffle_id, track_ids in batch:
+                self.add_shuffle([stored_tracks[tid] for tid in track_ids if tid in stored_tracks], shuffle_id)
+
+# Everything collected for one user, their tracks, indexes and contexts. Each user has their own lock,
+# so one user's sampler or reset never holds up anyone else's requests.
+# The store is what every worker process shares, this is one process's copy of it, kept up to date by sync()
+class UserData:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.lock = threading.RLock()
+        # the user's row in the store's users table as of the last sync
+        #     generation: a sampler's samples are only taken while the generation it was started in is current, see cancel_sampling
+        #     data_generation: changes when the stored data was replaced rather than added to
+        #     store_version: changes with anything stored for the user
+        self.generation = 0
+        self.data_generation = 0
+        self.store_version = 0
+        # filled in from the store the first time the user is seen, see load_saved_data
+        self.needs_loading = True
+        self.clear_loaded_data()
+
+    # Drops everything held in memory, the store is left alone
+    def clear_loaded_data(self):
+        self.stored_tracks = {}
+        self.track_search_index = TrackSearchIndex()
+        self.artist_genre_index = ArtistGenreIndex(artist_genres_cache)
+        self.contexts = {}
+        # every track seen in any of the user's contexts gets a number, so contexts can be lined up on them
+        self.track_numbers = {}
+        self.numbered_track_ids = []
+        # every context's plays and patterns together, master_version changes along with it
+        self.master_index = MasterTrackIndex()
+        self.master_version = next(versions)
+        self.bump_data_version()
+        self.bump_contexts_version()
+
+    # bumped whenever tracks or genres are added, since those show up in every one of the user's context responses
+    def bump_data_version(self):
+        self.data_version = next(versions)
+
+    # bumped whenever a context is added or its details change
+    def bump_contexts_version(self):
+        self.contexts_version = next(versions)
+
+    def store_track(self, track, save=True):
+        self.stored_tracks[track['id']] = track
+        self.track_search_index.add_track(track)
+        self.artist_genre_index.add_track(track)
+        self.bump_data_version()
+        if save:
+            shuffle_store.save_track(track)
+
+    def get_track_numbers(self, track_ids):
+        numbers = []
+        for track_id in track_ids:
+            number = self.track_numbers.get(track_id)
+            if number is None:
+                number = self.track_numbers[track_id] = len(self.numbered_track_ids)
+                self.numbered_track_ids.append(track_id)
+            numbers.append(number)
+        return numbers
+
+    def add_artist_genres(self, artist_id, genres):
+        self.artist_genre_index.add_artist_genres(artist_id, genres)
+        self.bump_data_version()
+
+    def has_artist(self, artist_id):
+        return artist_id in self.artist_genre_index.artist_tracks
+
+    def set_store_state(self, state):
+        self.generation, self.data_generation, self.store_version = state
+
+    # Bring back everything saved for the user, the shuffles themselves are only replayed once a context is used
+    def load_saved_data(self):
+        with self.lock:
+            if not self.needs_loading:
+                return
+
+            self.needs_loading = False
+            # read first, anything stored while this loads gets picked up by the next sync
+            self.set_store_state(shuffle_store.get_user_state(self.user_id))
+            for track in shuffle_store.load_user_tracks(self.user_id).values():
+                self.store_track(track, save=False)
+
+            for context_id, context_info in shuffle_store.load_contexts(self.user_id).items():
+                self.contexts[context_id] = TracksInContext(self, context_id, context_info, saved=True)
+
+    # Catches up with what other processes stored for the user, a single lookup when nothing has changed.
+    # Returns whether anything did
+    def sync(self):
+        with self.lock:
+            if self.needs_loading:
+                self.load_saved_data()
+                return True
+
+            generation, data_generation, store_version = shuffle_store.get_user_state(self.user_id)
+            self.generation = generation
+            if store_version == self.store_version:
+                return False
+
+            if data_generation != self.data_generation:
+                # reset or imported into somewhere else, start over
+                self.clear_loaded_data()
+                self.needs_loading = True
+                self.load_saved_data()
+                update_broadcaster.clear(self.is_subscription_key)
+                return True
+
+            self.store_version = store_version
+            for context_id, context_info in shuffle_store.load_contexts(self.user_id).items():
+                context = self.contexts.get(context_id)
+                if context is None:
+                    self.contexts[context_id] = TracksInContext(self, context_id, context_info, saved=True)
+                    continue
+
+                if context_info and context_info != context.context_info:
+                    context.context_info = context_info
+                    context.version = next(versions)
+                    self.bump_contexts_version()
+                # contexts nobody has looked at yet are left to load in full when they're used
+                if not context.needs_loading:
+                    context.catch_up()
+            return True
+
+    # Anything a sampler started before this hands in afterwards gets dropped, whichever process it's in.
+    # Samples are checked against the generation as they're stored and again under the lock before they're
+    # added here, so once this returns no old sample can land, even one already on its way
+    def cancel_sampling(self):
+        with self.lock:
+            self.generation = shuffle_store.cancel_sampling(self.user_id)
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    # Deletes the user's data, in memory and in the store, and cancels their sampler
+    def clear(self):
+        with self.lock:
+            self.clear_loaded_data()
+            self.needs_loading = False
+            self.set_store_state(shuffle_store.clear_user(self.user_id))
+        update_broadcaster.clear(self.is_subscription_key)
+
+    def is_subscription_key(self, key):
+        return key[0] == self.user_id
+
+    def get_context(self, context_id):
+        with self.lock:
+            context = self.contexts.get(context_id)
+            if context is None:
+                context = self.contexts[context_id] = TracksInContext(self, context_id)
+
+            context.load()
+            return context
+
+    # The master index only has contexts that were loaded, this loads the rest
+    def load_all_contexts(self):
+        with self.lock:
+            for context_id in list(self.contexts):
+                self.get_context(context_id)
+
+    def get_current_context(self):
+        return self.get_context(session.get("current_context_id"))
+
+    def format_track_summary(self, track_id):
+        track_info = self.stored_tracks.get(track_id, {})
+        return {
+            "id": track_id,
+            "name": track_info.get('name', 'Unknown Track'),
+            "artists": [{"name": artist['name']} for artist in track_info.get('artists', [])]
+        }
+
+# Versions come from one counter that never restarts, so a version number is never reused after a reset,
+# BOOT_ID keeps ETags from a previous run of the server from matching
+versions = itertools.count(1)
+BOOT_ID = uuid.uuid4().hex
 
 load_dotenv()
 
-artist_genres_cache = {}
-stored_tracks = {}
-all_contexts_track_info = {}
+# SPOTIFY_SIMULATOR=1 swaps spotify for an in-process stand-in, for load testing without an account (see loadTest.py)
+if os.environ.get("SPOTIFY_SIMULATOR") == "1":
+    spotifySimulator.install()
+
+shuffle_store = ShuffleStore()
+# every worker process takes its spotify calls out of the one budget kept in the store
+spotifyClient.rate_budget = spotifyClient.RateBudget(store=shuffle_store)
+
+# spotify metadata is shared by every session and survives a reset, set METADATA_DISK_CACHE=0 to keep it in memory only
+ARTIST_GENRES_TTL = 7 * 24 * 60 * 60
+EMPTY_GENRES_TTL = 24 * 60 * 60 # artists with no genres are checked again sooner
+CONTEXT_INFO_TTL = 24 * 60 * 60
+metadata_store = shuffle_store if os.environ.get("METADATA_DISK_CACHE", "1") != "0" else None
+artist_genres_cache = MetadataCache('artist_genres', max_entries=20000, ttl=ARTIST_GENRES_TTL, negative_ttl=EMPTY_GENRES_TTL, store=metadata_store)
+context_info_cache = MetadataCache('context_info', max_entries=1000, ttl=CONTEXT_INFO_TTL, store=metadata_store)
+
+# user ID -> that user's UserData, loaded the first time they make a request
+user_data_shards = {}
+user_data_shards_lock = threading.Lock()
+# user ID -> that user's background ShuffleSampler, if it's running in this process
+samplers = {}
+# a sampler that hasn't reported in this long went down with its process, longer than it can sit out a rate limit
+SAMPLER_STALE_AFTER = 90.0
+# memoized JSON for the read endpoints, see versioned_json_response
+response_cache = ResponseCache(max_entries=512, max_bytes=32 * 1024 * 1024)
+# pushes each new sample to the /queue_stream viewers of its (user, context)
+update_broadcaster = UpdateBroadcaster()
 MAX_TRACKS_TO_SEND = 50 # This will be the default limit when tracking is active
+MAX_SHUFFLE_ORDERS_PER_PAGE = 100
+MAX_SHARED_PATTERNS = 50
+
+# FLASK_SECRET_KEY if it's set, otherwise a random key made on the first run and kept next to the app,
+# so sessions stay valid across restarts and every worker process signs cookies with the same key
+SECRET_KEY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".flask_secret_key")
+
+def get_secret_key():
+    secret_key = os.environ.get("FLASK_SECRET_KEY")
+    if secret_key:
+        return secret_key
+
+    try:
+        # O_EXCL so two processes starting at once can't both write a key
+        fd = os.open(SECRET_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+
+    # read back even after writing it, in case another process won the race
+    for _ in range(50):
+        with open(SECRET_KEY_PATH) as f:
+            secret_key = f.read().strip()
+        if secret_key:
+            return secret_key
+        time.sleep(0.01)
+    raise RuntimeError(f"{SECRET_KEY_PATH} is empty, delete it or set FLASK_SECRET_KEY")
 
 app = Flask(__name__)
-app.secret_key = 'your_secret_key'  # Replace with a real secret in production
+app.secret_key = get_secret_key()
+
+# Timings and counters for /metrics, see appMetrics
+request_seconds = appMetrics.registry.histogram('http_request_seconds', "Time to handle each request, up to the first byte of a streamed one",
+                                                ['endpoint', 'method', 'status'])
+response_bytes = appMetrics.registry.histogram('http_response_bytes', "Size of each response that isn't streamed",
+                                               ['endpoint'], buckets=appMetrics.SIZE_BUCKETS)
+json_serialize_seconds = appMetrics.registry.histogram('json_serialize_seconds', "Time spent turning cached responses into JSON", ['endpoint'])
+operation_seconds = appMetrics.registry.histogram('operation_seconds', "Time spent in the trie, ranking and stats hot paths", ['operation'])
+# /metrics and the profiler are for whoever sends METRICS_TOKEN as a bearer token, without one set only
+# requests from this machine get in (behind a proxy on the same machine that's everyone, so set a token there)
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+LOOPBACK_ADDRESSES = {'127.0.0.1', '::1'}
+
+# totals per mode rather than per context, so nobody's user or context IDs end up in the metrics
+def collect_context_memory():
+    totals = {'exact': 0, 'streaming': 0}
+    for user_data in get_all_user_data():
+        with user_data.lock:
+            contexts = list(user_data.contexts.values())
+        for context in contexts:
+            totals['streaming' if context.streaming else 'exact'] += context.estimate_memory()
+    return [((mode,), total) for mode, total in totals.items()]
+
+def collect_samplers():
+    yield (), sum(sampler.is_running() for sampler in list(samplers.values()))
+
+appMetrics.registry.gauge('context_memory_bytes', "Rough memory held by the loaded contexts' tries, rankings and aggregates",
+                          ['mode'], collect=collect_context_memory)
+appMetrics.registry.gauge('response_cache_bytes', "Size of the cached JSON responses", collect=lambda: [((), response_cache.total_bytes)])
+appMetrics.registry.gauge('samplers_running', "Samplers running in this process", collect=collect_samplers)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(time.perf_counter() - started, endpoint, request.method, str(response.status_code))
+        if not response.is_streamed and response.content_length is not None:
+            response_bytes.observe(response.content_length, endpoint)
+    return response
 
 SCOPE = "playlist-read-private user-read-playback-state user-modify-playback-state user-library-read user-top-read"
 
-# Helper function to perform full reset logic (data and Spotify state)
+# Helper function to perform full reset logic (data and Spotify state), only for the calling user
 def reset():
-    # wait for things to stop running
+    # clear() cancels the sampler as well, so there's no need to wait for a sample in progress to finish
     session['running'] = False
-    time.sleep(2)
-
-    global stored_tracks
-    global artist_genres_cache
-    global all_contexts_track_info
+    stop_sampler()
 
-    stored_tracks = {}
-    artist_genres_cache = {} 
-    all_contexts_track_info = {} # Clear all contexts
+    get_user_data().clear()
+    shuffle_store.delete_expired_metadata(time.time())
+    shuffle_store.compact()
     
     # Clear session-specific tracking variables
-    if 'unshuffledkeys' in session:
-        del session['unshuffledkeys']
-
-    if 'current_song_id' in session:
-        del session['current_song_id']
-    
     if 'current_context_id' in session:
         del session['current_context_id']
 
+def get_user_data(user_id=None):
+    user_id = user_id or get_user_id()
+    with user_data_shards_lock:
+        user_data = user_data_shards.get(user_id)
+        if user_data is None:
+            user_data = user_data_shards[user_id] = UserData(user_id)
+
+    # loaded (or caught up with other processes) under the user's own lock, so other users aren't kept waiting
+    user_data.sync()
+    return user_data
+
+def get_all_user_data():
+    with user_data_shards_lock:
+        return list(user_data_shards.values())
+
+def cache_artist_genres(artist_id, genres):
+    artist_genres_cache.set(artist_id, genres)
+    if genres:
+        # the cache is shared, but each user indexes genres for their own tracks
+        for user_data in get_all_user_data():
+            if user_data.has_artist(artist_id):
+                with user_data.lock:
+                    user_data.add_artist_genres(artist_id, genres)
+
+# Serves build()'s result as JSON with an ETag made from key, or a 304 if the client already has it.
+# key has to include the user and every version the result depends on, and is worked out under the user's lock along with the build.
+# Errors come back from build() as (response, status) and are passed through uncached.
+def versioned_json_response(key, build):
+    etag = ResponseCache.make_etag((BOOT_ID, key))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key)
+        if body is None:
+            result = build()
+            if isinstance(result, tuple):
+                return result
+            with json_serialize_seconds.time(request.endpoint):
+                body = app.json.dumps(result)
+            response_cache.set(key, body)
+        response = Response(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    # let the browser keep a copy but always check back with the ETag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def fetch_context_details(sp, context_type, context_id):
+    details = {}
+
+    if context_type == 'album':
+        context = sp.album(context_id)
+        details['owner_name'] = context['artists'][0]['name'] if context['artists'] else None
+        details['total_tracks'] = context['total_tracks']
+    elif context_type == 'playlist':
+        context = sp.playlist(context_id)
+        details['owner_name'] = context['owner']['display_name']
+        details['total_tracks'] = context['tracks']['total']
+    elif context_type == 'artist':
+        context = sp.artist(context_id)
+    else:
+        return details
+
+    details['name'] = context['name']
+    details['image_url'] = context['images'][0]['url'] if context['images'] else None
+    return details
+
+# the spotify user ID once logged in (see callback), a random one for sessions that never went through it
+def get_user_id():
+    if 'user_id' not in session:
+        session['user_id'] = uuid.uuid4().hex
+    return session['user_id']
+
+def stop_sampler():
+    user_id = session.get('user_id')
+    if user_id is None:
+        return
+
+    # takes effect straight away, a sample still in progress is dropped when it comes in
+    get_user_data(user_id).cancel_sampling()
+    sampler = samplers.pop(user_id, None)
+    if sampler:
+        sampler.stop()
+
+# The user's sampler if it's running in this process, otherwise what it last reported from
+# whichever process it is running in, or None
+def get_sampler(user_data):
+    sampler = samplers.get(user_data.user_id)
+    if sampler is not None:
+        return sampler
+
+    reported = shuffle_store.load_sampler_status(user_data.user_id)
+    if reported is None or not user_data.is_current(reported[0]):
+        return None
+    _, status, updated_at = reported
+    return SamplerStatus(status, updated_at, SAMPLER_STALE_AFTER)
+
+def save_sampler_status(user_id, generation, status):
+    return shuffle_store.save_sampler_status(user_id, generation, status, time.time())
+
+# Called from a sampler's thread with every new shuffled queue, generation is the one the sampler was started in.
+# Returns False once the sampler has been cancelled
+def ingest_sample(user_data, generation, sp, context_id, queue_data):
+    if not user_data.is_current(generation):
+        return False
+
+    tracks = queue_data.get('queue', [])
+
+    # Collect unique artist IDs from the current queue to fetch genres
+    new_artist_ids = set()
+    for track in tracks:
+        for artist in track.get('artists', []):
+            if artist['id'] not in artist_genres_cache:
+                new_artist_ids.add(artist['id'])
+
+    # Fetch genres for new artists and add to cache
+    if new_artist_ids:
+        # the client merges these with other pending lookups into 50-artist calls
+        try:
+            artists_data = sp.artists(list(new_artist_ids))
+            artists_by_id = {artist['id']: artist for artist in artists_data['artists'] if artist}
+            # artists without genres get cached as well so they aren't fetched on every sample
+            for artist_id in new_artist_ids:
+                cache_artist_genres(artist_id, artists_by_id.get(artist_id, {}).get('genres', []))
+        except spotipy.exceptions.SpotifyException as e:
+            print(f"Warning: Could not fetch genres for artist batch: {e}")
+            pass
+
+    # stored first, the store hands out the shuffle ID and turns the sample away if the sampler was
+    # cancelled in the meantime, from this process or any other
+    stored = shuffle_store.append_sample(user_data.user_id, generation, context_id, tracks)
+    if stored is None:
+        return False
+    shuffle_id, store_version = stored
+
+    with user_data.lock:
+        # reset here after it was stored, the reset deleted it again
+        if not user_data.is_current(generation):
+            return False
+
+        for track in tracks:
+            if track.get('id') not in user_data.stored_tracks:
+                user_data.store_track(track, save=False)
+
+        # Update context-specific frequencies and patterns
+        context_track_info = user_data.get_context(context_id)
+        track_ids = [track.get('id') for track in tracks]
+        tracks_with_patterns = context_track_info.track_trie.getAllTracksWithPatterns()
+        had_patterns = {tid for tid in track_ids if tid in tracks_with_patterns}
+        if shuffle_id == context_track_info.last_shuffle_id + 1:
+            context_track_info.add_shuffle(tracks, shuffle_id)
+        else:
+            # another process stored some in between
+            context_track_info.catch_up()
+
+        # nothing else has been stored for the user since the last sync, so this copy is still up to date
+        if store_version == user_data.store_version + 1:
+            user_data.store_version = store_version
+
+        subscription_key = (user_data.user_id, context_id)
+        if update_broadcaster.has_subscribers(subscription_key):
+            update_broadcaster.publish(subscription_key, get_shuffle_update(
+                context_track_info, track_ids, had_patterns, get_currently_playing_data(queue_data)))
+    return True
+
+# Only what one sample changed: the new frequencies of the tracks in it and any tracks that just got a pattern
+def get_shuffle_update(context_track_info, track_ids, had_patterns, currently_playing):
+    ranking = context_track_info.track_ranking
+    user_data = context_track_info.user_data
+    tracks_with_patterns = context_track_info.track_trie.getAllTracksWithPatterns()
+    new_patterns = dict.fromkeys(tid for tid in track_ids if tid in tracks_with_patterns and tid not in had_patterns)
+
+    return {
+        'num_shuffles': context_track_info.num_shuffles,
+        'total_unique_tracks': len(ranking),
+        'total_plays_counted': ranking.total_plays,
+        'frequencies': {tid: ranking.get_frequency(tid) for tid in track_ids},
+        'new_patterns': [user_data.format_track_summary(tid) for tid in new_patterns if tid in user_data.stored_tracks],
+        'currently_playing': currently_playing
+    }
+
+# shared metadata is warmed once at startup, each user's own data is loaded the first time they're seen
+artist_genres_cache.warm()
+context_info_cache.warm()
+
 # Dedicated endpoint for the "Reset Data" button/link
 @app.route('/reset')
 def reset_route():
     reset()
     return redirect('/')
 
+# Downloads everything the user collected (or just ?context_id=... contexts) as NDJSON, or ?format=parquet for a zip of parquet tables
+@app.route('/export')
+def export_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    export_format = request.args.get('format', type=str, default='ndjson')
+    # contexts without an ID are asked for with an empty context_id
+    context_ids = [context_id or None for context_id in request.args.getlist('context_id')] or None
+    filename = f"shuffle_export_{time.strftime('%Y%m%d_%H%M%S')}"
+    user_id = get_user_id()
+
+    if export_format == 'ndjson':
+        # streamed straight out of the store as it's read
+        return Response(shuffleExport.export_ndjson(shuffle_store, user_id, context_ids), mimetype='application/x-ndjson',
+                        headers={'Content-Disposition': f'attachment; filename={filename}.ndjson'})
+
+    if export_format == 'parquet':
+        if not shuffleExport.has_parquet_support():
+            return jsonify({"status": "error", "error": "Parquet export needs pyarrow installed on the server."}), 501
+
+        archive = tempfile.TemporaryFile()
+        with tempfile.TemporaryDirectory() as directory:
+            shuffleExport.export_parquet_zip(shuffle_store, user_id, archive, directory, context_ids)
+        archive.seek(0)
+        return send_file(archive, mimetype='application/zip', as_attachment=True, download_name=f"{filename}.zip")
+
+    return jsonify({"status": "error", "error": f"Unknown export format: {export_format}"}), 400
+
+# Merges an export (an .ndjson file or a parquet .zip) uploaded as "file" into the user's collected data
+@app.route('/import', methods=['POST'])
+def import_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({"status": "error", "error": "No file uploaded."}), 400
+
+    is_parquet = upload.filename.endswith('.zip')
+    if is_parquet and not shuffleExport.has_parquet_support():
+        return jsonify({"status": "error", "error": "Parquet import needs pyarrow installed on the server."}), 501
+
+    # the sampler keeps running, the store hands out shuffle IDs as each batch (or sample) is written,
+    # so imported shuffles and new samples just end up interleaved
+    user_data = get_user_data()
+    try:
+        if is_parquet:
+            with tempfile.TemporaryDirectory() as directory:
+                stats = shuffleExport.import_parquet_zip(shuffle_store, user_data.user_id, upload.stream, directory)
+        else:
+            stats = shuffleExport.import_ndjson(shuffle_store, user_data.user_id, upload.stream)
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        # the file is checked through before anything is written, so none of it was imported
+        return jsonify({"status": "error", "error": f"Could not read the import file, nothing was imported: {str(e)}"}), 400
+
+    # the importer marks the data as replaced, so this replays it from the store with the imported shuffles alongside
+    user_data.sync()
+
+    return jsonify({"status": "success", "imported": stats})
+
 @app.route('/')
 def index():
     token_info = session.get('token_info')
@@ -120,39 +795,51 @@ def callback():
     code = request.args.get('code')
     token_info = sp_oauth.get_access_token(code)
     session['token_info'] = token_info
+
+    # data is kept per spotify account, so it follows the user across browsers and restarts
+    try:
+        user_id = spotifyClient.get_client(token_info['access_token']).current_user()['id']
+    except spotipy.exceptions.SpotifyException as e:
+        print(f"Warning: Could not look up the spotify user: {e}")
+        return redirect('/')
+
+    if session.get('user_id') != user_id:
+        stop_sampler()
+        session['running'] = False
+        session['user_id'] = user_id
+    # whoever logs in first after upgrading gets the data collected before it was kept per user,
+    # it's marked as replaced so any copy of theirs already loaded starts over
+    shuffle_store.claim_unowned(user_id)
     return redirect('/')
 
 @app.route('/logout')
 def logout():
+    # the collected data stays in the store for the next login, only /reset deletes it
+    session['running'] = False
+    stop_sampler()
     # Clear all session data, including Spotify tokens
     session.clear()
-    reset()
 
     # Redirect to the home page after logout
     return redirect('/')
 
-def populateUnShuffledKeys(queue_data):
-    if 'unshuffledkeys' in session:
-        session['unshuffledkeys'].clear()
-
-    tracks = queue_data.get('queue', [])
-    if len(tracks) >= 2:
-        session['unshuffledkeys'] = [tracks[0]['id'], tracks[1]['id']]
-    elif len(tracks) == 1:
-        session['unshuffledkeys'] = [tracks[0]['id']]
-    else:
-        session['unshuffledkeys'] = []
-
 @app.route('/get_all_contexts')
-def get_all_contexts():
+def get_all_contexts_route():
     token_info = session.get('token_info')
     if not token_info:
         return jsonify({"status": "error", "error": "Not logged in"}), 401
-    
-    global all_contexts_track_info
 
+    user_data = get_user_data()
+    with user_data.lock:
+        return versioned_json_response(('get_all_contexts', user_data.user_id, user_data.contexts_version),
+                                       lambda: get_all_contexts(user_data))
+
+def get_all_contexts(user_data):
     contexts_for_frontend = []
-    for cid, tracks_in_context in all_contexts_track_info.items():
+    with user_data.lock:
+        contexts = list(user_data.contexts.items())
+
+    for cid, tracks_in_context in contexts:
         context_info = tracks_in_context.context_info
 
         # Only include contexts that have a name
@@ -171,13 +858,12 @@ def get_all_contexts():
 
 @app.route('/toggle', methods=['GET', 'POST'])
 def toggle():
-    global all_contexts_track_info
-
     token_info = session.get('token_info')
     if not token_info:
         return jsonify({"status": "error", "error": "Not logged in"}), 401
     
-    sp = spotipy.Spotify(auth=token_info['access_token'])
+    sp = spotifyClient.get_client(token_info['access_token'])
+    user_data = get_user_data()
 
     # toggle the state 
     new_running_state = not session.get('running', False)
@@ -205,9 +891,6 @@ def toggle():
             playback_info['item_name'] = current_playback.get('item', {}).get('name')
             playback_info['item_artist'] = ", ".join([a['name'] for a in current_playback.get('item', {}).get('artists', [])])
 
-            # store the current song so we can check when it changes
-            session['current_song_id'] = current_playback.get('item', {}).get('id')
-
             # Populate context_info
             if current_playback.get('context'):
                 context_type = current_playback['context']['type']
@@ -216,31 +899,29 @@ def toggle():
                 
                 session['current_context_id'] = context_id
 
-                if context_type == 'album':
-                    context = sp.album(context_id)
-                    context_info['owner_name'] = context['artists'][0]['name'] if context['artists'] else None
-                    context_info['total_tracks'] = context['total_tracks']
-                elif context_type == 'playlist':
-                    context = sp.playlist(context_id)
-                    context_info['owner_name'] = context['owner']['display_name']
-                    context_info['total_tracks'] = context['tracks']['total']
-                elif context_type == 'artist':
-                    context = sp.artist(context_id)
-                
-                if context:
-                    context_info['name'] = context['name']
-                    context_info['image_url'] = context['images'][0]['url'] if context['images'] else None
+                # album/playlist/artist details rarely change, so they come from the cache when possible
+                context_info.update(context_info_cache.get_or_fetch(
+                    f"{context_type}:{context_id}",
+                    lambda: fetch_context_details(sp, context_type, context_id)))
 
                 # set the data for the specific context we are in
-                context_track_info = all_contexts_track_info.setdefault(context_id, TracksInContext())
-                context_track_info.context_info = context_info
-
-            sp.shuffle(False) # Unshuffle
-            time.sleep(2.5)
-
-            populateUnShuffledKeys(sp.queue())
-
-            return jsonify(running=session['running'], status="started", playback_info=playback_info, context_info=context_info, all_contexts=get_all_contexts())
+                with user_data.lock:
+                    context_track_info = user_data.get_context(context_id)
+                    context_track_info.set_context_info(context_info)
+
+            # sampling carries on in the background until tracking is stopped,
+            # the sampler learns the unshuffled order itself so there's no need to wait for it here.
+            # ?depth=N turns on deep sampling, which skips ahead through playback to record N tracks per shuffle
+            stop_sampler()
+            sampler = ShuffleSampler(token_info['access_token'],
+                                     session.get('current_context_id'),
+                                     functools.partial(ingest_sample, user_data, user_data.generation),
+                                     on_status=functools.partial(save_sampler_status, user_data.user_id, user_data.generation),
+                                     depth=request.args.get('depth', type=int, default=DEEP_SAMPLE_DEPTH))
+            samplers[user_data.user_id] = sampler
+            sampler.start()
+
+            return jsonify(running=session['running'], status="started", playback_info=playback_info, context_info=context_info, all_contexts=get_all_contexts(user_data))
 
         except spotipy.exceptions.SpotifyException as e:
             session['running'] = False # Revert running state if setup fails
@@ -249,30 +930,24 @@ def toggle():
             return jsonify({"status": "error", "error": f"Error during setup: {str(e)}"}), 500
         
     else: # User is trying to STOP tracking
+        stop_sampler()
         return jsonify(running=session['running'], status="stopped")
 
-def get_queue_data_json(offset=0, limit=MAX_TRACKS_TO_SEND, search_query=""):
-    context_obj = TracksInContext.get_current_context()
-    ranked_tracks = context_obj.get_ranked_tracks(search_query)
-    total_unique_tracks = len(ranked_tracks)
-    total_plays_counted = sum(t['frequency'] for t in ranked_tracks)
-    paginated_tracks = ranked_tracks[offset:offset + limit]
+def get_queue_data_json(offset=0, limit=MAX_TRACKS_TO_SEND, search_query="", context_obj=None):
+    context_obj = context_obj or get_user_data().get_current_context()
+    user_data = context_obj.user_data
+    paginated_tracks, total_unique_tracks, total_plays_counted = context_obj.get_ranked_tracks(offset, limit, search_query)
 
     tracks_with_patterns_ids = context_obj.track_trie.getAllTracksWithPatterns()
-    tracks_with_patterns = [
-        {
-            'name': stored_tracks[track_id]['name'],
-            'artists': [{"name": artist['name']} for artist in stored_tracks[track_id]['artists']]
-        }
-        for track_id in tracks_with_patterns_ids if track_id in stored_tracks
-    ]
+    tracks_with_patterns = [user_data.format_track_summary(track_id) for track_id in tracks_with_patterns_ids if track_id in user_data.stored_tracks]
 
     return {
         'queue': paginated_tracks,
         'total_unique_tracks': total_unique_tracks,
         'total_plays_counted': total_plays_counted,
         'tracks_with_patterns': tracks_with_patterns,
-        'has_more': (offset + limit) < total_unique_tracks
+        'has_more': (offset + limit) < total_unique_tracks,
+        'streaming': context_obj.get_streaming_status()
     }
 
 @app.route('/queue_data')
@@ -287,104 +962,22 @@ def queue_data_endpoint():
         session['current_context_id'] = context_id
 
     if session.get("running"):
-        # We also need to perform the shuffle logic
-        sp = spotipy.Spotify(auth=token_info['access_token'])
-
-        global stored_tracks
-        global artist_genres_cache
-
-        try:
-            sp.shuffle(False)
-            
-            queue_data = sp.queue()
-            # song changed, so need to update the unshuffled keys
-            if queue_data['currently_playing']['id'] != session['current_song_id']:
-                time.sleep(5)
-                populateUnShuffledKeys(queue_data)
-                session['current_song_id'] = queue_data['currently_playing']['id']
-
-            sp.shuffle(True)
-
-            # Wait until the shuffle takes effect by checking if the first 2 tracks changed
-            max_attempts = 5
-            attempts = 0
-
-            unshuffled_keys = session.get('unshuffledkeys', [])
-            
-            # wait until shuffle takes effect
-            while attempts < max_attempts:
-                queue_data = sp.queue()
-                tracks = queue_data.get('queue', [])
-
-                if len(tracks) >= 2 and len(unshuffled_keys) >= 2:
-                    if tracks[0]['id'] != unshuffled_keys[0] or tracks[1]['id'] != unshuffled_keys[1]:
-                        break  # Shuffle has taken effect
-                elif len(tracks) >= 1 and len(unshuffled_keys) >= 1:
-                    if len(unshuffled_keys) >= 1 and tracks[0]['id'] != unshuffled_keys[0]:
-                        break # Shuffle has taken effect
-                else:
-                    break  # Not enough info to compare or queue is empty
-
-                time.sleep(0.5)  # Avoid hitting rate limits with spotify
-                attempts += 1
-
-        except spotipy.exceptions.SpotifyException as e:
-            if e.http_status == 401: # Token expired
-                return jsonify({"status": "error", "error": "Token expired, please log in again"}), 401
-            if e.http_status == 429: # rate limits
-                return jsonify({"status": "error", "error": "Rate limits met, please try again later"}), 429
-            if e.http_status == 404: # rate limits
-                return jsonify({"status": "error", "error": "No active device, please keep spotify open"}), 404
-            
-            # For any other Spotify API errors during this process, return an error to frontend
-            return jsonify({"status": "error", "error": f"Spotify API error during shuffle operation: {str(e)}"}), 500
-        except Exception as e:
-            return jsonify({"status": "error", "error": f"An unexpected error occurred: {str(e)}"}), 500
-
-        # Collect unique artist IDs from the current queue to fetch genres
-        new_artist_ids = set()
-        for track in tracks:
-            for artist in track.get('artists', []):
-                if artist['id'] not in artist_genres_cache:
-                    new_artist_ids.add(artist['id'])
-
-        # Fetch genres for new artists and add to cache
-        if new_artist_ids:
-            # Spotify API allows fetching up to 50 artists at once
-            artist_ids_list = list(new_artist_ids)
-            for i in range(0, len(artist_ids_list), 50):
-                batch_ids = artist_ids_list[i:i+50]
-                try:
-                    artists_data = sp.artists(batch_ids)
-                    for artist in artists_data['artists']:
-                        if artist and artist.get('genres'):
-                            artist_genres_cache[artist['id']] = artist['genres']
-                except spotipy.exceptions.SpotifyException as e:
-                    print(f"Warning: Could not fetch genres for artist batch: {e}")
-                    pass
-
-        context_track_info = TracksInContext.get_current_context()
-        for track in tracks:
-            tid = track.get('id')
-
-            if tid not in stored_tracks:
-                stored_tracks[tid] = track
-
-            # Update context-specific frequency
-            context_track_info.track_freq[tid] = context_track_info.track_freq.get(tid, 0) + 1
-
-        # Handle the track trie for pattern finding later
-        tracks_deque = deque([track.get('id') for track in tracks])
-        context_track_info.addShuffleQueue(tracks_deque)
-
-        currently_playing = queue_data['currently_playing']
-        currently_playing_data = {
-            'item_name': queue_data['currently_playing'].get('name', 'Unknown Track'),
-            'item_artist': ", ".join([a['name'] for a in currently_playing.get('artists', [])])
-        }
-
-        queue_data_json = get_queue_data_json()
-        queue_data_json['currently_playing'] = currently_playing_data
+        # the sampler thread does the shuffling, this just reads what it has collected
+        user_data = get_user_data()
+        sampler = get_sampler(user_data)
+        if not sampler:
+            session['running'] = False
+            return jsonify({"status": "error", "error": "Tracking setup incomplete, please start tracking again"}), 409
+
+        if sampler.error:
+            if not sampler.is_running():
+                session['running'] = False
+                stop_sampler()
+            return jsonify({"status": "error", "error": sampler.error['error']}), sampler.error['status']
+
+        with user_data.lock:
+            queue_data_json = get_queue_data_json(context_obj=user_data.get_current_context())
+        queue_data_json['currently_playing'] = sampler.currently_playing
     
         # Now get the data for the frontend based on the enforced limit
         return jsonify(queue_data_json)
@@ -393,8 +986,91 @@ def queue_data_endpoint():
         limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
         offset = request.args.get('offset', type=int, default=0)
         search_query = request.args.get('search', type=str, default="")
-        return jsonify(get_queue_data_json(offset, limit, search_query))
+        user_data = get_user_data()
+        with user_data.lock:
+            context_obj = user_data.get_current_context()
+            key = ('queue_data', user_data.user_id, context_obj.context_id, context_obj.version, user_data.data_version, offset, limit, search_query)
+            return versioned_json_response(key, lambda: get_queue_data_json(offset, limit, search_query, context_obj))
+
+
+def get_stream_snapshot(user_data, context_id):
+    with user_data.lock:
+        snapshot = get_queue_data_json(context_obj=user_data.get_context(context_id))
+    sampler = get_sampler(user_data)
+    snapshot['currently_playing'] = sampler.currently_playing if sampler else None
+    return snapshot
+
+def stream_updates(subscription, user_data):
+    _, context_id = subscription.key
+    try:
+        snapshot = get_stream_snapshot(user_data, context_id)
+        # full track details only go out the first time this viewer sees a track
+        known_track_ids = {track['id'] for track in snapshot['queue']}
+        yield format_event('snapshot', snapshot)
+
+        last_error = None
+        idle_time = 0.0
+        while True:
+            if subscription.needs_snapshot:
+                # fell too far behind (or the data was reset), start over
+                subscription.needs_snapshot = False
+                while subscription.get(0) is not None:
+                    pass
+                snapshot = get_stream_snapshot(user_data, context_id)
+                known_track_ids = {track['id'] for track in snapshot['queue']}
+                yield format_event('snapshot', snapshot)
+
+            update = subscription.get(STATUS_CHECK_INTERVAL)
+            if update is not None:
+                idle_time = 0.0
+                with user_data.lock:
+                    stored_tracks = user_data.stored_tracks
+                    new_tracks = {tid: stored_tracks[tid] for tid in update['frequencies'] if tid not in known_track_ids and tid in stored_tracks}
+                known_track_ids.update(new_tracks)
+                yield format_event('delta', dict(update, tracks=new_tracks))
+                continue
 
+            # samples stored by another process don't come through the broadcaster, only a snapshot catches them
+            if user_data.sync():
+                subscription.needs_snapshot = True
+
+            # nothing new, make sure the sampler is still going
+            sampler = get_sampler(user_data)
+            if not sampler:
+                yield format_event('sampler_error', {"status": 409, "error": "Tracking setup incomplete, please start tracking again", "fatal": True})
+                return
+
+            if sampler.error != last_error:
+                last_error = sampler.error
+                if sampler.error:
+                    yield format_event('sampler_error', dict(sampler.error, fatal=not sampler.is_running()))
+            if not sampler.is_running():
+                return
+
+            idle_time += STATUS_CHECK_INTERVAL
+            if idle_time >= KEEPALIVE_INTERVAL:
+                idle_time = 0.0
+                yield format_keepalive()
+    finally:
+        update_broadcaster.unsubscribe(subscription)
+
+# Server-sent events for the context being tracked: one snapshot, then a delta per new sample
+@app.route('/queue_stream')
+def queue_stream_endpoint():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    context_id = request.args.get('context_id', type=str)
+    if context_id:
+        session['current_context_id'] = context_id
+
+    # subscribe before the snapshot is taken so nothing in between is missed,
+    # frequencies are sent as totals so seeing a sample twice does no harm
+    user_data = get_user_data()
+    subscription = update_broadcaster.subscribe((user_data.user_id, session.get('current_context_id')))
+    return Response(stream_updates(subscription, user_data), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/track_stats/<string:track_id>')
 def track_stats_endpoint(track_id):
@@ -402,143 +1078,552 @@ def track_stats_endpoint(track_id):
     if not token_info:
         return jsonify({"status": "error", "error": "Not logged in"}), 401
 
-    global stored_tracks
-    global artist_genres_cache
+    user_data = get_user_data()
+    with user_data.lock:
+        context_track_info = user_data.get_current_context()
+        key = ('track_stats', user_data.user_id, context_track_info.context_id, context_track_info.version, user_data.data_version, track_id)
+        return versioned_json_response(key, lambda: get_track_stats(track_id, context_track_info))
 
+def get_track_stats(track_id, context_track_info):
+    user_data = context_track_info.user_data
+    stored_tracks = user_data.stored_tracks
+    artist_genre_index = user_data.artist_genre_index
     track_stats = {}
 
-    try:
-        track_details = stored_tracks.get(track_id)
-        if not track_details:
-            return jsonify({"status": "error", "error": "Track not found."}), 404
+    with user_data.lock:
+        try:
+            track_details = stored_tracks.get(track_id)
+            if not track_details:
+                return jsonify({"status": "error", "error": "Track not found."}), 404
 
-        track_stats['id'] = track_details['id'] # Add track ID for consistency in frontend
-        track_stats['name'] = track_details['name']
-        track_stats['artists'] = [{"id": a['id'], "name": a['name']} for a in track_details['artists']]
-        track_stats['album_name'] = track_details['album']['name']
-        track_stats['album_image'] = track_details['album']['images'][0]['url'] if track_details['album']['images'] else None
-        track_stats['duration_ms'] = track_details['duration_ms']
-        track_stats['popularity'] = track_details['popularity'] # 0-100
-        track_stats['shuffle_chance_percent'] = 0.0
+            track_stats['id'] = track_details['id'] # Add track ID for consistency in frontend
+            track_stats['name'] = track_details['name']
+            track_stats['artists'] = [{"id": a['id'], "name": a['name']} for a in track_details['artists']]
+            track_stats['album_name'] = track_details['album']['name']
+            track_stats['album_image'] = track_details['album']['images'][0]['url'] if track_details['album']['images'] else None
+            track_stats['duration_ms'] = track_details['duration_ms']
+            track_stats['popularity'] = track_details['popularity'] # 0-100
+            track_stats['shuffle_chance_percent'] = 0.0
 
-        context_track_info = TracksInContext.get_current_context()
-        track_stats['frequency'] = context_track_info.track_freq[track_id]
+            track_stats['frequency'] = context_track_info.track_ranking.get_frequency(track_id)
 
-        total_tracks_in_context = context_track_info.context_info['total_tracks']
-        if total_tracks_in_context > 0:
-            track_stats['shuffle_chance_percent'] = (track_stats['frequency'] / total_tracks_in_context) * 100
+            total_tracks_in_context = context_track_info.context_info['total_tracks']
+            if total_tracks_in_context > 0:
+                track_stats['shuffle_chance_percent'] = (track_stats['frequency'] / total_tracks_in_context) * 100
 
-        clicked_track_artist_ids = {a['id'] for a in track_details['artists']}
+            clicked_track_artist_ids = {a['id'] for a in track_details['artists']}
 
-        # helper function to flatten the list of genres from multiple artists
-        def GetGenreList(artist_ids):
-            genre_list = []
+            # helper function to flatten the list of genres from multiple artists
+            def GetGenreList(artist_ids):
+                genre_list = []
 
-            for artist_id in artist_ids:
-                if artist_id in artist_genres_cache:
-                    genre_list.extend(artist_genres_cache[artist_id])
+                for artist_id in artist_ids:
+                    genre_list.extend(artist_genres_cache.get(artist_id, []))
 
-            return genre_list
+                return genre_list
 
-        track_stats['artist_genres'] = GetGenreList(clicked_track_artist_ids)
-        # Use a set to store track IDs that have already matched a genre to avoid double-counting
-        songs_matching_genre = []
-        songs_by_same_artists = {}
+            track_stats['artist_genres'] = GetGenreList(clicked_track_artist_ids)
 
-        total_plays_by_same_artists = 0
-        for stored_track_id, cur_stored_track in stored_tracks.items():
-            # don't count the song that was clicked on
-            if stored_track_id == track_id:
-                continue
-
-            # Same artist count
-            cur_stored_track_artist_ids = {a['id'] for a in cur_stored_track['artists']} # Extract IDs
+            # everything below is looked up from the artist/genre indexes, don't count the song that was clicked on
+            songs_by_same_artists = {}
+            total_plays_by_same_artists = 0
             for aid in clicked_track_artist_ids:
-                if aid in cur_stored_track_artist_ids:
-                    songs_by_same_artists.setdefault(aid, []).append(cur_stored_track)
-                    total_plays_by_same_artists += context_track_info.track_freq[stored_track_id]
-            
-            # Genre matching count
-            cur_song_artist_genres = set(GetGenreList(cur_stored_track_artist_ids))
-            if set(track_stats['artist_genres']).intersection(cur_song_artist_genres):
-                songs_matching_genre.append(cur_stored_track)
-
-        track_stats['songs_by_same_artists'] = songs_by_same_artists
-        track_stats['total_plays_by_same_artists'] = total_plays_by_same_artists
-        
-        # Add actual tracks for songs_matching_genre
-        track_stats['songs_matching_genre'] = songs_matching_genre
-        track_stats['shuffle_ids'] = context_track_info.track_trie.getShuffleIDs(track_id)
+                same_artist_tracks = [stored_tracks[tid] for tid in artist_genre_index.get_tracks_by_artist(aid) if tid != track_id]
+                if same_artist_tracks:
+                    songs_by_same_artists[aid] = same_artist_tracks
+                total_plays_by_same_artists += context_track_info.artist_plays.get(aid, 0) - track_stats['frequency']
 
-        try:
-            unique_patterns = {}
-            patterns = context_track_info.track_trie.getAllPatterns(track_stats['shuffle_ids'])
-            for pattern_track_ids in patterns:
-                if not pattern_track_ids or len(pattern_track_ids) < 2:
-                    continue
+            songs_matching_genre = [stored_tracks[tid] for tid in artist_genre_index.get_tracks_by_genres(track_stats['artist_genres']) if tid != track_id]
+
+            track_stats['songs_by_same_artists'] = songs_by_same_artists
+            track_stats['total_plays_by_same_artists'] = total_plays_by_same_artists
+        
+            # Add actual tracks for songs_matching_genre
+            track_stats['songs_matching_genre'] = songs_matching_genre
+            # streaming mode doesn't keep the shuffles, only the pairs of tracks that keep coming up together
+            streaming = context_track_info.streaming
+            track_stats['shuffle_ids'] = [] if streaming else context_track_info.track_trie.getShuffleIDs(track_id)
+
+            try:
+                unique_patterns = {}
+                with operation_seconds.time('getAllPatterns'):
+                    if streaming:
+                        patterns = list(context_track_info.track_trie.findAllPatterns(track_id).values())
+                    else:
+                        patterns = context_track_info.track_trie.getAllPatterns(track_stats['shuffle_ids'])
+                for pattern_track_ids in patterns:
+                    if not pattern_track_ids or len(pattern_track_ids) < 2:
+                        continue
                 
-                pattern_tuple = tuple(t_id for t_id in pattern_track_ids)
+                    pattern_tuple = tuple(t_id for t_id in pattern_track_ids)
 
-                if pattern_tuple not in unique_patterns:
-                    cur_pattern = []
-                    for track_id in pattern_track_ids:
-                        cur_pattern.append({"id": track_id, "name": stored_tracks[track_id]['name']})
+                    if pattern_tuple not in unique_patterns:
+                        cur_pattern = []
+                        for track_id in pattern_track_ids:
+                            cur_pattern.append({"id": track_id, "name": stored_tracks[track_id]['name']})
 
-                        unique_patterns[pattern_tuple] = {
-                            'count': 0,
-                            'pattern': cur_pattern
-                        }
+                            unique_patterns[pattern_tuple] = {
+                                'count': 0,
+                                'pattern': cur_pattern
+                            }
                         
-                unique_patterns[pattern_tuple]['count'] += 1   
+                    unique_patterns[pattern_tuple]['count'] += 1   
  
-            # Filter out empty patterns for a cleaner response
-            track_stats['patterns'] = list(unique_patterns.values())
+                # Filter out empty patterns for a cleaner response
+                track_stats['patterns'] = list(unique_patterns.values())
+
+            except KeyError:
+                # If the track_id isn't in the trie, it means no patterns were recorded for it
+                track_stats['patterns'] = []
+            except Exception as e:
+                # Log any other errors during pattern finding but don't fail the whole request
+                print(f"Error finding patterns for track {track_id}: {e}")
+                track_stats['patterns'] = [] # Send empty patterns on error
+        
+            return track_stats
 
-        except KeyError:
-            # If the track_id isn't in the trie, it means no patterns were recorded for it
-            track_stats['patterns'] = []
+        except spotipy.exceptions.SpotifyException as e:
+            if e.http_status == 401:
+                return jsonify({"status": "error", "error": "Token expired, please log in again"}), 401
+            return jsonify({"status": "error", "error": f"Spotify API error: {str(e)}"}), 500
         except Exception as e:
-            # Log any other errors during pattern finding but don't fail the whole request
-            print(f"Error finding patterns for track {track_id}: {e}")
-            track_stats['patterns'] = [] # Send empty patterns on error
+            return jsonify({"status": "error", "error": f"An unexpected error occurred: {str(e)}"}), 500
+
+@app.route('/shuffle_order/<int:shuffle_id>/<string:track_id>')
+def get_shuffle_order_route(shuffle_id, track_id):
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    user_data = get_user_data()
+    with user_data.lock:
+        context_track_info = user_data.get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        key = ('shuffle_order', user_data.user_id, context_track_info.context_id, context_track_info.version, shuffle_id, track_id)
+        return versioned_json_response(key, lambda: get_shuffle_order(context_track_info, shuffle_id, track_id))
+
+def get_shuffle_order(context_track_info, shuffle_id, track_id):
+    user_data = context_track_info.user_data
+    with user_data.lock:
+        try:
+            selected_track_full_shuffle = context_track_info.track_trie.getShuffleQueue(shuffle_id, track_id)
+            if not selected_track_full_shuffle:
+                return jsonify({"status": "error", "error": f"Shuffle ID {shuffle_id} not found."}), 404
         
-        return jsonify(track_stats)
+            # Convert track IDs to track objects with names and artists for frontend display
+            formatted_shuffle_order = []
+            for track_id in selected_track_full_shuffle:
+                track_info = user_data.stored_tracks.get(track_id)
+                formatted_shuffle_order.append({
+                    "id": track_id,
+                    "name": track_info.get('name', 'Unknown Track'),
+                    "artists": track_info.get('artists', [])
+                })
+
+            return {"status": "success", "shuffle_order": formatted_shuffle_order}
+
+        except Exception as e:
+            print(f"Error fetching shuffle order for ID {shuffle_id}: {e}")
+            return jsonify({"status": "error", "error": f"Failed to retrieve shuffle order: {str(e)}"}), 500
+
+# Many shuffle orders for one track in a single request, ?shuffle_ids=1,2,3 to pick which ones (all by default),
+# ?window=N for only N tracks either side of the track, and ?offset= / ?limit= to page through long histories
+@app.route('/shuffle_orders/<string:track_id>')
+def get_shuffle_orders_route(track_id):
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    shuffle_ids = request.args.get('shuffle_ids', type=str)
+    try:
+        shuffle_ids = tuple(int(shuffle_id) for shuffle_id in shuffle_ids.split(',') if shuffle_id) if shuffle_ids else None
+    except ValueError:
+        return jsonify({"status": "error", "error": "shuffle_ids must be a comma separated list of shuffle IDs."}), 400
+
+    window = request.args.get('window', type=int)
+    if window is not None:
+        window = max(0, window)
+    offset = max(0, request.args.get('offset', type=int, default=0))
+    limit = min(MAX_SHUFFLE_ORDERS_PER_PAGE, max(1, request.args.get('limit', type=int, default=MAX_SHUFFLE_ORDERS_PER_PAGE)))
+
+    user_data = get_user_data()
+    with user_data.lock:
+        context_track_info = user_data.get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        key = ('shuffle_orders', user_data.user_id, context_track_info.context_id, context_track_info.version, track_id, shuffle_ids, window, offset, limit)
+        return versioned_json_response(key, lambda: get_shuffle_orders(context_track_info, track_id, shuffle_ids, window, offset, limit))
+
+def get_shuffle_orders(context_track_info, track_id, shuffle_ids, window, offset, limit):
+    track_trie = context_track_info.track_trie
+    occurrences = track_trie.getTrackOccurrences(track_id, shuffle_ids)
+    if not occurrences:
+        return jsonify({"status": "error", "error": "Track not found in any of the shuffles."}), 404
+
+    # only the requested page gets read out of the trie
+    orders = [track_trie.getShuffleOrder(slot, occurrence, window) for slot, occurrence in occurrences[offset:offset + limit]]
+
+    # every track is described once, the orders themselves are just IDs
+    order_track_ids = dict.fromkeys(tid for _, _, _, order in orders for tid in order)
+    return {
+        "status": "success",
+        "track_id": track_id,
+        "total_shuffles": len(occurrences),
+        "offset": offset,
+        "limit": limit,
+        "has_more": offset + limit < len(occurrences),
+        "tracks": {tid: context_track_info.user_data.format_track_summary(tid) for tid in order_track_ids},
+        "shuffle_orders": [
+            {"shuffle_id": shuffle_id, "position": position, "window_start": window_start, "track_ids": order}
+            for shuffle_id, position, window_start, order in orders
+        ]
+    }
+
+# Shuffle orders and the stats built from them need every shuffle, which streaming mode doesn't keep
+def streaming_not_supported():
+    return jsonify({"status": "error", "error": "This context is in streaming mode, its individual shuffles aren't kept."}), 409
+
+def get_context_matrix(context_track_info):
+    with context_track_info.user_data.lock, operation_seconds.time('build_shuffle_matrix'):
+        return shuffleStats.build_shuffle_matrix(context_track_info.track_trie)
+
+@app.route('/shuffle_stats/uniformity')
+def shuffle_uniformity_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    try:
+        context_track_info = get_user_data().get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        matrix = get_context_matrix(context_track_info)
+        stats = shuffleStats.frequency_uniformity(matrix, context_track_info.context_info.get('total_tracks'))
+        return jsonify({"status": "success", "uniformity": stats})
 
-    except spotipy.exceptions.SpotifyException as e:
-        if e.http_status == 401:
-            return jsonify({"status": "error", "error": "Token expired, please log in again"}), 401
-        return jsonify({"status": "error", "error": f"Spotify API error: {str(e)}"}), 500
     except Exception as e:
-        return jsonify({"status": "error", "error": f"An unexpected error occurred: {str(e)}"}), 500
+        print(f"Error computing frequency uniformity: {e}")
+        return jsonify({"status": "error", "error": f"Failed to compute uniformity: {str(e)}"}), 500
 
-@app.route('/shuffle_order/<int:shuffle_id>/<string:track_id>')
-def get_shuffle_order_route(shuffle_id, track_id):
+@app.route('/shuffle_stats/position_bias')
+def position_bias_route():
     token_info = session.get('token_info')
     if not token_info:
         return jsonify({"status": "error", "error": "Not logged in"}), 401
 
+    limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
+
     try:
-        context_track_info = TracksInContext.get_current_context()
+        context_track_info = get_user_data().get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        track_trie = context_track_info.track_trie
+        matrix = get_context_matrix(context_track_info)
+        counts, ratio, track_chi_square, summary = shuffleStats.position_bias(matrix, len(track_trie.trackIDs))
+
+        # most position-biased tracks first
+        heatmap = []
+        for index in np.argsort(-track_chi_square)[:limit]:
+            track = context_track_info.user_data.format_track_summary(track_trie.trackIDs[index])
+            track['position_counts'] = counts[index].astype(int).tolist()
+            track['position_ratio'] = ratio[index].round(3).tolist()
+            track['chi_square'] = float(track_chi_square[index])
+            heatmap.append(track)
+
+        return jsonify({"status": "success", "position_bias": summary, "heatmap": heatmap})
 
-        selected_track_full_shuffle = context_track_info.track_trie.getShuffleQueue(shuffle_id, track_id)
-        if not selected_track_full_shuffle:
-            return jsonify({"status": "error", "error": f"Shuffle ID {shuffle_id} not found."}), 404
-        
-        # Convert track IDs to track objects with names and artists for frontend display
-        formatted_shuffle_order = []
-        for track_id in selected_track_full_shuffle:
-            track_info = stored_tracks.get(track_id)
-            formatted_shuffle_order.append({
-                "id": track_id,
-                "name": track_info.get('name', 'Unknown Track'),
-                "artists": track_info.get('artists', [])
+    except Exception as e:
+        print(f"Error computing position bias: {e}")
+        return jsonify({"status": "error", "error": f"Failed to compute position bias: {str(e)}"}), 500
+
+@app.route('/shuffle_stats/adjacency')
+def adjacency_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
+    min_count = request.args.get('min_count', type=int, default=2)
+
+    try:
+        context_track_info = get_user_data().get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        track_trie = context_track_info.track_trie
+        matrix = get_context_matrix(context_track_info)
+        first, second, counts, expected = shuffleStats.adjacency_overrepresentation(
+            matrix, context_track_info.context_info.get('total_tracks'), min_count)
+
+        pairs = []
+        for index in np.argsort(-counts, kind='stable')[:limit]:
+            pairs.append({
+                'first': context_track_info.user_data.format_track_summary(track_trie.trackIDs[first[index]]),
+                'second': context_track_info.user_data.format_track_summary(track_trie.trackIDs[second[index]]),
+                'count': int(counts[index]),
+                'expected': expected,
+                'ratio': float(counts[index] / expected) if expected else 0.0
             })
 
-        return jsonify({"status": "success", "shuffle_order": formatted_shuffle_order})
+        return jsonify({"status": "success", "expected_per_pair": expected, "pairs": pairs})
 
     except Exception as e:
-        print(f"Error fetching shuffle order for ID {shuffle_id}: {e}")
-        return jsonify({"status": "error", "error": f"Failed to retrieve shuffle order: {str(e)}"}), 500
+        print(f"Error computing adjacency: {e}")
+        return jsonify({"status": "error", "error": f"Failed to compute adjacency: {str(e)}"}), 500
+
+@app.route('/shuffle_stats/artist_clustering')
+def artist_clustering_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
+
+    try:
+        context_track_info = get_user_data().get_current_context()
+        if context_track_info.streaming:
+            return streaming_not_supported()
+        track_trie = context_track_info.track_trie
+        matrix = get_context_matrix(context_track_info)
+
+        # intern each track's primary artist so the matrix can be mapped onto artists
+        artist_indexes = {}
+        artist_names = []
+        track_artists = np.full(len(track_trie.trackIDs), -1, dtype=np.int64)
+        for index, track_id in enumerate(track_trie.trackIDs):
+            artists = context_track_info.user_data.stored_tracks.get(track_id, {}).get('artists', [])
+            if artists:
+                if artists[0]['id'] not in artist_indexes:
+                    artist_indexes[artists[0]['id']] = len(artist_names)
+                    artist_names.append(artists[0])
+                track_artists[index] = artist_indexes[artists[0]['id']]
+
+        same_artist_counts, summary = shuffleStats.artist_clustering(matrix, track_artists)
+
+        clustered_artists = [
+            {"id": artist_names[index]['id'], "name": artist_names[index]['name'], "same_artist_neighbours": int(same_artist_counts[index])}
+            for index in np.argsort(-same_artist_counts, kind='stable')[:limit] if same_artist_counts[index] > 0
+        ]
+
+        return jsonify({"status": "success", "artist_clustering": summary, "artists": clustered_artists})
+
+    except Exception as e:
+        print(f"Error computing artist clustering: {e}")
+        return jsonify({"status": "error", "error": f"Failed to compute artist clustering: {str(e)}"}), 500
+
+# Compares ?context_id=...&context_id=... (by default every context with shuffles) side by side: each one's plays of the
+# most played tracks lined up on the same tracks, how much each pair overlaps and diverges, and the patterns they share
+@app.route('/compare')
+def compare_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
+    pattern_limit = request.args.get('pattern_limit', type=int, default=MAX_SHARED_PATTERNS)
+    # contexts without an ID are asked for with an empty context_id
+    context_ids = [context_id or None for context_id in request.args.getlist('context_id')]
+
+    user_data = get_user_data()
+    with user_data.lock:
+        if context_ids:
+            missing = [context_id for context_id in context_ids if context_id not in user_data.contexts]
+            if missing:
+                return jsonify({"status": "error", "error": f"Unknown context: {missing[0]}"}), 404
+            contexts = [user_data.get_context(context_id) for context_id in dict.fromkeys(context_ids)]
+        else:
+            contexts = [user_data.get_context(context_id) for context_id in list(user_data.contexts)]
+            contexts = [context for context in contexts if context.num_shuffles > 0]
+
+        if len(contexts) < 2:
+            return jsonify({"status": "error", "error": "Need at least two contexts with shuffles to compare."}), 400
+
+        key = ('compare', user_data.user_id, tuple((context.context_id, context.version) for context in contexts),
+               user_data.data_version, limit, pattern_limit)
+        return versioned_json_response(key, lambda: get_comparison(user_data, contexts, limit, pattern_limit))
+
+def get_comparison(user_data, contexts, limit, pattern_limit):
+    with user_data.lock:
+        aggregates = [context.get_aggregate() for context in contexts]
+        counts = np.zeros((len(contexts), len(user_data.numbered_track_ids)), dtype=np.int64)
+        for row, aggregate in zip(counts, aggregates):
+            row[aggregate['track_numbers']] = aggregate['counts']
+
+        shares, overlap = shuffleStats.compare_frequencies(counts)
+        for pair in overlap['pairs']:
+            pair['first'] = contexts[pair['first']].context_id
+            pair['second'] = contexts[pair['second']].context_id
+
+        # most played first, by share of each context's plays so a bigger context doesn't drown out the rest
+        top = np.argsort(-shares.sum(axis=0), kind='stable')[:limit]
+        top = top[counts[:, top].sum(axis=0) > 0]
+
+        pattern_contexts = {}
+        for context, aggregate in zip(contexts, aggregates):
+            for pattern in aggregate['patterns']:
+                pattern_contexts.setdefault(pattern, []).append(context.context_id)
+        shared_patterns = sorted((pattern for pattern, context_ids in pattern_contexts.items() if len(context_ids) > 1),
+                                 key=lambda pattern: (-len(pattern_contexts[pattern]), -len(pattern)))[:pattern_limit]
+
+        return {
+            "status": "success",
+            "contexts": [{
+                "context_id": context.context_id,
+                "name": context.context_info.get('name', 'Unknown Context'),
+                "type": context.context_info.get('type', 'Unknown'),
+                "num_shuffles": context.num_shuffles,
+                "total_plays": context.track_ranking.total_plays,
+                "unique_tracks": len(context.track_ranking)
+            } for context in contexts],
+            "tracks": [user_data.format_track_summary(user_data.numbered_track_ids[number]) for number in top],
+            # one row per context, lined up with tracks
+            "frequencies": counts[:, top].tolist(),
+            "shares": shares[:, top].round(5).tolist(),
+            "overlap": overlap,
+            "shared_patterns": [{"track_ids": list(pattern), "contexts": pattern_contexts[pattern]} for pattern in shared_patterns]
+        }
+
+# Every track the user has collected ranked by its plays across all of their contexts, paged like /queue_data
+@app.route('/master/tracks')
+def master_tracks_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    limit = request.args.get('limit', type=int, default=MAX_TRACKS_TO_SEND)
+    offset = request.args.get('offset', type=int, default=0)
+    search_query = request.args.get('search', type=str, default="")
+
+    user_data = get_user_data()
+    with user_data.lock:
+        user_data.load_all_contexts()
+        key = ('master_tracks', user_data.user_id, user_data.master_version, user_data.data_version, offset, limit, search_query)
+        return versioned_json_response(key, lambda: get_master_tracks(user_data, offset, limit, search_query))
+
+def get_master_tracks(user_data, offset, limit, search_query):
+    with user_data.lock:
+        master_index = user_data.master_index
+        ranked_tracks, total_unique_tracks, total_plays_counted = rank_tracks(master_index.track_ranking, user_data, offset, limit, search_query)
+        for track in ranked_tracks:
+            track['num_contexts'] = len(master_index.get_contexts(track['id']))
+            track['num_pattern_contexts'] = len(master_index.get_pattern_contexts(track['id']))
+
+        return {
+            "status": "success",
+            "tracks": ranked_tracks,
+            "total_unique_tracks": total_unique_tracks,
+            "total_plays_counted": total_plays_counted,
+            "has_more": (offset + limit) < total_unique_tracks
+        }
+
+# How often one track came up in each of the user's contexts, and the patterns it's part of in each
+@app.route('/master/track/<string:track_id>')
+def master_track_route(track_id):
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    user_data = get_user_data()
+    with user_data.lock:
+        user_data.load_all_contexts()
+        if track_id not in user_data.master_index.track_ranking:
+            return jsonify({"status": "error", "error": "Track not found."}), 404
+
+        key = ('master_track', user_data.user_id, user_data.master_version, user_data.contexts_version, track_id)
+        return versioned_json_response(key, lambda: get_master_track(user_data, track_id))
+
+# The distinct patterns in the context the track is part of. A shuffle's pattern is the run it shares with
+# another shuffle, which needn't be the part of it the track is in
+def get_track_patterns(context, track_id):
+    patterns = context.track_trie.findAllPatterns(track_id).values()
+    return [list(pattern) for pattern in dict.fromkeys(tuple(pattern) for pattern in patterns if track_id in pattern)]
+
+def get_master_track(user_data, track_id):
+    with user_data.lock:
+        master_index = user_data.master_index
+        pattern_contexts = master_index.get_pattern_contexts(track_id)
+
+        contexts = []
+        for context_id in master_index.get_contexts(track_id):
+            context = user_data.contexts[context_id]
+            frequency = context.track_ranking.get_frequency(track_id)
+            total_plays = context.track_ranking.total_plays
+            contexts.append({
+                "context_id": context_id,
+                "name": context.context_info.get('name', 'Unknown Context'),
+                "type": context.context_info.get('type', 'Unknown'),
+                "frequency": frequency,
+                "share_of_plays": frequency / total_plays if total_plays else 0.0,
+                "num_shuffles": context.num_shuffles,
+                "patterns": get_track_patterns(context, track_id) if context_id in pattern_contexts else []
+            })
+        contexts.sort(key=lambda entry: entry['frequency'], reverse=True)
+
+        return {
+            "status": "success",
+            "track": user_data.format_track_summary(track_id),
+            "total_frequency": master_index.track_ranking.get_frequency(track_id),
+            "contexts": contexts
+        }
+
+# POST ?enabled=1 puts a context (?context_id=..., the current one by default) in streaming mode, which keeps fixed size
+# sketches instead of every shuffle. ?epsilon=, ?delta=, ?distinct_error= and ?top_k= set its error bounds,
+# ?enabled=0 goes back to exact counts. Either way the context is rebuilt from its stored shuffles
+@app.route('/streaming_mode', methods=['POST'])
+def streaming_mode_route():
+    token_info = session.get('token_info')
+    if not token_info:
+        return jsonify({"status": "error", "error": "Not logged in"}), 401
+
+    context_id = request.args.get('context_id', type=str) or session.get('current_context_id')
+    settings = None
+    if request.args.get('enabled', type=int, default=1):
+        try:
+            settings = get_sketch_settings(request.args)
+        except ValueError as e:
+            return jsonify({"status": "error", "error": f"Invalid sketch settings: {str(e)}"}), 400
+
+    user_data = get_user_data()
+    with user_data.lock:
+        context = user_data.contexts.get(context_id)
+        if context is None:
+            return jsonify({"status": "error", "error": f"Unknown context: {context_id}"}), 404
+
+        context.set_streaming(settings)
+        context = user_data.get_context(context_id)
+        return jsonify({"status": "success", "context_id": context_id, "streaming": context.get_streaming_status()})
+
+def has_metrics_access():
+    if not METRICS_TOKEN:
+        return request.remote_addr in LOOPBACK_ADDRESSES
+    return secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+
+# Prometheus text format, for this worker process only
+@app.route('/metrics')
+def metrics_route():
+    if not has_metrics_access():
+        return jsonify({"status": "error", "error": "Not allowed"}), 403
+    return Response(appMetrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+# POST ?enabled=1 starts the sampling profiler (?enabled=0 stops it, ?reset=1 drops what it collected so far),
+# GET gives back what it collected as folded stacks, ready for a flamegraph
+@app.route('/metrics/profiler', methods=['GET', 'POST'])
+def profiler_route():
+    if not has_metrics_access():
+        return jsonify({"status": "error", "error": "Not allowed"}), 403
+
+    profiler = appMetrics.profiler
+    if request.method == 'GET':
+        return Response(profiler.get_folded(), mimetype='text/plain')
+
+    if request.args.get('reset', type=int, default=0):
+        profiler.reset()
+    enabled = request.args.get('enabled', type=int)
+    if enabled == 1:
+        profiler.start()
+    elif enabled == 0:
+        profiler.stop()
+    return jsonify({"status": "success", "profiler": profiler.get_status()})
 
 if __name__ == '__main__':
     import os
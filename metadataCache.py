@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Bounded LRU cache where every entry also expires, with an optional on-disk tier in the ShuffleStore.
+# Empty results (an artist with no genres) are cached too, just for less time.
+class MetadataCache:
+    def __init__(self, namespace, max_entries, ttl, negative_ttl=None, store=None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl if negative_ttl is not None else ttl
+        self.store = store
+
+        # key -> (expires_at, value), oldest used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    return True, entry[1]
+                del self.entries[key]
+
+        if self.store is None:
+            return False, None
+
+        # fall back to disk, a hit gets promoted back into memory
+        entry = self.store.load_metadata(self.namespace, key)
+        if entry is None or entry[0] <= now:
+            return False, None
+
+        self.remember(key, entry[0], entry[1])
+        return True, entry[1]
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def __contains__(self, key):
+        return self.lookup(key)[0]
+
+    def set(self, key, value):
+        expires_at = time.time() + (self.ttl if value else self.negative_ttl)
+        self.remember(key, expires_at, value)
+        if self.store is not None:
+            self.store.save_metadata(self.namespace, key, value, expires_at)
+
+    def remember(self, key, expires_at, value):
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_fetch(self, key, fetch):
+        found, value = self.lookup(key)
+        if not found:
+            value = fetch()
+            self.set(key, value)
+        return value
+
+    def warm(self):
+        # pull whatever is still fresh on disk into memory, newest last so they're the last to be evicted
+        if self.store is None:
+            return []
+
+        now = time.time()
+        entries = [(key, expires_at, value) for key, expires_at, value in self.store.load_all_metadata(self.namespace) if expires_at > now]
+        for key, expires_at, value in entries[-self.max_entries:]:
+            self.remember(key, expires_at, value)
+        return entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.store is not None:
+            self.store.clear_metadata(self.namespace)
+
+    def __len__(self):
+        return len(self.entries)
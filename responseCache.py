@@ -0,0 +1,48 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Serialized JSON bodies keyed by (endpoint, context, version, params), bounded by count and total size.
+# Keys carry the version they were built from, so nothing ever needs invalidating, old versions just age out.
+class ResponseCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_etag(key):
+        return hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            old_body = self.entries.pop(key, None)
+            if old_body is not None:
+                self.total_bytes -= len(old_body)
+
+            self.entries[key] = body
+            self.total_bytes += len(body)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
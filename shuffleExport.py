@@ -0,0 +1,361 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import zipfile
+from shuffleStore import ShuffleStore, BATCH_SIZE, UNOWNED_USER_ID
+
+# parquet is optional, NDJSON works without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FORMAT_VERSION = 2
+# export record type -> parquet table it goes in
+RECORD_TABLES = {'context': 'contexts', 'frequency': 'frequencies', 'track': 'tracks', 'shuffle': 'shuffles'}
+
+def has_parquet_support():
+    return pa is not None
+
+def require_parquet_support():
+    if pa is None:
+        raise RuntimeError("Parquet export and import need pyarrow, install it with: pip install pyarrow")
+
+def get_context_ids(store, user_id, context_ids=None):
+    contexts = store.load_contexts(user_id)
+    if context_ids is not None:
+        contexts = {context_id: contexts[context_id] for context_id in context_ids if context_id in contexts}
+    return contexts
+
+# Everything one user's export holds, as one stream of typed records. Tracks are limited to the ones the
+# exported contexts actually played, and frequencies are counted by the store, not from memory.
+def iter_export_records(store, user_id, context_ids=None):
+    contexts = get_context_ids(store, user_id, context_ids)
+    yield {'type': 'export', 'version': EXPORT_FORMAT_VERSION, 'exported_at': time.time(), 'export_id': store.get_store_id()}
+
+    for context_id, context_info in contexts.items():
+        yield {'type': 'context', 'context_id': context_id, 'info': context_info}
+
+    played_track_ids = set()
+    for context_id in contexts:
+        for track_id, frequency in store.count_track_plays(user_id, context_id):
+            played_track_ids.add(track_id)
+            yield {'type': 'frequency', 'context_id': context_id, 'track_id': track_id, 'frequency': frequency}
+
+    for track in store.iter_tracks():
+        if track['id'] in played_track_ids:
+            yield {'type': 'track', 'track': track}
+
+    # the origin only differs from export_id and shuffle_id for shuffles this store imported itself
+    for context_id in contexts:
+        for shuffle_id, track_ids, source, source_shuffle_id in store.iter_shuffles_with_origins(user_id, context_id):
+            yield {'type': 'shuffle', 'context_id': context_id, 'shuffle_id': shuffle_id, 'track_ids': track_ids,
+                   'source': source, 'source_shuffle_id': source_shuffle_id}
+
+def export_ndjson(store, user_id, context_ids=None):
+    for record in iter_export_records(store, user_id, context_ids):
+        yield json.dumps(record) + "\n"
+
+def get_parquet_schemas():
+    return {
+        'contexts': pa.schema([
+            ('context_id', pa.string()),
+            ('type', pa.string()),
+            ('name', pa.string()),
+            ('info', pa.string())
+        ]),
+        'frequencies': pa.schema([
+            ('context_id', pa.string()),
+            ('track_id', pa.string()),
+            ('frequency', pa.int64())
+        ]),
+        'tracks': pa.schema([
+            ('track_id', pa.string()),
+            ('name', pa.string()),
+            ('artist_ids', pa.list_(pa.string())),
+            ('artist_names', pa.list_(pa.string())),
+            ('album_name', pa.string()),
+            ('duration_ms', pa.int64()),
+            ('popularity', pa.int64()),
+            ('data', pa.string()) # the full spotify object, so an import gets back exactly what was stored
+        ]),
+        'shuffles': pa.schema([
+            ('context_id', pa.string()),
+            ('shuffle_id', pa.int64()),
+            ('track_ids', pa.list_(pa.string())),
+            ('source', pa.string()),
+            ('source_shuffle_id', pa.int64())
+        ])
+    }
+
+def to_parquet_row(record):
+    record_type = record['type']
+    if record_type == 'context':
+        info = record['info']
+        return {'context_id': record['context_id'], 'type': info.get('type'), 'name': info.get('name'), 'info': json.dumps(info)}
+    if record_type == 'track':
+        track = record['track']
+        return {
+            'track_id': track['id'],
+            'name': track.get('name'),
+            'artist_ids': [artist['id'] for artist in track.get('artists', [])],
+            'artist_names': [artist['name'] for artist in track.get('artists', [])],
+            'album_name': (track.get('album') or {}).get('name'),
+            'duration_ms': track.get('duration_ms'),
+            'popularity': track.get('popularity'),
+            'data': json.dumps(track)
+        }
+    return {key: value for key, value in record.items() if key != 'type'}
+
+# One parquet file per table in directory, written a row group at a time
+def export_parquet(store, user_id, directory, context_ids=None):
+    require_parquet_support()
+    schemas = get_parquet_schemas()
+    os.makedirs(directory, exist_ok=True)
+
+    writers = {}
+    batches = {table: [] for table in schemas}
+
+    def flush(table):
+        if batches[table]:
+            writers[table].write_batch(pa.RecordBatch.from_pylist(batches[table], schema=schemas[table]))
+            batches[table] = []
+
+    try:
+        for table, schema in schemas.items():
+            writers[table] = pq.ParquetWriter(os.path.join(directory, f"{table}.parquet"), schema)
+
+        # records come out grouped by type, so only one table's batch is ever filling up
+        for record in iter_export_records(store, user_id, context_ids):
+            table = RECORD_TABLES.get(record['type'])
+            if table is None:
+                continue
+            batches[table].append(to_parquet_row(record))
+            if len(batches[table]) >= BATCH_SIZE:
+                flush(table)
+
+        for table in schemas:
+            flush(table)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return [os.path.join(directory, f"{table}.parquet") for table in schemas]
+
+def export_parquet_zip(store, user_id, fileobj, directory, context_ids=None):
+    # parquet is already compressed, the zip is just to hand the tables over as one file
+    paths = export_parquet(store, user_id, directory, context_ids)
+    with zipfile.ZipFile(fileobj, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path in paths:
+            archive.write(path, os.path.basename(path))
+
+# Merges exported records into a user's data. Shuffles get the next free IDs in their context and ones
+# whose origin (source store and shuffle ID there) is already there are skipped, so the same export can be
+# imported twice and several machines' exports can be combined. Shuffles from exports without origins
+# (format version 1) are always added. Frequencies aren't imported, they come from the shuffles.
+class ShuffleImporter:
+    def __init__(self, store, user_id):
+        self.store = store
+        self.user_id = user_id
+        self.pending_tracks = []
+        self.pending_shuffles = {}
+        # context ID -> origins of the shuffles already stored
+        self.contexts = {}
+        # the store the export came from, older exports don't say
+        self.export_id = None
+        self.stats = {'contexts': 0, 'tracks': 0, 'shuffles': 0, 'duplicate_shuffles': 0}
+
+    def get_context_state(self, context_id):
+        state = self.contexts.get(context_id)
+        if state is None:
+            state = self.contexts[context_id] = self.store.load_shuffle_origins(self.user_id, context_id)
+        return state
+
+    def add_record(self, record):
+        record_type = record.get('type')
+        if record_type == 'export':
+            self.export_id = record.get('export_id')
+        elif record_type == 'context':
+            self.store.add_context_info(self.user_id, record['context_id'], record.get('info') or {})
+            self.stats['contexts'] += 1
+        elif record_type == 'track':
+            self.pending_tracks.append(record['track'])
+            if len(self.pending_tracks) >= BATCH_SIZE:
+                self.flush_tracks()
+        elif record_type == 'shuffle':
+            source = record.get('source') or self.export_id
+            source_shuffle_id = record.get('source_shuffle_id')
+            if source_shuffle_id is None:
+                source_shuffle_id = record.get('shuffle_id')
+            self.add_shuffle(record['context_id'], record['track_ids'], source, source_shuffle_id)
+
+    def add_shuffle(self, context_id, track_ids, source=None, source_shuffle_id=None):
+        if source is None or source_shuffle_id is None:
+            # nothing to tell it apart by, it becomes a shuffle of this store's
+            source = source_shuffle_id = None
+        else:
+            state = self.get_context_state(context_id)
+            if (source, source_shuffle_id) in state:
+                self.stats['duplicate_shuffles'] += 1
+                return
+            state.add((source, source_shuffle_id))
+
+        # IDs are handed out by the store as each batch is written
+        pending = self.pending_shuffles.setdefault(context_id, [])
+        pending.append((track_ids, source, source_shuffle_id))
+        self.stats['shuffles'] += 1
+
+        if len(pending) >= BATCH_SIZE:
+            self.flush_shuffles(context_id)
+
+    def flush_tracks(self):
+        if self.pending_tracks:
+            self.store.save_tracks(self.pending_tracks)
+            self.stats['tracks'] += len(self.pending_tracks)
+            self.pending_tracks = []
+
+    def flush_shuffles(self, context_id):
+        shuffles = self.pending_shuffles.pop(context_id, None)
+        if shuffles:
+            self.store.append_shuffles(self.user_id, context_id, shuffles)
+
+    def flush(self):
+        # tracks first so nothing refers to a track that isn't stored yet
+        self.flush_tracks()
+        for context_id in list(self.pending_shuffles):
+            self.flush_shuffles(context_id)
+
+    def finish(self):
+        self.flush()
+        # every process with the user's data loaded starts over from the store
+        self.store.touch_user(self.user_id, reload=True)
+        return self.stats
+
+# ValueError naming the record if it isn't one add_record can take, records of unknown types are ignored
+def check_record(record, position):
+    if not isinstance(record, dict):
+        raise ValueError(f"record {position} isn't an object")
+
+    record_type = record.get('type')
+    if record_type == 'context':
+        valid = 'context_id' in record and isinstance(record.get('info') or {}, dict)
+    elif record_type == 'track':
+        track = record.get('track')
+        valid = isinstance(track, dict) and isinstance(track.get('id'), str)
+    elif record_type == 'shuffle':
+        track_ids = record.get('track_ids')
+        valid = ('context_id' in record and isinstance(track_ids, list) and
+                 all(track_id is None or isinstance(track_id, str) for track_id in track_ids))
+    else:
+        valid = True
+    if not valid:
+        raise ValueError(f"record {position} is not a valid {record_type} record")
+
+# Imports the records iter_records() hands out. The whole file is read through and checked first, so a bad
+# record anywhere leaves the user's data as it was instead of half imported. Anything written before a
+# failure after that (the store itself erroring) is still made visible to every process
+def run_import(store, user_id, iter_records):
+    for position, record in enumerate(iter_records(), 1):
+        check_record(record, position)
+
+    importer = ShuffleImporter(store, user_id)
+    try:
+        for record in iter_records():
+            importer.add_record(record)
+        importer.flush()
+    finally:
+        store.touch_user(user_id, reload=True)
+    return importer.stats
+
+# lines has to be readable twice, a list or a file that can seek back to the start
+def import_ndjson(store, user_id, lines):
+    def iter_records():
+        if hasattr(lines, 'seek'):
+            lines.seek(0)
+        for line_number, line in enumerate(lines, 1):
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"line {line_number} isn't valid JSON: {e}")
+
+    return run_import(store, user_id, iter_records)
+
+def iter_parquet_rows(path):
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=BATCH_SIZE):
+        yield from batch.to_pylist()
+
+def import_parquet(store, user_id, directory):
+    require_parquet_support()
+
+    def table_path(table):
+        path = os.path.join(directory, f"{table}.parquet")
+        return path if os.path.exists(path) else None
+
+    def iter_records():
+        if table_path('contexts'):
+            for row in iter_parquet_rows(table_path('contexts')):
+                yield {'type': 'context', 'context_id': row['context_id'], 'info': json.loads(row['info'])}
+        if table_path('tracks'):
+            for row in iter_parquet_rows(table_path('tracks')):
+                yield {'type': 'track', 'track': json.loads(row['data'])}
+        if table_path('shuffles'):
+            for row in iter_parquet_rows(table_path('shuffles')):
+                yield {'type': 'shuffle', 'context_id': row['context_id'], 'track_ids': row['track_ids'],
+                       'source': row.get('source'), 'source_shuffle_id': row.get('source_shuffle_id')}
+
+    return run_import(store, user_id, iter_records)
+
+def import_parquet_zip(store, user_id, fileobj, directory):
+    with zipfile.ZipFile(fileobj) as archive:
+        for name in archive.namelist():
+            # only the flat table files, never paths out of the directory
+            if name.endswith('.parquet') and os.path.basename(name) == name:
+                archive.extract(name, directory)
+    return import_parquet(store, user_id, directory)
+
+# e.g. python shuffleExport.py export data.ndjson
+#      python shuffleExport.py export --format parquet export_dir
+#      python shuffleExport.py import other_machine.ndjson export_dir
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export or merge collected shuffle data")
+    parser.add_argument('--db', help="database path, SHUFFLE_DB_PATH or shuffle_data.db by default")
+    parser.add_argument('--user', default=UNOWNED_USER_ID,
+                        help="spotify user ID whose data this is, by default the unowned data the next user to log in takes over")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('output', help="an .ndjson file, or a directory for parquet")
+    export_parser.add_argument('--format', choices=['ndjson', 'parquet'], default='ndjson')
+    export_parser.add_argument('--context', action='append', help="only export this context ID (can be repeated)")
+
+    import_parser = commands.add_parser('import')
+    import_parser.add_argument('inputs', nargs='+', help=".ndjson files, parquet directories or parquet .zip exports")
+
+    args = parser.parse_args()
+    store = ShuffleStore(args.db)
+
+    if args.command == 'export':
+        if args.format == 'parquet':
+            export_parquet(store, args.user, args.output, args.context)
+        else:
+            with open(args.output, 'w') as f:
+                f.writelines(export_ndjson(store, args.user, args.context))
+        print(f"Exported to {args.output}")
+    else:
+        for path in args.inputs:
+            if os.path.isdir(path):
+                stats = import_parquet(store, args.user, path)
+            elif path.endswith('.zip'):
+                with tempfile.TemporaryDirectory() as directory, open(path, 'rb') as f:
+                    stats = import_parquet_zip(store, args.user, f, directory)
+            else:
+                with open(path) as f:
+                    stats = import_ndjson(store, args.user, f)
+            print(f"{path}: {stats}")
@@ -0,0 +1,305 @@
+import os
+import random
+import threading
+import time
+import spotipy
+import spotifyClient
+import appMetrics
+
+SAMPLE_INTERVAL = float(os.environ.get("SAMPLE_INTERVAL", 1.0)) # seconds between the end of one sample and the start of the next
+RATE_LIMIT_BACKOFF = 5.0
+MAX_RATE_LIMIT_BACKOFF = 60.0
+SIGNATURE_SIZE = 10 # how many tracks from the top of the queue identify an ordering
+STATUS_HEARTBEAT_INTERVAL = 5.0 # status is reported at least this often, even when nothing changed
+# deep sampling skips through each shuffle to record up to this many tracks of it, 0 only reads the queue once
+DEEP_SAMPLE_DEPTH = int(os.environ.get("DEEP_SAMPLE_DEPTH", 0))
+MAX_DEEP_SAMPLE_DEPTH = 1000
+
+shuffle_wait_seconds = appMetrics.registry.histogram(
+    'shuffle_wait_seconds', "Time spent polling the queue until a shuffle change went through", ['stage', 'outcome'])
+
+def get_queue_signature(queue_data):
+    tracks = queue_data.get('queue', [])
+    return tuple(track['id'] for track in tracks[:SIGNATURE_SIZE])
+
+def is_reshuffled(signature, unshuffled_signature, last_shuffled_signature):
+    if not signature or not unshuffled_signature:
+        return True  # Not enough info to compare or queue is empty
+
+    # still showing the previous shuffle, spotify hasn't reshuffled yet
+    if signature == last_shuffled_signature:
+        return False
+
+    # a real reshuffle leaves very few tracks where the unshuffled order had them
+    matching_positions = sum(a == b for a, b in zip(signature, unshuffled_signature))
+    if len(signature) < 4:
+        return signature != unshuffled_signature[:len(signature)]
+    return matching_positions <= len(signature) // 4
+
+# Learns how long spotify takes to apply a shuffle change, so polling starts about when it's expected to be done
+class PropagationDelay:
+    def __init__(self, name, initial, minimum=0.1, maximum=5.0, smoothing=0.3):
+        self.name = name
+        self.estimate = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.smoothing = smoothing
+
+    def first_wait(self):
+        # start a bit early, if it's already done the estimate drifts down
+        return max(self.minimum, self.estimate * 0.8)
+
+    def next_wait(self, wait):
+        # back off with jitter so retries don't line up into bursts
+        return min(self.maximum, max(self.minimum, wait * 1.5) * random.uniform(0.8, 1.2))
+
+    def record(self, elapsed):
+        self.estimate = (1 - self.smoothing) * self.estimate + self.smoothing * elapsed
+        self.estimate = min(self.maximum, max(self.minimum, self.estimate))
+
+    def record_timeout(self):
+        self.estimate = min(self.maximum, self.estimate * 1.5)
+
+def get_currently_playing_data(queue_data):
+    currently_playing = queue_data.get('currently_playing') or {}
+    return {
+        'item_name': currently_playing.get('name', 'Unknown Track'),
+        'item_artist': ", ".join([a['name'] for a in currently_playing.get('artists', [])])
+    }
+
+# A sampler running in another process, as it last reported itself through on_status
+class SamplerStatus:
+    def __init__(self, status, updated_at, stale_after):
+        self.error = status.get('error')
+        self.currently_playing = status.get('currently_playing')
+        self.num_samples = status.get('num_samples', 0)
+        self.running = status.get('running', False)
+        self.updated_at = updated_at
+        self.stale_after = stale_after
+
+    def is_running(self):
+        # a sampler that stopped reporting went down with its process
+        return self.running and time.time() - self.updated_at < self.stale_after
+
+# Drives the unshuffle -> shuffle -> read queue cycle for one user on its own thread,
+# so /queue_data only has to read whatever has been collected so far.
+# on_sample returning False, or on_status returning False, stops the sampler
+class ShuffleSampler:
+    def __init__(self, access_token, context_id, on_sample, interval=SAMPLE_INTERVAL, on_status=None, depth=DEEP_SAMPLE_DEPTH):
+        self.access_token = access_token
+        self.context_id = context_id
+        self.on_sample = on_sample
+        self.on_status = on_status
+        self.interval = interval
+        self.depth = min(max(depth, 0), MAX_DEEP_SAMPLE_DEPTH)
+
+        # the unshuffled order is learned on the first sample and again whenever the song changes
+        self.current_song_id = None
+        self.unshuffled_signature = ()
+        self.last_shuffled_signature = ()
+
+        self.unshuffle_delay = PropagationDelay('unshuffle', initial=1.0)
+        self.shuffle_delay = PropagationDelay('shuffle', initial=0.5)
+        self.skip_delay = PropagationDelay('skip', initial=0.5)
+        self.rate_limit_backoff = RATE_LIMIT_BACKOFF
+
+        self.currently_playing = None
+        self.error = None
+        self.num_samples = 0
+        self.skipped_samples = 0
+        self.reported_status = None
+        self.reported_at = 0.0
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait=False):
+        self.stop_event.set()
+        if wait and self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def is_running(self):
+        return self.thread.is_alive() and not self.stop_event.is_set()
+
+    def get_status(self):
+        return {'running': self.is_running(), 'error': self.error,
+                'currently_playing': self.currently_playing, 'num_samples': self.num_samples}
+
+    # only when something changed, or now and then so it can be told apart from a sampler that died
+    def report_status(self, force=False):
+        if self.on_status is None:
+            return
+
+        status = self.get_status()
+        now = time.monotonic()
+        if force or status != self.reported_status or now - self.reported_at >= STATUS_HEARTBEAT_INTERVAL:
+            self.reported_status = status
+            self.reported_at = now
+            if self.on_status(status) is False:
+                self.stop_event.set()
+
+    def run(self):
+        try:
+            self.sample_until_stopped()
+        finally:
+            self.report_status(force=True)
+
+    def sample_until_stopped(self):
+        sp = spotifyClient.get_client(self.access_token)
+        # straight away, so it shows up as running before the first sample is in
+        self.report_status()
+
+        while not self.stop_event.is_set():
+            try:
+                queue_data = self.sample(sp)
+
+                # don't let a sample that was cut short land in the data
+                if self.stop_event.is_set():
+                    break
+
+                self.rate_limit_backoff = RATE_LIMIT_BACKOFF
+                self.error = None
+
+                if queue_data is None:
+                    self.skipped_samples += 1
+                elif self.on_sample(sp, self.context_id, queue_data) is False:
+                    # cancelled while the sample was being taken
+                    self.stop_event.set()
+                    break
+                else:
+                    self.currently_playing = get_currently_playing_data(queue_data)
+                    self.num_samples += 1
+
+            except spotipy.exceptions.SpotifyException as e:
+                if e.http_status == 401: # Token expired
+                    self.fail(401, "Token expired, please log in again")
+                elif e.http_status == 404:
+                    self.fail(404, "No active device, please keep spotify open")
+                elif e.http_status == 429: # rate limits, back off and keep going
+                    self.error = {"status": 429, "error": "Rate limits met, please try again later"}
+                    self.stop_event.wait(self.get_rate_limit_wait(e))
+                else:
+                    self.error = {"status": 500, "error": f"Spotify API error during shuffle operation: {str(e)}"}
+            except Exception as e:
+                self.fail(500, f"An unexpected error occurred: {str(e)}")
+
+            self.report_status()
+            self.stop_event.wait(self.interval)
+
+    def fail(self, status, error):
+        self.error = {"status": status, "error": error}
+        self.stop_event.set()
+
+    def get_rate_limit_wait(self, e):
+        retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+        if retry_after is not None:
+            return float(retry_after) * random.uniform(1.0, 1.2)
+
+        wait = self.rate_limit_backoff * random.uniform(0.8, 1.2)
+        self.rate_limit_backoff = min(MAX_RATE_LIMIT_BACKOFF, self.rate_limit_backoff * 2)
+        return wait
+
+    # Polls the queue on the delay's schedule until is_ready says the change went through,
+    # None if it never did (or the sampler was stopped)
+    def wait_for_queue(self, sp, delay, is_ready):
+        started = time.monotonic()
+        wait = delay.first_wait()
+
+        while not self.stop_event.wait(wait):
+            queue_data = sp.queue()
+            if is_ready(queue_data):
+                delay.record(time.monotonic() - started)
+                shuffle_wait_seconds.observe(time.monotonic() - started, delay.name, 'ready')
+                return queue_data
+
+            if time.monotonic() - started >= delay.maximum:
+                delay.record_timeout()
+                shuffle_wait_seconds.observe(time.monotonic() - started, delay.name, 'timeout')
+                return None
+
+            wait = delay.next_wait(wait)
+
+        shuffle_wait_seconds.observe(time.monotonic() - started, delay.name, 'stopped')
+        return None
+
+    def sample(self, sp):
+        sp.shuffle(False)
+
+        previous_read = {}
+        def is_unshuffled(queue_data):
+            signature = get_queue_signature(queue_data)
+            if signature and signature == self.last_shuffled_signature:
+                return False
+
+            if queue_data['currently_playing']['id'] == self.current_song_id:
+                return signature == self.unshuffled_signature
+
+            # song changed, the new unshuffled order is only trusted once two reads agree
+            stable = previous_read.get('signature') == signature
+            previous_read['signature'] = signature
+            return stable
+
+        queue_data = self.wait_for_queue(sp, self.unshuffle_delay, is_unshuffled)
+        if queue_data is None:
+            return None
+
+        # song changed, so need to update the unshuffled order
+        if queue_data['currently_playing']['id'] != self.current_song_id:
+            self.unshuffled_signature = get_queue_signature(queue_data)
+            self.current_song_id = queue_data['currently_playing']['id']
+
+        sp.shuffle(True)
+
+        # wait until shuffle takes effect
+        queue_data = self.wait_for_queue(sp, self.shuffle_delay, lambda queue_data: is_reshuffled(
+            get_queue_signature(queue_data), self.unshuffled_signature, self.last_shuffled_signature))
+        if queue_data is None:
+            return None
+
+        self.last_shuffled_signature = get_queue_signature(queue_data)
+        if len(queue_data.get('queue', [])) < self.depth:
+            queue_data = dict(queue_data, queue=self.extend_queue(sp, queue_data))
+        return queue_data
+
+    # Deep sampling: skips through the shuffled queue and reads it again, until depth tracks of this one
+    # shuffle have been seen. Every skip goes through the rate budget like any other call, and playback
+    # really does move ahead, which is why it's opt-in
+    def extend_queue(self, sp, queue_data):
+        window = queue_data.get('queue', [])
+        tracks = list(window)
+        seen = {track['id'] for track in tracks}
+
+        while window and len(tracks) < self.depth and not self.stop_event.is_set():
+            skips = min(len(window), self.depth - len(tracks))
+            for _ in range(skips):
+                if self.stop_event.is_set():
+                    return tracks
+                sp.next_track()
+
+            # only trust the new read once it lines up with the old one, a dropped skip would shift everything
+            expected_id = window[skips - 1]['id']
+            overlap = [track['id'] for track in window[skips:]]
+            def is_skipped(queue_data):
+                upcoming = queue_data.get('queue', [])
+                return ((queue_data.get('currently_playing') or {}).get('id') == expected_id and
+                        [track['id'] for track in upcoming[:len(overlap)]] == overlap)
+
+            queue_data = self.wait_for_queue(sp, self.skip_delay, is_skipped)
+            if queue_data is None:
+                break
+
+            window = queue_data.get('queue', [])
+            # spotify reads the queue as the shuffled order now, not the one sample() saw
+            self.last_shuffled_signature = get_queue_signature(queue_data)
+
+            for track in window[len(overlap):]:
+                # the queue wrapped back round to the start of the context
+                if track['id'] in seen:
+                    return tracks
+                seen.add(track['id'])
+                tracks.append(track)
+
+        return tracks
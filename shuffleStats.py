@@ -0,0 +1,168 @@
+import math
+import numpy as np
+
+# Everything in here works off a shuffles x positions matrix of interned track IDs (-1 past the end of a queue)
+def build_shuffle_matrix(track_trie):
+    # copy out of the trie's arrays, a live view would stop them from growing while the stats are computed
+    all_tracks = np.array(track_trie.allTracks, dtype=np.int32)
+    starts = np.array(track_trie.shuffleStarts, dtype=np.int32)
+    if len(starts) == 0:
+        return np.full((0, 0), -1, dtype=np.int32)
+
+    lengths = np.diff(np.append(starts, len(all_tracks)))
+    rows = np.repeat(np.arange(len(starts)), lengths)
+    positions = np.arange(len(all_tracks)) - np.repeat(starts, lengths)
+
+    matrix = np.full((len(starts), lengths.max()), -1, dtype=np.int32)
+    matrix[rows, positions] = all_tracks
+    return matrix
+
+# p-value of a chi-square statistic using the Wilson-Hilferty normal approximation
+def chi_square_p_value(chi_square, dof):
+    if dof <= 0:
+        return 1.0
+    z = ((chi_square / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def get_adjacent_pairs(matrix):
+    first, second = matrix[:, :-1], matrix[:, 1:]
+    valid = (first >= 0) & (second >= 0)
+    return first[valid].astype(np.int64), second[valid].astype(np.int64)
+
+def frequency_uniformity(matrix, num_tracks_in_context):
+    seen = matrix[matrix >= 0]
+    counts = np.bincount(seen)
+    counts = counts[counts > 0]
+
+    # tracks that never showed up still count towards the test
+    num_tracks = max(num_tracks_in_context or 0, len(counts))
+    if num_tracks < 2 or len(seen) == 0:
+        return {'num_shuffles': len(matrix), 'num_tracks': num_tracks, 'total_plays': int(len(seen)),
+                'chi_square': 0.0, 'degrees_of_freedom': 0, 'p_value': 1.0}
+
+    expected = len(seen) / num_tracks
+    unseen = num_tracks - len(counts)
+    chi_square = float(((counts - expected) ** 2 / expected).sum() + unseen * expected)
+    dof = num_tracks - 1
+
+    return {
+        'num_shuffles': len(matrix),
+        'num_tracks': num_tracks,
+        'total_plays': int(len(seen)),
+        'expected_frequency': expected,
+        'min_frequency': 0 if unseen else int(counts.min()),
+        'max_frequency': int(counts.max()),
+        'std_frequency': float(np.concatenate([counts, np.zeros(unseen)]).std()),
+        'chi_square': chi_square,
+        'degrees_of_freedom': dof,
+        'p_value': chi_square_p_value(chi_square, dof)
+    }
+
+def position_bias(matrix, num_tracks):
+    num_positions = matrix.shape[1]
+    rows, positions = np.nonzero(matrix >= 0)
+    tracks = matrix[rows, positions]
+
+    counts = np.bincount(tracks * num_positions + positions, minlength=num_tracks * num_positions)
+    counts = counts.reshape(num_tracks, num_positions).astype(np.float64)
+
+    # expected count if a track's position doesn't depend on which track it is
+    track_totals = counts.sum(axis=1, keepdims=True)
+    position_totals = counts.sum(axis=0, keepdims=True)
+    expected = track_totals * position_totals / max(counts.sum(), 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(expected > 0, counts / expected, 0.0)
+        cells = np.where(expected > 0, (counts - expected) ** 2 / expected, 0.0)
+
+    track_chi_square = cells.sum(axis=1)
+    chi_square = float(cells.sum())
+    dof = max((int((track_totals > 0).sum()) - 1) * (num_positions - 1), 0)
+
+    return counts, ratio, track_chi_square, {
+        'num_positions': num_positions,
+        'chi_square': chi_square,
+        'degrees_of_freedom': dof,
+        'p_value': chi_square_p_value(chi_square, dof)
+    }
+
+def adjacency_overrepresentation(matrix, num_tracks_in_context, min_count=2):
+    first, second = get_adjacent_pairs(matrix)
+    num_tracks = max(num_tracks_in_context or 0, int(matrix.max()) + 1 if matrix.size else 0)
+    if len(first) == 0 or num_tracks < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 0.0
+
+    keys, counts = np.unique(first * num_tracks + second, return_counts=True)
+    keep = counts >= min_count
+    keys, counts = keys[keep], counts[keep]
+
+    # any ordered pair is equally likely in any adjacent slot of a uniform shuffle
+    expected = len(first) / (num_tracks * (num_tracks - 1))
+    return keys // num_tracks, keys % num_tracks, counts, expected
+
+def artist_clustering(matrix, track_artists):
+    # track_artists: interned track ID -> interned primary artist (-1 when unknown)
+    artists = np.where(matrix >= 0, track_artists[np.maximum(matrix, 0)], -1)
+    known = (artists[:, :-1] >= 0) & (artists[:, 1:] >= 0)
+    same_artist = known & (artists[:, :-1] == artists[:, 1:])
+
+    # chance two different random tracks share an artist, from how many tracks each artist has
+    artist_sizes = np.bincount(track_artists[track_artists >= 0])
+    num_known = artist_sizes.sum()
+    expected_rate = float((artist_sizes * (artist_sizes - 1)).sum() / (num_known * (num_known - 1))) if num_known > 1 else 0.0
+
+    total_pairs = int(known.sum())
+    total_same = int(same_artist.sum())
+    observed_rate = total_same / total_pairs if total_pairs else 0.0
+    std = math.sqrt(total_pairs * expected_rate * (1 - expected_rate))
+    same_per_shuffle = same_artist.sum(axis=1)
+
+    return np.bincount(artists[:, :-1][same_artist], minlength=len(artist_sizes)), {
+        'adjacent_pairs': total_pairs,
+        'same_artist_pairs': total_same,
+        'observed_rate': observed_rate,
+        'expected_rate': expected_rate,
+        'clustering_score': observed_rate / expected_rate if expected_rate else 0.0,
+        'z_score': (total_same - total_pairs * expected_rate) / std if std else 0.0,
+        'shuffles_with_same_artist_neighbours': int((same_per_shuffle > 0).sum()),
+        'mean_same_artist_per_shuffle': float(same_per_shuffle.mean()) if len(same_per_shuffle) else 0.0
+    }
+
+def jensen_shannon_divergence(p, q):
+    # in bits, so 0 is the same distribution and 1 is no tracks in common
+    m = (p + q) / 2
+    def kl(a):
+        mask = a > 0
+        return float((a[mask] * np.log2(a[mask] / m[mask])).sum())
+    return (kl(p) + kl(q)) / 2
+
+# Side by side comparison of several contexts, counts is a contexts x tracks matrix of plays aligned on the same tracks.
+# Returns each context's share of plays per track, and overlap and divergence for every pair of contexts
+def compare_frequencies(counts):
+    counts = counts.astype(np.float64)
+    shares = counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    present = counts > 0
+    norms = np.linalg.norm(shares, axis=1)
+
+    pairs = []
+    for i in range(len(counts)):
+        for j in range(i + 1, len(counts)):
+            shared = int((present[i] & present[j]).sum())
+            either = int((present[i] | present[j]).sum())
+            pairs.append({
+                'first': i,
+                'second': j,
+                'shared_tracks': shared,
+                'jaccard': shared / either if either else 0.0,
+                # share of the first context's plays that went to tracks the second also played
+                'coverage': [float(shares[i][present[j]].sum()), float(shares[j][present[i]].sum())],
+                'cosine_similarity': float(shares[i] @ shares[j] / (norms[i] * norms[j])) if norms[i] and norms[j] else 0.0,
+                'total_variation': float(np.abs(shares[i] - shares[j]).sum() / 2),
+                'jensen_shannon': jensen_shannon_divergence(shares[i], shares[j])
+            })
+
+    return shares, {
+        'tracks': int(present.any(axis=0).sum()),
+        'tracks_in_all': int(present.all(axis=0).sum()) if len(counts) else 0,
+        'pairs': pairs
+    }
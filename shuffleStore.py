@@ -0,0 +1,421 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+
+DEFAULT_DB_PATH = "shuffle_data.db"
+BATCH_SIZE = 1000 # rows per query when streaming a whole table out
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    track_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS contexts (
+    user_id TEXT NOT NULL,
+    context_id TEXT NOT NULL,
+    info TEXT NOT NULL,
+    PRIMARY KEY (user_id, context_id)
+);
+CREATE TABLE IF NOT EXISTS shuffles (
+    user_id TEXT NOT NULL,
+    context_id TEXT NOT NULL,
+    shuffle_id INTEGER NOT NULL,
+    track_ids TEXT NOT NULL,
+    PRIMARY KEY (user_id, context_id, shuffle_id)
+);
+CREATE TABLE IF NOT EXISTS shuffle_sources (
+    user_id TEXT NOT NULL,
+    context_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    source_shuffle_id INTEGER NOT NULL,
+    shuffle_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, context_id, source, source_shuffle_id)
+);
+CREATE TABLE IF NOT EXISTS store_info (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_budgets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL DEFAULT 0,
+    data_generation INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sampler_status (
+    user_id TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL,
+    running INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Tracks and metadata are spotify's own data and shared by everyone, contexts and shuffles belong to a user.
+# Every shuffle has an origin, the store it was sampled into and its ID there. Sampled shuffles are from this
+# store (store_info's store_id), imported ones keep where they came from in shuffle_sources, so the same
+# shuffle is never imported twice however many machines it went through.
+# Rows from before data was kept per user are owned by UNOWNED_USER_ID until someone claims them.
+# Every worker process reads and writes the same database, so the users table is how they keep up with
+# each other's changes to a user:
+#     generation: bumped to cancel the user's sampler, whichever process it's running in
+#     data_generation: bumped when the user's data is replaced (a reset or an import), loaded copies start over
+#     version: bumped by every change, loaded copies catch up when it moves
+UNOWNED_USER_ID = ""
+BUSY_TIMEOUT_MS = 30000 # how long a write waits on another thread or process's write
+COMPACT_PAGES = 1024 # pages given back per incremental vacuum step, each step holds the write lock only briefly
+
+class ShuffleStore:
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("SHUFFLE_DB_PATH", DEFAULT_DB_PATH)
+        # one connection per thread, WAL lets them all read at once and sqlite puts the writes in order
+        self.local = threading.local()
+
+        conn = self.get_connection()
+        # only takes effect on a new database, migrate converts older ones
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.executescript(SCHEMA)
+        self.migrate(conn)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        # a connection can't be used on both sides of a fork, e.g. a WSGI server preloading the app before starting workers
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = self.connect()
+            self.local.pid = os.getpid()
+        return conn
+
+    # BEGIN IMMEDIATE takes the write lock up front, so nothing read inside can change before the writes
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    # contexts and shuffles from before there was a user_id column get rebuilt with it, under UNOWNED_USER_ID
+    def migrate(self, conn):
+        with self.transaction():
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(contexts)")]
+            if 'user_id' not in columns:
+                conn.execute("ALTER TABLE contexts RENAME TO old_contexts")
+                conn.execute("ALTER TABLE shuffles RENAME TO old_shuffles")
+                for statement in SCHEMA.split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+                conn.execute("INSERT INTO contexts (user_id, context_id, info) SELECT ?, context_id, info FROM old_contexts",
+                             (UNOWNED_USER_ID,))
+                conn.execute("INSERT INTO shuffles (user_id, context_id, shuffle_id, track_ids) SELECT ?, context_id, shuffle_id, track_ids FROM old_shuffles",
+                             (UNOWNED_USER_ID,))
+                conn.execute("DROP TABLE old_contexts")
+                conn.execute("DROP TABLE old_shuffles")
+
+        # databases from before compaction was incremental need one full VACUUM to switch over, it can't run in a transaction
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+
+    # contexts without an ID (playing straight from the queue) are stored under ""
+    @staticmethod
+    def to_key(context_id):
+        return context_id or ""
+
+    @staticmethod
+    def from_key(key):
+        return key or None
+
+    def write(self, sql, params=()):
+        conn = self.get_connection()
+        with conn:
+            conn.execute(sql, params)
+
+    def write_many(self, sql, rows):
+        conn = self.get_connection()
+        with conn:
+            conn.executemany(sql, rows)
+
+    def read(self, sql, params=()):
+        return self.get_connection().execute(sql, params).fetchall()
+
+    def get_store_id(self):
+        store_id = getattr(self, 'store_id', None)
+        if store_id is None:
+            self.write("INSERT OR IGNORE INTO store_info (key, value) VALUES ('store_id', ?)", (uuid.uuid4().hex,))
+            store_id = self.store_id = self.read("SELECT value FROM store_info WHERE key = 'store_id'")[0][0]
+        return store_id
+
+    def save_track(self, track):
+        self.write("INSERT OR IGNORE INTO tracks (track_id, data) VALUES (?, ?)",
+                   (track['id'], json.dumps(track)))
+
+    def save_metadata(self, namespace, key, value, expires_at):
+        self.write("INSERT OR REPLACE INTO metadata (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                   (namespace, key, json.dumps(value), expires_at))
+
+    # (generation, data_generation, version) for the user, see the users table
+    def get_user_state(self, user_id):
+        rows = self.read("SELECT generation, data_generation, version FROM users WHERE user_id = ?", (user_id,))
+        return rows[0] if rows else (0, 0, 0)
+
+    # called inside a transaction, returns the user's new state
+    def bump_user(self, conn, user_id, generation=0, data_generation=0):
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        conn.execute("UPDATE users SET generation = generation + ?, data_generation = data_generation + ?, version = version + 1 WHERE user_id = ?",
+                     (generation, data_generation, user_id))
+        return self.get_user_state(user_id)
+
+    def cancel_sampling(self, user_id):
+        with self.transaction() as conn:
+            return self.bump_user(conn, user_id, generation=1)[0]
+
+    # marks the user's data as changed by something other than the calls below (an import), reload=True when
+    # it's changed enough that loaded copies should start over
+    def touch_user(self, user_id, reload=False):
+        with self.transaction() as conn:
+            self.bump_user(conn, user_id, data_generation=int(reload))
+
+    def save_context_info(self, user_id, context_id, context_info):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO contexts (user_id, context_id, info) VALUES (?, ?, ?)",
+                         (user_id, self.to_key(context_id), json.dumps(context_info)))
+            self.bump_user(conn, user_id)
+
+    # Stores one sample's tracks and shuffle, unless the sampler that took it has been cancelled since.
+    # Taking the next shuffle ID and writing it happen in one transaction, so samples for a context are
+    # stored one at a time even from different processes. Returns (shuffle ID, user's new version) or None
+    def append_sample(self, user_id, generation, context_id, tracks):
+        with self.transaction() as conn:
+            if self.get_user_state(user_id)[0] != generation:
+                return None
+
+            conn.executemany("INSERT OR IGNORE INTO tracks (track_id, data) VALUES (?, ?)",
+                             [(track['id'], json.dumps(track)) for track in tracks])
+            shuffle_id = self.get_last_shuffle_id(user_id, context_id) + 1
+            conn.execute("INSERT INTO shuffles (user_id, context_id, shuffle_id, track_ids) VALUES (?, ?, ?, ?)",
+                         (user_id, self.to_key(context_id), shuffle_id, json.dumps([track.get('id') for track in tracks])))
+            return shuffle_id, self.bump_user(conn, user_id)[2]
+
+    def save_tracks(self, tracks):
+        self.write_many("INSERT OR IGNORE INTO tracks (track_id, data) VALUES (?, ?)",
+                        [(track['id'], json.dumps(track)) for track in tracks])
+
+    def add_context_info(self, user_id, context_id, context_info):
+        # unlike save_context_info, what's already here wins
+        self.write("INSERT OR IGNORE INTO contexts (user_id, context_id, info) VALUES (?, ?, ?)",
+                   (user_id, self.to_key(context_id), json.dumps(context_info)))
+
+    # Stores a batch of (track IDs, source, source shuffle ID) under the next free IDs in the context, the source is
+    # None for shuffles that don't have one to keep. Like
+    # append_sample the IDs are taken in the same transaction as the writes, so samples stored in the meantime keep theirs
+    def append_shuffles(self, user_id, context_id, shuffles):
+        key = self.to_key(context_id)
+        with self.transaction() as conn:
+            first_id = self.get_last_shuffle_id(user_id, context_id) + 1
+            conn.executemany("INSERT INTO shuffles (user_id, context_id, shuffle_id, track_ids) VALUES (?, ?, ?, ?)",
+                             [(user_id, key, shuffle_id, json.dumps(track_ids))
+                              for shuffle_id, (track_ids, _, _) in enumerate(shuffles, first_id)])
+            conn.executemany("INSERT INTO shuffle_sources (user_id, context_id, source, source_shuffle_id, shuffle_id) VALUES (?, ?, ?, ?, ?)",
+                             [(user_id, key, source, source_shuffle_id, shuffle_id)
+                              for shuffle_id, (_, source, source_shuffle_id) in enumerate(shuffles, first_id) if source is not None])
+            return first_id
+
+    def get_last_shuffle_id(self, user_id, context_id):
+        rows = self.read("SELECT MAX(shuffle_id) FROM shuffles WHERE user_id = ? AND context_id = ?",
+                         (user_id, self.to_key(context_id)))
+        return rows[0][0] if rows[0][0] is not None else -1
+
+    # The iter_ functions page through with keyset queries, so a big export only ever holds
+    # one batch in memory and no read is kept open between batches
+    def iter_tracks(self, batch_size=BATCH_SIZE):
+        last_id = ""
+        while True:
+            rows = self.read("SELECT track_id, data FROM tracks WHERE track_id > ? ORDER BY track_id LIMIT ?", (last_id, batch_size))
+            for _, data in rows:
+                yield json.loads(data)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def iter_shuffles(self, user_id, context_id, after=-1, batch_size=BATCH_SIZE):
+        last_id = after
+        while True:
+            rows = self.read("SELECT shuffle_id, track_ids FROM shuffles WHERE user_id = ? AND context_id = ? AND shuffle_id > ? ORDER BY shuffle_id LIMIT ?",
+                             (user_id, self.to_key(context_id), last_id, batch_size))
+            for shuffle_id, track_ids in rows:
+                yield shuffle_id, json.loads(track_ids)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    # iter_shuffles with each shuffle's origin, (shuffle ID, track IDs, source, source shuffle ID)
+    def iter_shuffles_with_origins(self, user_id, context_id, batch_size=BATCH_SIZE):
+        last_id = -1
+        while True:
+            rows = self.read("""
+                SELECT shuffles.shuffle_id, shuffles.track_ids, COALESCE(sources.source, ?), COALESCE(sources.source_shuffle_id, shuffles.shuffle_id)
+                FROM shuffles LEFT JOIN shuffle_sources AS sources ON sources.user_id = shuffles.user_id
+                    AND sources.context_id = shuffles.context_id AND sources.shuffle_id = shuffles.shuffle_id
+                WHERE shuffles.user_id = ? AND shuffles.context_id = ? AND shuffles.shuffle_id > ? ORDER BY shuffles.shuffle_id LIMIT ?
+            """, (self.get_store_id(), user_id, self.to_key(context_id), last_id, batch_size))
+            for shuffle_id, track_ids, source, source_shuffle_id in rows:
+                yield shuffle_id, json.loads(track_ids), source, source_shuffle_id
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    # (source, source shuffle ID) of every shuffle in the context
+    def load_shuffle_origins(self, user_id, context_id):
+        key = self.to_key(context_id)
+        origins = {(source, source_shuffle_id) for source, source_shuffle_id in self.read(
+            "SELECT source, source_shuffle_id FROM shuffle_sources WHERE user_id = ? AND context_id = ?", (user_id, key))}
+        store_id = self.get_store_id()
+        origins.update((store_id, shuffle_id) for (shuffle_id,) in self.read("""
+            SELECT shuffle_id FROM shuffles WHERE user_id = ? AND context_id = ? AND shuffle_id NOT IN (
+                SELECT shuffle_id FROM shuffle_sources WHERE user_id = ? AND context_id = ?)
+        """, (user_id, key, user_id, key)))
+        return origins
+
+    def count_track_plays(self, user_id, context_id):
+        # one row per track in the context, so this stays small even for long histories
+        return self.read("""
+            SELECT queued.value, COUNT(*) AS plays FROM shuffles, json_each(shuffles.track_ids) AS queued
+            WHERE shuffles.user_id = ? AND shuffles.context_id = ? GROUP BY queued.value ORDER BY plays DESC, queued.value
+        """, (user_id, self.to_key(context_id)))
+
+    def load_tracks_by_id(self, track_ids):
+        rows = self.read("SELECT track_id, data FROM tracks WHERE track_id IN (SELECT value FROM json_each(?))",
+                         (json.dumps(list(track_ids)),))
+        return {track_id: json.loads(data) for track_id, data in rows}
+
+    def load_user_tracks(self, user_id):
+        # only the tracks that turn up in the user's own shuffles
+        rows = self.read("""
+            SELECT track_id, data FROM tracks WHERE track_id IN (
+                SELECT queued.value FROM shuffles, json_each(shuffles.track_ids) AS queued WHERE shuffles.user_id = ?)
+        """, (user_id,))
+        return {track_id: json.loads(data) for track_id, data in rows}
+
+    def load_metadata(self, namespace, key):
+        rows = self.read("SELECT expires_at, value FROM metadata WHERE namespace = ? AND key = ?", (namespace, key))
+        return (rows[0][0], json.loads(rows[0][1])) if rows else None
+
+    def load_all_metadata(self, namespace):
+        rows = self.read("SELECT key, expires_at, value FROM metadata WHERE namespace = ? ORDER BY expires_at", (namespace,))
+        return [(key, expires_at, json.loads(value)) for key, expires_at, value in rows]
+
+    def clear_metadata(self, namespace):
+        self.write("DELETE FROM metadata WHERE namespace = ?", (namespace,))
+
+    def delete_expired_metadata(self, now):
+        self.write("DELETE FROM metadata WHERE expires_at <= ?", (now,))
+
+    def load_contexts(self, user_id):
+        contexts = {self.from_key(key): {} for (key,) in self.read("SELECT DISTINCT context_id FROM shuffles WHERE user_id = ?", (user_id,))}
+        for key, info in self.read("SELECT context_id, info FROM contexts WHERE user_id = ?", (user_id,)):
+            contexts[self.from_key(key)] = json.loads(info)
+        return contexts
+
+    def has_user_data(self, user_id):
+        return bool(self.read("SELECT 1 FROM contexts WHERE user_id = ? UNION ALL SELECT 1 FROM shuffles WHERE user_id = ? LIMIT 1",
+                              (user_id, user_id)))
+
+    # Hands the unowned rows to a user who has nothing yet, returns whether there was anything to take
+    def claim_unowned(self, user_id):
+        # in one transaction so two users logging in at once can't both claim them
+        with self.transaction() as conn:
+            if not self.has_user_data(UNOWNED_USER_ID) or self.has_user_data(user_id):
+                return False
+            conn.execute("UPDATE contexts SET user_id = ? WHERE user_id = ?", (user_id, UNOWNED_USER_ID))
+            conn.execute("UPDATE shuffles SET user_id = ? WHERE user_id = ?", (user_id, UNOWNED_USER_ID))
+            conn.execute("UPDATE shuffle_sources SET user_id = ? WHERE user_id = ?", (user_id, UNOWNED_USER_ID))
+            self.bump_user(conn, user_id, data_generation=1)
+            return True
+
+    # tracks and metadata are a cache of what spotify says, not collected data, so they're left for other users
+    # also cancels the user's sampler, so nothing it had in flight lands in the cleared data
+    def clear_user(self, user_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM shuffles WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM shuffle_sources WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM contexts WHERE user_id = ?", (user_id,))
+            return self.bump_user(conn, user_id, generation=1, data_generation=1)
+
+    # A token bucket every process shares, see spotifyClient.RateBudget. Takes a token if there is one and
+    # returns 0, otherwise how long until there will be. Times are wall clock, the processes don't share a monotonic one
+    def take_rate_token(self, name, rate, capacity, now):
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT tokens, updated, blocked_until FROM rate_budgets WHERE name = ?", (name,)).fetchall()
+            tokens, updated, blocked_until = rows[0] if rows else (capacity, now, 0.0)
+            tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+
+            if now < blocked_until:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            conn.execute("INSERT OR REPLACE INTO rate_budgets (name, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)",
+                         (name, tokens, max(now, updated), blocked_until))
+            return wait
+
+    def block_rate_budget(self, name, now, until):
+        with self.transaction() as conn:
+            conn.execute("""
+                INSERT INTO rate_budgets (name, tokens, updated, blocked_until) VALUES (?, 0, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET tokens = 0, updated = MAX(updated, excluded.updated),
+                    blocked_until = MAX(blocked_until, excluded.blocked_until)
+            """, (name, now, until))
+
+    # Gives the pages freed by deleted rows back to the filesystem a step at a time, so other writers get in
+    # between steps, then empties the WAL
+    def compact(self):
+        conn = self.get_connection()
+        while conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            conn.execute(f"PRAGMA incremental_vacuum({COMPACT_PAGES})").fetchall()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    # What a user's sampler is up to, so any process can answer for it. Refused (False) once the
+    # sampler's generation has been cancelled, which is how a sampler finds out it was stopped elsewhere
+    def save_sampler_status(self, user_id, generation, status, now):
+        with self.transaction() as conn:
+            if self.get_user_state(user_id)[0] != generation:
+                return False
+            conn.execute("INSERT OR REPLACE INTO sampler_status (user_id, generation, running, status, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         (user_id, generation, int(status['running']), json.dumps(status), now))
+            return True
+
+    # (generation, status, updated_at) or None
+    def load_sampler_status(self, user_id):
+        rows = self.read("SELECT generation, status, updated_at FROM sampler_status WHERE user_id = ?", (user_id,))
+        if not rows:
+            return None
+        generation, status, updated_at = rows[0]
+        return generation, json.loads(status), updated_at
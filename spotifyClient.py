@@ -0,0 +1,268 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+import requests
+import spotipy
+import appMetrics
+
+# Spotify doesn't publish its limit, it's a rolling window per app so every client shares one budget
+REQUESTS_PER_SECOND = float(os.environ.get("SPOTIFY_REQUESTS_PER_SECOND", 5))
+BURST_SIZE = int(os.environ.get("SPOTIFY_BURST_SIZE", 10))
+MAX_RATE_LIMIT_RETRIES = 2
+DEFAULT_RETRY_AFTER = 5.0
+
+MAX_CLIENTS = 64
+MAX_ARTISTS_PER_CALL = 50 # Spotify API allows fetching up to 50 artists at once
+ARTIST_BATCH_WINDOW = 0.05 # how long the first caller waits for others to add their artists to the batch
+
+spotify_request_seconds = appMetrics.registry.histogram(
+    'spotify_request_seconds', "Spotify API call latency, not counting the wait for the rate budget", ['method'])
+rate_budget_wait_seconds = appMetrics.registry.histogram(
+    'spotify_rate_budget_wait_seconds', "Time calls spent waiting for the shared rate budget")
+rate_limited = appMetrics.registry.counter('spotify_rate_limited', "429 responses from spotify", ['method'])
+
+# spotifySimulator.install() swaps this out to run without talking to spotify
+def create_spotify(access_token, session):
+    return spotipy.Spotify(auth=access_token, requests_session=session)
+
+spotify_factory = create_spotify
+
+# Token bucket, a 429 stops everyone until the Retry-After is up. With a store the bucket is kept there,
+# so every worker process using the same database shares one budget and one Retry-After, otherwise it's
+# this process's alone
+class RateBudget:
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST_SIZE, store=None, name='spotify'):
+        self.rate = rate
+        self.capacity = capacity
+        self.store = store
+        self.name = name
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    # how long to wait before asking again, 0 when a token was taken
+    def take_token(self):
+        if self.store is not None:
+            return self.store.take_rate_token(self.name, self.rate, self.capacity, time.time())
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self.take_token()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def block_for(self, seconds):
+        if self.store is not None:
+            now = time.time()
+            self.store.block_rate_budget(self.name, now, now + seconds)
+            return
+
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+def get_retry_after(e):
+    retry_after = (e.headers or {}).get('Retry-After')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+# Lets concurrent identical calls share one request instead of each making their own
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SpotifyClient:
+    def __init__(self, access_token, budget):
+        self.budget = budget
+
+        # one pooled session per token, spotipy's own retries are off since the budget handles 429s
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.sp = spotify_factory(access_token, self.session)
+
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def execute(self, method, *args, **kwargs):
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            with rate_budget_wait_seconds.time():
+                self.budget.acquire()
+            try:
+                with spotify_request_seconds.time(method):
+                    return getattr(self.sp, method)(*args, **kwargs)
+            except spotipy.exceptions.SpotifyException as e:
+                if e.http_status == 429:
+                    rate_limited.inc(method)
+                if e.http_status != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                self.budget.block_for(get_retry_after(e) * random.uniform(1.0, 1.1))
+
+    def call(self, method, *args, **kwargs):
+        key = (method, args, tuple(sorted(kwargs.items())))
+
+        with self.lock:
+            call = self.in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.in_flight[key] = InFlightCall()
+
+        if is_leader:
+            try:
+                call.result = self.execute(method, *args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error:
+            raise call.error
+        return call.result
+
+    # reads get coalesced, anything that changes playback always goes out
+    def current_user(self):
+        return self.call('current_user')
+
+    def current_playback(self):
+        return self.call('current_playback')
+
+    def queue(self):
+        return self.call('queue')
+
+    def album(self, album_id):
+        return self.call('album', album_id)
+
+    def playlist(self, playlist_id):
+        return self.call('playlist', playlist_id)
+
+    def artist(self, artist_id):
+        return self.call('artist', artist_id)
+
+    def artists(self, artist_ids):
+        return {'artists': list(artist_batcher.get_artists(self, artist_ids).values())}
+
+    def shuffle(self, state):
+        return self.execute('shuffle', state)
+
+    def next_track(self):
+        return self.execute('next_track')
+
+    def close(self):
+        self.session.close()
+
+# What a lookup gets instead of an artist when the call it was batched into failed
+class FailedLookup:
+    def __init__(self, error):
+        self.error = error
+
+# Merges artist lookups from every request into as few 50-ID sp.artists calls as possible
+class ArtistBatcher:
+    def __init__(self):
+        self.pending = OrderedDict()
+        self.results = {}
+        self.waiters = {}
+        self.fetching = False
+        self.condition = threading.Condition()
+
+    def get_artists(self, client, artist_ids):
+        artist_ids = list(dict.fromkeys(artist_ids))
+
+        with self.condition:
+            for artist_id in artist_ids:
+                self.waiters[artist_id] = self.waiters.get(artist_id, 0) + 1
+                # a failure someone else is still waiting to hear about isn't this caller's, it tries again
+                if isinstance(self.results.get(artist_id), FailedLookup):
+                    del self.results[artist_id]
+                if artist_id not in self.results:
+                    self.pending[artist_id] = None
+
+            try:
+                while any(artist_id not in self.results for artist_id in artist_ids):
+                    if not self.fetching:
+                        self.fetch_pending(client)
+                    else:
+                        self.condition.wait()
+
+                results = {artist_id: self.results[artist_id] for artist_id in artist_ids}
+                for result in results.values():
+                    if isinstance(result, FailedLookup):
+                        raise result.error
+                return results
+            finally:
+                for artist_id in artist_ids:
+                    self.waiters[artist_id] -= 1
+                    if self.waiters[artist_id] == 0:
+                        del self.waiters[artist_id]
+                        self.results.pop(artist_id, None)
+
+    # called with the condition held, releases it while the requests are out
+    def fetch_pending(self, client):
+        self.fetching = True
+        try:
+            # give concurrent callers a moment to add their artists to this batch
+            self.condition.wait(ARTIST_BATCH_WINDOW)
+
+            while self.pending:
+                batch_ids = list(self.pending)[:MAX_ARTISTS_PER_CALL]
+                for artist_id in batch_ids:
+                    del self.pending[artist_id]
+
+                self.condition.release()
+                try:
+                    artists_data = client.execute('artists', batch_ids)
+                    artists_by_id = {artist['id']: artist for artist in artists_data['artists'] if artist}
+                    batch_results = {artist_id: artists_by_id.get(artist_id) for artist_id in batch_ids}
+                except Exception as e:
+                    # everyone waiting on the batch gets the error, it's dropped with the results once they've all seen it
+                    batch_results = dict.fromkeys(batch_ids, FailedLookup(e))
+                finally:
+                    self.condition.acquire()
+
+                self.results.update(batch_results)
+                self.condition.notify_all()
+        finally:
+            self.fetching = False
+            self.condition.notify_all()
+
+rate_budget = RateBudget()
+artist_batcher = ArtistBatcher()
+clients = OrderedDict()
+clients_lock = threading.Lock()
+
+def get_client(access_token):
+    with clients_lock:
+        client = clients.get(access_token)
+        if client is None:
+            client = clients[access_token] = SpotifyClient(access_token, rate_budget)
+
+            # tokens expire every hour, so old clients just get closed
+            while len(clients) > MAX_CLIENTS:
+                _, old_client = clients.popitem(last=False)
+                old_client.close()
+
+        clients.move_to_end(access_token)
+        return client
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import random
+import threading
+import time
+import spotipy
+import spotifyClient
+
+QUEUE_SIZE = 20 # what sp.queue() hands back
+
+def make_id(*parts):
+    # stable 22 character IDs so runs with the same seed line up
+    return hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()[:22]
+
+def make_catalog(context_id, num_tracks, tracks_per_artist=5, seed=0):
+    rng = random.Random(f"{seed}:{context_id}")
+    num_artists = max(1, num_tracks // tracks_per_artist)
+    artists = [{'id': make_id('artist', context_id, i), 'name': f"Artist {i}"} for i in range(num_artists)]
+    genres = {artist['id']: rng.sample(['pop', 'rock', 'indie', 'jazz', 'hip hop', 'folk', 'metal', 'electronic'], rng.randint(0, 2))
+              for artist in artists}
+
+    tracks = []
+    for i in range(num_tracks):
+        artist = artists[rng.randrange(num_artists)]
+        tracks.append({
+            'id': make_id('track', context_id, i),
+            'name': f"Track {i}",
+            'artists': [artist],
+            'album': {'name': f"Album {i // 10}", 'images': []},
+            'duration_ms': rng.randint(120000, 300000),
+            'popularity': rng.randint(0, 100)
+        })
+    return tracks, artists, genres
+
+# Shuffle algorithms, each takes the tracks to shuffle (not the one playing) and a Random
+def uniform_shuffle(tracks, rng, previous):
+    return rng.sample(tracks, len(tracks))
+
+def weighted_shuffle(tracks, rng, previous):
+    # popular tracks tend to come up first, like a "smart" shuffle
+    keyed = [(rng.random() ** (1 / (track['popularity'] + 1)), track) for track in tracks]
+    return [track for _, track in sorted(keyed, key=lambda item: item[0], reverse=True)]
+
+def artist_spread_shuffle(tracks, rng, previous):
+    # spread each artist's tracks evenly over the queue with a random offset
+    by_artist = {}
+    for track in tracks:
+        by_artist.setdefault(track['artists'][0]['id'], []).append(track)
+
+    positioned = []
+    for artist_tracks in by_artist.values():
+        rng.shuffle(artist_tracks)
+        spacing = 1 / len(artist_tracks)
+        offset = rng.random() * spacing
+        for i, track in enumerate(artist_tracks):
+            positioned.append((offset + i * spacing + rng.uniform(-0.1, 0.1) * spacing, track))
+    return [track for _, track in sorted(positioned, key=lambda item: item[0])]
+
+def sticky_shuffle(tracks, rng, previous):
+    # mostly keeps the previous order and swaps a few tracks, so patterns keep showing up
+    order = [track for track in previous if track in tracks] if previous else rng.sample(tracks, len(tracks))
+    for _ in range(max(1, len(order) // 10)):
+        i, j = rng.randrange(len(order)), rng.randrange(len(order))
+        order[i], order[j] = order[j], order[i]
+    return order
+
+SHUFFLE_ALGORITHMS = {
+    'uniform': uniform_shuffle,
+    'weighted': weighted_shuffle,
+    'artist_spread': artist_spread_shuffle,
+    'sticky': sticky_shuffle
+}
+
+class SimulatorConfig:
+    def __init__(self):
+        self.num_tracks = int(os.environ.get("SIM_TRACKS", 200))
+        self.num_contexts = int(os.environ.get("SIM_CONTEXTS", 1))
+        self.algorithm = os.environ.get("SIM_ALGORITHM", "uniform")
+        self.latency = float(os.environ.get("SIM_LATENCY_MS", 20)) / 1000
+        self.propagation_delay = float(os.environ.get("SIM_PROPAGATION_MS", 200)) / 1000
+        self.rate_limit_probability = float(os.environ.get("SIM_429_PROBABILITY", 0))
+        self.retry_after = float(os.environ.get("SIM_RETRY_AFTER", 1))
+        self.song_seconds = float(os.environ.get("SIM_SONG_SECONDS", 0)) # 0 never changes song
+        self.seed = int(os.environ.get("SIM_SEED", 0))
+
+config = SimulatorConfig()
+catalogs = {}
+catalogs_lock = threading.Lock()
+devices = {}
+devices_lock = threading.Lock()
+
+def get_catalog(context_id):
+    with catalogs_lock:
+        if context_id not in catalogs:
+            catalogs[context_id] = make_catalog(context_id, config.num_tracks, seed=config.seed)
+        return catalogs[context_id]
+
+# One simulated playback device per access token
+class SimulatedDevice:
+    def __init__(self, access_token):
+        self.rng = random.Random(f"{config.seed}:{access_token}")
+        self.context_id = f"sim{self.rng.randrange(config.num_contexts)}"
+        self.tracks, _, _ = get_catalog(self.context_id)
+
+        self.current_index = 0
+        self.song_started = time.monotonic()
+        self.shuffled = False
+        self.shuffled_order = []
+        # queue reads keep returning the old state until the change has propagated
+        self.pending_state = None
+        self.lock = threading.Lock()
+
+    def update(self):
+        now = time.monotonic()
+        if self.pending_state and now >= self.pending_state[0]:
+            _, self.shuffled, self.shuffled_order = self.pending_state
+            self.pending_state = None
+
+        if config.song_seconds and now - self.song_started >= config.song_seconds:
+            self.current_index = (self.current_index + 1) % len(self.tracks)
+            self.song_started = now
+
+    def set_shuffle(self, state):
+        with self.lock:
+            self.update()
+            order = self.shuffled_order
+            if state:
+                # every shuffle(True) deals a fresh order, just like the real thing
+                others = [track for track in self.tracks if track is not self.tracks[self.current_index]]
+                order = SHUFFLE_ALGORITHMS[config.algorithm](others, self.rng, self.shuffled_order)
+            self.pending_state = (time.monotonic() + config.propagation_delay, state, order)
+
+    def get_queue(self):
+        with self.lock:
+            self.update()
+            current = self.tracks[self.current_index]
+            if self.shuffled:
+                upcoming = self.shuffled_order[:QUEUE_SIZE]
+            else:
+                upcoming = [self.tracks[(self.current_index + i) % len(self.tracks)] for i in range(1, QUEUE_SIZE + 1)]
+            return current, upcoming
+
+    def next_track(self):
+        with self.lock:
+            self.update()
+            if self.shuffled and self.shuffled_order:
+                next_track = self.shuffled_order.pop(0)
+                self.current_index = self.tracks.index(next_track)
+            else:
+                self.current_index = (self.current_index + 1) % len(self.tracks)
+            self.song_started = time.monotonic()
+
+def get_device(access_token):
+    with devices_lock:
+        if access_token not in devices:
+            devices[access_token] = SimulatedDevice(access_token)
+        return devices[access_token]
+
+# Stand-in for the spotipy.Spotify calls the app makes
+class SimulatedSpotify:
+    def __init__(self, access_token, requests_session=None):
+        self.access_token = access_token
+        self.device = get_device(access_token)
+
+    def call(self):
+        time.sleep(config.latency * random.uniform(0.5, 1.5))
+        if config.rate_limit_probability and random.random() < config.rate_limit_probability:
+            raise spotipy.exceptions.SpotifyException(429, -1, "simulated rate limit",
+                                                      headers={'Retry-After': str(config.retry_after)})
+
+    def current_user(self):
+        self.call()
+        return {'id': make_id('user', self.access_token), 'display_name': f"Simulated user {self.access_token}"}
+
+    def current_playback(self):
+        self.call()
+        current, _ = self.device.get_queue()
+        context_id = self.device.context_id
+        return {'is_playing': True, 'item': current, 'context': {'type': 'playlist', 'uri': f"spotify:playlist:{context_id}"}}
+
+    def queue(self):
+        self.call()
+        current, upcoming = self.device.get_queue()
+        return {'currently_playing': current, 'queue': upcoming}
+
+    def shuffle(self, state):
+        self.call()
+        self.device.set_shuffle(state)
+
+    def next_track(self):
+        self.call()
+        self.device.next_track()
+
+    def playlist(self, playlist_id):
+        self.call()
+        tracks, _, _ = get_catalog(playlist_id)
+        return {'name': f"Simulated {playlist_id}", 'images': [], 'owner': {'display_name': 'simulator'}, 'tracks': {'total': len(tracks)}}
+
+    def album(self, album_id):
+        self.call()
+        return {'name': f"Simulated album {album_id}", 'images': [], 'artists': [], 'total_tracks': 0}
+
+    def artist(self, artist_id):
+        self.call()
+        return {'name': f"Simulated artist {artist_id}", 'images': []}
+
+    def artists(self, artist_ids):
+        self.call()
+        all_genres = {}
+        with catalogs_lock:
+            catalog_list = list(catalogs.values())
+        for _, _, genres in catalog_list:
+            all_genres.update(genres)
+        return {'artists': [{'id': artist_id, 'genres': all_genres.get(artist_id, [])} for artist_id in artist_ids]}
+
+def create_simulated_spotify(access_token, session):
+    return SimulatedSpotify(access_token, session)
+
+def install():
+    spotifyClient.spotify_factory = create_simulated_spotify
@@ -0,0 +1,121 @@
+import io
+import json
+
+import pytest
+
+import shuffleExport
+from shuffleStore import ShuffleStore, BATCH_SIZE
+
+USER_ID = "user"
+
+def make_store(tmp_path, name):
+    return ShuffleStore(str(tmp_path / f"{name}.db"))
+
+def add_samples(store, context_id, shuffles):
+    generation = store.get_user_state(USER_ID)[0]
+    for track_ids in shuffles:
+        store.append_sample(USER_ID, generation, context_id, [{'id': track_id} for track_id in track_ids])
+
+def export_lines(store):
+    return list(shuffleExport.export_ndjson(store, USER_ID))
+
+def stored_shuffles(store, context_id):
+    return [track_ids for _, track_ids in store.iter_shuffles(USER_ID, context_id)]
+
+def test_round_trip_keeps_identical_shuffles(tmp_path):
+    source = make_store(tmp_path, "source")
+    # the same order twice is two shuffles, not a duplicate
+    add_samples(source, "context", [["a", "b"], ["a", "b"], ["b", "a"]])
+    target = make_store(tmp_path, "target")
+
+    stats = shuffleExport.import_ndjson(target, USER_ID, export_lines(source))
+
+    assert stats['shuffles'] == 3
+    assert stats['duplicate_shuffles'] == 0
+    assert stored_shuffles(target, "context") == [["a", "b"], ["a", "b"], ["b", "a"]]
+    assert {track['id'] for track in target.iter_tracks()} == {"a", "b"}
+
+def test_importing_twice_skips_everything(tmp_path):
+    source = make_store(tmp_path, "source")
+    add_samples(source, "context", [["a", "b"], ["c", "d"]])
+    target = make_store(tmp_path, "target")
+    lines = export_lines(source)
+
+    shuffleExport.import_ndjson(target, USER_ID, lines)
+    stats = shuffleExport.import_ndjson(target, USER_ID, lines)
+
+    assert stats['shuffles'] == 0
+    assert stats['duplicate_shuffles'] == 2
+    assert len(stored_shuffles(target, "context")) == 2
+
+def test_shuffles_keep_their_origin_across_machines(tmp_path):
+    first = make_store(tmp_path, "first")
+    second = make_store(tmp_path, "second")
+    add_samples(first, "context", [["a", "b"]])
+    add_samples(second, "context", [["c", "d"]])
+
+    # second gets first's shuffle, then first gets everything second has, including its own shuffle back
+    shuffleExport.import_ndjson(second, USER_ID, export_lines(first))
+    stats = shuffleExport.import_ndjson(first, USER_ID, export_lines(second))
+
+    assert stats['shuffles'] == 1
+    assert stats['duplicate_shuffles'] == 1
+    assert stored_shuffles(first, "context") == [["a", "b"], ["c", "d"]]
+
+    # and a third machine merging both exports ends up with each shuffle once
+    third = make_store(tmp_path, "third")
+    shuffleExport.import_ndjson(third, USER_ID, export_lines(first))
+    stats = shuffleExport.import_ndjson(third, USER_ID, export_lines(second))
+    assert stats['duplicate_shuffles'] == 2
+    assert sorted(stored_shuffles(third, "context")) == [["a", "b"], ["c", "d"]]
+
+def test_import_keeps_samples_stored_in_between(tmp_path):
+    source = make_store(tmp_path, "source")
+    add_samples(source, "context", [["a", "b"]])
+    target = make_store(tmp_path, "target")
+    add_samples(target, "context", [["x", "y"]])
+
+    importer = shuffleExport.ShuffleImporter(target, USER_ID)
+    for line in export_lines(source):
+        importer.add_record(json.loads(line))
+    add_samples(target, "context", [["y", "x"]])
+    importer.finish()
+
+    assert stored_shuffles(target, "context") == [["x", "y"], ["y", "x"], ["a", "b"]]
+
+@pytest.mark.skipif(not shuffleExport.has_parquet_support(), reason="needs pyarrow")
+def test_parquet_round_trip(tmp_path):
+    source = make_store(tmp_path, "source")
+    add_samples(source, "context", [["a", "b"], ["a", "b"]])
+    target = make_store(tmp_path, "target")
+
+    archive = io.BytesIO()
+    shuffleExport.export_parquet_zip(source, USER_ID, archive, str(tmp_path / "export"))
+    for directory in ("first", "second"):
+        archive.seek(0)
+        stats = shuffleExport.import_parquet_zip(target, USER_ID, archive, str(tmp_path / directory))
+
+    assert stats['duplicate_shuffles'] == 2
+    assert stored_shuffles(target, "context") == [["a", "b"], ["a", "b"]]
+
+def test_bad_record_late_in_the_file_imports_nothing(tmp_path):
+    source = make_store(tmp_path, "source")
+    add_samples(source, "context", [["a", "b"], ["c", "d"]])
+    lines = export_lines(source)
+    header, shuffle = lines[0], json.loads(lines[-1])
+    # more shuffles than one batch, so some would have been written before the bad line is reached
+    shuffles = [json.dumps(dict(shuffle, source_shuffle_id=i)) + "\n" for i in range(BATCH_SIZE + 10)]
+
+    target = make_store(tmp_path, "target")
+    version = target.get_user_state(USER_ID)[2]
+    for bad_line in ("not json\n", json.dumps({'type': 'shuffle', 'context_id': "context"}) + "\n"):
+        with pytest.raises(ValueError):
+            shuffleExport.import_ndjson(target, USER_ID, [header] + shuffles + [bad_line])
+
+    assert stored_shuffles(target, "context") == []
+    # and a good file afterwards goes in whole, read back from a file the way an upload is
+    upload = io.BytesIO("".join([header] + shuffles).encode())
+    stats = shuffleExport.import_ndjson(target, USER_ID, upload)
+    assert stats['shuffles'] == BATCH_SIZE + 10
+    assert len(stored_shuffles(target, "context")) == BATCH_SIZE + 10
+    assert target.get_user_state(USER_ID)[2] > version
@@ -0,0 +1,47 @@
+import random
+
+from trackRanking import TrackRanking
+
+def make_ranking(plays):
+    ranking = TrackRanking()
+    for track_id in plays:
+        ranking.increment(track_id)
+    return ranking
+
+def test_pages_follow_frequency():
+    rng = random.Random(0)
+    plays = [f"track{int(rng.paretovariate(1.2)) % 300}" for _ in range(5000)]
+    ranking = make_ranking(plays)
+    counts = {track_id: plays.count(track_id) for track_id in set(plays)}
+
+    ranked = ranking.get_page(0, len(counts) + 10)
+    assert len(ranked) == len(ranking) == len(counts)
+    assert dict(ranked) == counts
+    assert [freq for _, freq in ranked] == sorted(counts.values(), reverse=True)
+
+    # pages line up with one long walk from any offset
+    for offset in (0, 1, 17, 150, len(counts) - 1, len(counts)):
+        assert ranking.get_page(offset, 25) == ranked[offset:offset + 25]
+
+def test_only_frequencies_with_tracks_are_linked():
+    ranking = make_ranking(["a"] * 5 + ["b"] * 2 + ["c"])
+
+    linked = []
+    freq = ranking.max_freq
+    while freq:
+        linked.append(freq)
+        freq = ranking.lower[freq]
+    assert linked == sorted(ranking.buckets, reverse=True) == [5, 2, 1]
+    assert ranking.min_freq == 1
+
+    # c catching up with b empties the bottom bucket
+    ranking.increment("c")
+    assert sorted(ranking.buckets) == [2, 5]
+    assert ranking.min_freq == 2
+    assert ranking.get_page(0, 3) == [("a", 5), ("b", 2), ("c", 2)]
+
+def test_empty_ranking():
+    ranking = TrackRanking()
+
+    assert ranking.get_page(0, 10) == []
+    assert list(ranking.iter_ranked()) == []
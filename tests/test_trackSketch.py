@@ -0,0 +1,29 @@
+from collections import deque
+
+from trackSketch import SketchRanking, PairSketch, get_sketch_settings
+
+def test_ranking_pages_only_through_top_k():
+    ranking = SketchRanking(get_sketch_settings({'top_k': 5}))
+    for i in range(50):
+        for _ in range(i + 1):
+            ranking.increment(f"track{i}")
+
+    assert len(ranking) == 5
+    assert [track_id for track_id, _ in ranking.get_page(0, 10)] == [f"track{i}" for i in range(49, 44, -1)]
+    assert abs(ranking.estimate_distinct() - 50) <= 2
+    assert ranking.get_frequency("track49") >= 50
+
+def test_tracks_without_an_id_are_skipped():
+    settings = get_sketch_settings()
+    ranking = SketchRanking(settings)
+    ranking.increment(None)
+    ranking.increment("a")
+
+    assert ranking.total_plays == 1
+    assert ranking.get_frequency(None) == 0
+    assert None not in ranking
+
+    pairs = PairSketch(settings)
+    for shuffleID in (1, 2):
+        pairs.addShuffleQueue(deque(["a", None, "b", "c"]), shuffleID)
+    assert list(pairs.allPatterns.values()) == [["b", "c"]]
@@ -0,0 +1,127 @@
+import random
+import tracemalloc
+from collections import deque
+
+import trackTrie
+from trackTrie import TrackTrie
+
+def build_trie(shuffles):
+    trie = TrackTrie()
+    for shuffleID, shuffle in enumerate(shuffles, 1):
+        trie.addShuffleQueue(deque(shuffle), shuffleID)
+    return trie
+
+def longest_shared_run(shuffle, other):
+    longest = 0
+    for i in range(len(shuffle)):
+        for j in range(len(other)):
+            length = 0
+            while i + length < len(shuffle) and j + length < len(other) and shuffle[i + length] == other[j + length]:
+                length += 1
+            longest = max(longest, length)
+    return longest if longest >= 2 else 0
+
+def shares_pair_with(track, shuffle, other):
+    pairs = {pair for pair in zip(other, other[1:]) if track in pair}
+    return any(pair in pairs for pair in zip(shuffle, shuffle[1:]))
+
+def is_run_of(pattern, shuffle):
+    return any(shuffle[i:i + len(pattern)] == pattern for i in range(len(shuffle)))
+
+def random_shuffles(num_shuffles, num_tracks, length, seed):
+    rng = random.Random(seed)
+    tracks = [f"track{i}" for i in range(num_tracks)]
+    return [rng.sample(tracks, length) for _ in range(num_shuffles)]
+
+def test_pattern_is_longest_run_shared_with_another_shuffle():
+    shuffles = random_shuffles(30, 25, 12, seed=1)
+    trie = build_trie(shuffles)
+
+    for shuffleID, shuffle in enumerate(shuffles, 1):
+        expected = max(longest_shared_run(shuffle, other) for j, other in enumerate(shuffles, 1) if j != shuffleID)
+        pattern = trie.allPatterns.get(shuffleID, [])
+        assert len(pattern) == expected
+        if pattern:
+            assert is_run_of(pattern, shuffle)
+            assert any(is_run_of(pattern, other) for j, other in enumerate(shuffles, 1) if j != shuffleID)
+
+def test_older_shuffles_pick_up_patterns_from_newer_ones():
+    trie = build_trie([["a", "b", "c", "d"], ["x", "b", "c", "y"], ["a", "b", "c", "d"]])
+
+    assert trie.allPatterns == {1: ["a", "b", "c", "d"], 2: ["b", "c"], 3: ["a", "b", "c", "d"]}
+
+def test_tracks_with_patterns_are_the_pattern_tracks():
+    shuffles = random_shuffles(20, 30, 10, seed=2)
+    trie = build_trie(shuffles)
+
+    pattern_tracks = {track for pattern in trie.allPatterns.values() for track in pattern}
+    # a shuffle can swap its pattern for a longer one, the tracks of the old one stay
+    assert pattern_tracks <= trie.getAllTracksWithPatterns()
+    # and nothing gets in that was never part of a shared run
+    for track in trie.getAllTracksWithPatterns():
+        assert any(shares_pair_with(track, shuffle, other)
+                   for i, shuffle in enumerate(shuffles) for other in shuffles[i + 1:])
+
+def test_no_pattern_without_a_repeated_pair():
+    trie = build_trie([["a", "b", "c"], ["c", "b", "a"], ["b", "d", "a"]])
+
+    assert trie.allPatterns == {}
+    assert trie.getAllTracksWithPatterns() == set()
+
+def test_queue_does_not_match_itself():
+    trie = build_trie([["a", "b", "a", "b"]])
+
+    assert trie.allPatterns == {}
+
+def test_pair_walk_is_capped(monkeypatch):
+    monkeypatch.setattr(trackTrie, 'MAX_PAIR_MATCHES', 4)
+    trie = TrackTrie()
+    visited = []
+    updatePattern = trie.updatePattern
+    def counting_update(slot, start, length):
+        visited.append(slot)
+        updatePattern(slot, start, length)
+    trie.updatePattern = counting_update
+
+    for shuffleID in range(1, 21):
+        visited.clear()
+        trie.addShuffleQueue(deque(["a", "b"]), shuffleID)
+
+    # the new shuffle and each of the 4 latest shuffles with the pair
+    assert len(visited) == 2 * 4
+    assert set(visited) == {19} | {15, 16, 17, 18}
+    assert trie.allPatterns[20] == ["a", "b"]
+
+def test_lookups():
+    trie = build_trie([["a", "b", "c"], ["d", "a", "b"], ["e", "f"]])
+
+    assert trie.getShuffleIDs("a") == [1, 2]
+    assert trie.getShuffleIDs("missing") == []
+    assert list(trie.getShuffleQueue(2, "a")) == ["d", "a", "b"]
+    assert list(trie.getShuffleQueue(3, "a")) == []
+    assert trie.findAllPatterns("a") == {1: ["a", "b"], 2: ["a", "b"]}
+    assert trie.getTrackOccurrences("b") == [(0, 1), (1, 5)]
+    assert trie.getShuffleOrder(1, 4, window=1) == (2, 1, 0, ["d", "a", "b"])
+
+def test_pair_table_grows_and_swaps():
+    table = trackTrie.PairTable(capacity=4)
+    for track in range(100):
+        assert table.swap(track, track + 1, track) == -1
+    assert table.swap(5, 6, 500) == 5
+
+    assert len(table) == 100
+    assert table.get(5, 6) == 500
+    assert table.get(99, 100) == 99
+    assert table.get(6, 5) == -1
+
+def test_memory_estimate_matches_allocations():
+    shuffles = random_shuffles(2000, 500, 20, seed=3)
+    # the ID strings belong to the caller
+    queues = [deque(shuffle) for shuffle in shuffles]
+
+    tracemalloc.start()
+    trie = build_trie(queues)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert abs(trie.estimateMemory() - allocated) < 0.05 * allocated
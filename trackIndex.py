@@ -0,0 +1,111 @@
+from trackRanking import TrackRanking
+
+GRAM_SIZE = 3
+
+class TrackSearchIndex:
+
+    def __init__(self):
+        # every 1 to GRAM_SIZE character chunk of a track or artist name -> track IDs containing it
+        self.postings = {}
+        # track ID -> lowercased track and artist names, used to confirm longer queries
+        self.searchable_names = {}
+
+    def add_track(self, track):
+        track_id = track.get('id')
+        if track_id in self.searchable_names:
+            return
+
+        names = [track.get('name', '').lower()]
+        names.extend(artist.get('name', '').lower() for artist in track.get('artists', []))
+        self.searchable_names[track_id] = names
+
+        for name in names:
+            for gram in self.get_grams(name, GRAM_SIZE):
+                self.postings.setdefault(gram, set()).add(track_id)
+
+    @staticmethod
+    def get_grams(text, max_size):
+        grams = set()
+        for size in range(1, max_size + 1):
+            for i in range(len(text) - size + 1):
+                grams.add(text[i:i + size])
+        return grams
+
+    def search(self, query):
+        query = query.lower()
+        if not query:
+            return set()
+
+        # short queries are indexed directly
+        if len(query) <= GRAM_SIZE:
+            return self.postings.get(query, set())
+
+        # a track can only match if it has every gram of the query, start from the rarest one
+        grams = {query[i:i + GRAM_SIZE] for i in range(len(query) - GRAM_SIZE + 1)}
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        candidates = postings[0].intersection(*postings[1:])
+
+        return {track_id for track_id in candidates
+                if any(query in name for name in self.searchable_names[track_id])}
+
+    def __len__(self):
+        return len(self.searchable_names)
+
+class ArtistGenreIndex:
+
+    def __init__(self, artist_genres):
+        # artist ID -> track IDs by that artist (dicts keep the order tracks were stored in)
+        self.artist_tracks = {}
+        # genre -> track IDs with at least one artist in that genre
+        self.genre_tracks = {}
+        # where genres are looked up from, anything with .get(artist_id, default)
+        self.artist_genres = artist_genres
+
+    def add_track(self, track):
+        track_id = track.get('id')
+
+        for artist in track.get('artists', []):
+            self.artist_tracks.setdefault(artist['id'], {})[track_id] = None
+
+            for genre in self.artist_genres.get(artist['id'], []):
+                self.genre_tracks.setdefault(genre, {})[track_id] = None
+
+    def add_artist_genres(self, artist_id, genres):
+        # genres can show up after the artist's tracks were already stored
+        for genre in genres:
+            genre_tracks = self.genre_tracks.setdefault(genre, {})
+            for track_id in self.artist_tracks.get(artist_id, {}):
+                genre_tracks[track_id] = None
+
+    def get_tracks_by_artist(self, artist_id):
+        return self.artist_tracks.get(artist_id, {})
+
+    def get_tracks_by_genres(self, genres):
+        track_ids = {}
+        for genre in genres:
+            track_ids.update(self.genre_tracks.get(genre, {}))
+        return track_ids
+
+# One user's tracks across all of their contexts, kept up to date as each context takes in a shuffle
+class MasterTrackIndex:
+
+    def __init__(self):
+        # plays of each track summed over every context, ranked the same way a single context's are
+        self.track_ranking = TrackRanking()
+        # track ID -> context IDs it was played in, and the ones it's part of a pattern in
+        self.track_contexts = {}
+        self.pattern_contexts = {}
+
+    def add_track_play(self, track_id, context_id):
+        self.track_ranking.increment(track_id)
+        self.track_contexts.setdefault(track_id, {})[context_id] = None
+
+    def add_pattern_tracks(self, track_ids, context_id):
+        for track_id in track_ids:
+            self.pattern_contexts.setdefault(track_id, {})[context_id] = None
+
+    def get_contexts(self, track_id):
+        return self.track_contexts.get(track_id, {})
+
+    def get_pattern_contexts(self, track_id):
+        return self.pattern_contexts.get(track_id, {})
@@ -0,0 +1,96 @@
+from itertools import islice
+
+class TrackRanking:
+
+    def __init__(self):
+        self.track_freq = {}
+        # frequency -> tracks currently at that frequency (dicts keep the order they got there)
+        self.buckets = {}
+        # the frequencies with a bucket, linked highest to lowest so iter_ranked never looks at an empty one
+        #     lower/higher: frequency -> next frequency down/up with a bucket, 0 at either end
+        self.lower = {}
+        self.higher = {}
+        self.max_freq = 0
+        self.min_freq = 0
+        self.total_plays = 0
+
+    def link(self, freq, below, above):
+        self.lower[freq] = below
+        self.higher[freq] = above
+        if below:
+            self.higher[below] = freq
+        else:
+            self.min_freq = freq
+        if above:
+            self.lower[above] = freq
+        else:
+            self.max_freq = freq
+
+    def unlink(self, freq):
+        below, above = self.lower.pop(freq), self.higher.pop(freq)
+        if below:
+            self.higher[below] = above
+        else:
+            self.min_freq = above
+        if above:
+            self.lower[above] = below
+        else:
+            self.max_freq = below
+
+    def increment(self, track_id):
+        freq = self.track_freq.get(track_id, 0)
+
+        # the next bucket up goes right above this one, or at the bottom for a new track
+        if freq + 1 not in self.buckets:
+            if freq > 0:
+                self.link(freq + 1, freq, self.higher[freq])
+            else:
+                self.link(1, 0, self.min_freq)
+            self.buckets[freq + 1] = {}
+
+        # move the track up into the next bucket
+        if freq > 0:
+            bucket = self.buckets[freq]
+            del bucket[track_id]
+            if not bucket:
+                del self.buckets[freq]
+                self.unlink(freq)
+
+        freq += 1
+        self.track_freq[track_id] = freq
+        self.buckets[freq][track_id] = None
+        self.total_plays += 1
+
+    def get_frequency(self, track_id):
+        return self.track_freq.get(track_id, 0)
+
+    def iter_ranked(self, offset=0):
+        # walk the buckets from the highest frequency down, skipping whole buckets for the offset
+        freq = self.max_freq
+        while freq:
+            bucket = self.buckets[freq]
+            if offset >= len(bucket):
+                offset -= len(bucket)
+            else:
+                for track_id in islice(bucket, offset, None):
+                    yield track_id, freq
+                offset = 0
+            freq = self.lower[freq]
+
+    def get_page(self, offset, limit):
+        page = []
+        if limit <= 0:
+            return page
+
+        for track_id, freq in self.iter_ranked(offset):
+            page.append((track_id, freq))
+            if len(page) >= limit:
+                break
+
+        return page
+
+    def __len__(self):
+        return len(self.track_freq)
+
+    def __contains__(self, track_id):
+        return track_id in self.track_freq
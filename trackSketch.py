@@ -0,0 +1,237 @@
+import hashlib
+import heapq
+import math
+import os
+import sys
+from array import array
+import numpy as np
+
+# Default error bounds for contexts in streaming mode, each can be overridden per context
+DEFAULT_SKETCH_SETTINGS = {
+    'epsilon': float(os.environ.get("SKETCH_EPSILON", 0.001)), # frequencies are overcounted by at most epsilon * total plays...
+    'delta': float(os.environ.get("SKETCH_DELTA", 0.01)), # ...except with probability delta
+    'distinct_error': float(os.environ.get("SKETCH_DISTINCT_ERROR", 0.02)), # relative standard error of the distinct track count
+    'top_k': int(os.environ.get("SKETCH_TOP_K", 500)) # how many of the most played tracks (and track pairs) are ranked
+}
+MAX_TOP_K = 10000
+MIN_DISTINCT_ERROR = 0.002 # 2^18 registers
+
+# Fills in the defaults for anything values (any mapping, e.g. request args) leaves out, ValueError if a setting is out of range
+def get_sketch_settings(values=None):
+    settings = {}
+    for name, default in DEFAULT_SKETCH_SETTINGS.items():
+        value = (values or {}).get(name)
+        settings[name] = type(default)(value) if value is not None else default
+
+    if not 0 < settings['epsilon'] < 1 or not 0 < settings['delta'] < 1:
+        raise ValueError("epsilon and delta have to be between 0 and 1")
+    if not MIN_DISTINCT_ERROR <= settings['distinct_error'] < 1:
+        raise ValueError(f"distinct_error has to be between {MIN_DISTINCT_ERROR} and 1")
+    if not 1 <= settings['top_k'] <= MAX_TOP_K:
+        raise ValueError(f"top_k has to be between 1 and {MAX_TOP_K}")
+    return settings
+
+# 64 bits that don't change between runs, unlike hash(). Tracks without an ID (local files) never get
+# this far, the sketches skip them
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+
+class CountMinSketch:
+
+    def __init__(self, epsilon, delta):
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        # the rows one after another
+        self.table = array('q', bytes(8 * self.depth * self.width))
+
+    def get_cells(self, key_hash):
+        # one hash split in two stands in for depth independent ones
+        first, second = key_hash & 0xFFFFFFFF, (key_hash >> 32) | 1
+        return [row * self.width + (first + row * second) % self.width for row in range(self.depth)]
+
+    # Conservative update, only the cells that are at the estimate go up, which keeps collisions from
+    # adding up as fast. Returns the new estimate
+    def add(self, key_hash, count=1):
+        table = self.table
+        cells = self.get_cells(key_hash)
+        estimate = min(table[cell] for cell in cells) + count
+        for cell in cells:
+            if table[cell] < estimate:
+                table[cell] = estimate
+        return estimate
+
+    def estimate(self, key_hash):
+        table = self.table
+        return min(table[cell] for cell in self.get_cells(key_hash))
+
+    def estimate_memory(self):
+        return self.table.buffer_info()[1] * self.table.itemsize
+
+class HyperLogLog:
+
+    def __init__(self, error):
+        self.precision = min(18, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+        self.num_registers = 1 << self.precision
+        self.registers = bytearray(self.num_registers)
+
+    def add(self, key_hash):
+        register = key_hash >> (64 - self.precision)
+        rest = key_hash & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self):
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        registers = np.frombuffer(self.registers, dtype=np.uint8)
+        estimate = alpha * m * m / float(np.ldexp(1.0, -registers.astype(np.int64)).sum())
+
+        # small counts are better served by how many registers are still empty
+        zeros = int((registers == 0).sum())
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def estimate_memory(self):
+        return len(self.registers)
+
+# The capacity keys with the highest estimates seen so far, the smallest is found through a heap
+# that's rebuilt now and then instead of updated in place
+class HeavyHitters:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []
+
+    # returns (key, count) of whatever got pushed out to make room, if anything did
+    def offer(self, key, estimate):
+        if key in self.counts or len(self.counts) < self.capacity:
+            self.counts[key] = estimate
+            self.push(key, estimate)
+            return None
+
+        smallest = self.get_smallest()
+        if estimate <= smallest[1]:
+            return None
+
+        del self.counts[smallest[0]]
+        self.counts[key] = estimate
+        self.push(key, estimate)
+        return smallest
+
+    def push(self, key, estimate):
+        heapq.heappush(self.heap, (estimate, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def get_smallest(self):
+        # entries whose count has gone up since are stale
+        while self.heap[0][1] not in self.counts or self.counts[self.heap[0][1]] != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][1], self.heap[0][0]
+
+    def get_ranked(self):
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+
+    def estimate_memory(self):
+        return sys.getsizeof(self.counts) + sys.getsizeof(self.heap)
+
+# Stands in for a TrackRanking in streaming mode, in fixed memory: frequencies are Count-Min estimates,
+# only the top_k tracks are ranked and the number of distinct tracks comes from a HyperLogLog
+class SketchRanking:
+
+    def __init__(self, settings):
+        self.frequencies = CountMinSketch(settings['epsilon'], settings['delta'])
+        self.top_tracks = HeavyHitters(settings['top_k'])
+        self.distinct_tracks = HyperLogLog(settings['distinct_error'])
+        self.epsilon = settings['epsilon']
+        self.total_plays = 0
+
+    @property
+    def track_freq(self):
+        return self.top_tracks.counts
+
+    def increment(self, track_id):
+        if track_id is None:
+            return
+        key_hash = hash_key(track_id)
+        self.top_tracks.offer(track_id, self.frequencies.add(key_hash))
+        self.distinct_tracks.add(key_hash)
+        self.total_plays += 1
+
+    def get_frequency(self, track_id):
+        if track_id is None:
+            return 0
+        return self.frequencies.estimate(hash_key(track_id))
+
+    def get_page(self, offset, limit):
+        if limit <= 0:
+            return []
+        return self.top_tracks.get_ranked()[offset:offset + limit]
+
+    def get_error_bound(self):
+        return self.epsilon * self.total_plays
+
+    def estimate_memory(self):
+        return self.frequencies.estimate_memory() + self.top_tracks.estimate_memory() + self.distinct_tracks.estimate_memory()
+
+    def estimate_distinct(self):
+        return self.distinct_tracks.count()
+
+    # only the top_k tracks can be paged through, so that's how many there are as far as paging goes
+    def __len__(self):
+        return len(self.top_tracks.counts)
+
+    def __contains__(self, track_id):
+        return self.get_frequency(track_id) > 0
+
+# Stands in for a TrackTrie in streaming mode. No shuffle is kept, just Count-Min estimates of how often
+# each pair of tracks came up back to back. The top_k pairs seen more than once are the patterns
+class PairSketch:
+
+    def __init__(self, settings):
+        self.pairCounts = CountMinSketch(settings['epsilon'], settings['delta'])
+        self.topPairs = HeavyHitters(settings['top_k'])
+        # track ID -> how many of the top pairs with a pattern it's in
+        self.patternTracks = {}
+        self.numShuffles = 0
+
+    def addShuffleQueue(self, q, shuffleID):
+        tracks = list(q)
+        for pair in zip(tracks, tracks[1:]):
+            if None in pair:
+                continue
+            before = self.topPairs.counts.get(pair, 0)
+            estimate = self.pairCounts.add(hash_key(f"{pair[0]}>{pair[1]}"))
+
+            evicted = self.topPairs.offer(pair, estimate)
+            if evicted is not None and evicted[1] >= 2:
+                self.updatePatternTracks(evicted[0], -1)
+            if pair in self.topPairs.counts and before < 2 <= estimate:
+                self.updatePatternTracks(pair, 1)
+
+        self.numShuffles = max(self.numShuffles, shuffleID)
+
+    def updatePatternTracks(self, pair, change):
+        for trackID in pair:
+            count = self.patternTracks.get(trackID, 0) + change
+            if count > 0:
+                self.patternTracks[trackID] = count
+            else:
+                self.patternTracks.pop(trackID, None)
+
+    def getAllTracksWithPatterns(self):
+        return self.patternTracks
+
+    @property
+    def allPatterns(self):
+        return {index: list(pair) for index, (pair, count) in enumerate(self.topPairs.get_ranked()) if count >= 2}
+
+    def findAllPatterns(self, trackID):
+        return {index: pattern for index, pattern in self.allPatterns.items() if trackID in pattern}
+
+    def estimateMemory(self):
+        return self.pairCounts.estimate_memory() + self.topPairs.estimate_memory() + sys.getsizeof(self.patternTracks)
@@ -1,165 +1,287 @@
+import sys
+from array import array
+from bisect import bisect_right
 from collections import deque
 
-class trackNode:
-
-    def __init__(self):
-        self.next = {}
-        self.prev = {}
-
-    def __str__(self):
-        return f"Node(Prev: {self.prev}, Next: {self.next})"
+# how many of a pair's latest earlier occurrences a new queue is compared against, on small contexts every pair
+# comes up in most shuffles and walking all of them would make each ingest cost grow with the history
+MAX_PAIR_MATCHES = 64
+
+# Open addressing hash table of (track, next track) -> latest occurrence of that pair, in two arrays.
+# A dict would need a key object for every pair, and track << 32 | next track doesn't fit in a small int
+class PairTable:
+
+    def __init__(self, capacity=1024):
+        self.keys = array('q', [-1]) * capacity
+        self.values = array('i', bytes(4 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+
+    def findSlot(self, key, track, nextTrack):
+        keys = self.keys
+        mask = self.mask
+        # the track indexes are dense, so multiplying by odd constants spreads them well enough
+        slot = (track * 0x9E3779B1 + nextTrack * 0x85EBCA77) & mask
+        while True:
+            found = keys[slot]
+            if found == key or found == -1:
+                return slot
+            slot = (slot + 1) & mask
+
+    def get(self, track, nextTrack):
+        key = track << 32 | nextTrack
+        slot = self.findSlot(key, track, nextTrack)
+        return self.values[slot] if self.keys[slot] == key else -1
+
+    # sets the pair's occurrence and returns the one it replaced, -1 if it's new
+    def swap(self, track, nextTrack, value):
+        key = track << 32 | nextTrack
+        slot = self.findSlot(key, track, nextTrack)
+        if self.keys[slot] == key:
+            previous = self.values[slot]
+        else:
+            # kept at most half full so probes stay short
+            if 2 * (self.size + 1) > len(self.keys):
+                self.grow()
+                slot = self.findSlot(key, track, nextTrack)
+            self.keys[slot] = key
+            self.size += 1
+            previous = -1
+        self.values[slot] = value
+        return previous
+
+    def grow(self):
+        keys, values = self.keys, self.values
+        self.keys = array('q', [-1]) * (2 * len(keys))
+        self.values = array('i', bytes(4 * len(self.keys)))
+        self.mask = len(self.keys) - 1
+        for key, value in zip(keys, values):
+            if key != -1:
+                slot = self.findSlot(key, key >> 32, key & 0xFFFFFFFF)
+                self.keys[slot] = key
+                self.values[slot] = value
+
+    def estimateMemory(self):
+        return sys.getsizeof(self.keys) + sys.getsizeof(self.values)
+
+    def __len__(self):
+        return self.size
 
 class TrackTrie:
 
     def __init__(self):
-        self.trackNodes = {}
+        # Spotify IDs are interned to dense ints, trackIDs[i] is the Spotify ID for i
+        self.trackIDs = []
+        self.trackIndexes = {}
         self.numShuffles = 0
-        self.allPatterns = {}
+
+        # every shuffle is stored back to back in one array, a position in it is an "occurrence"
+        self.allTracks = array('i')
+        # slot -> first occurrence of that shuffle, and shuffleID -> slot
+        self.shuffleStarts = array('i')
+        self.shuffleIDs = array('i')
+        self.shuffleSlots = {}
+
+        # linked lists threaded through the occurrences, -1 is the end of a list
+        #     nextSameTrack: previous occurrence of the same track
+        #     nextSamePair: previous occurrence of the same (track, next track) pair
+        self.nextSameTrack = array('i')
+        self.nextSamePair = array('i')
+        self.trackHeads = array('i')
+        # (track << 32 | next track) -> latest occurrence of that pair
+        self.pairHeads = PairTable()
+
+        # slot -> longest run (first occurrence, length) the shuffle shares with any other shuffle
+        self.patternStarts = array('i')
+        self.patternLengths = array('i')
         self.allTracksWithPatterns = set()
 
-    def addTrack(self, trackID, nextID, prevID, shuffleID):
-        if trackID not in self.trackNodes:
-            self.trackNodes[trackID] = trackNode()
+    def internTrack(self, trackID):
+        index = self.trackIndexes.get(trackID)
+        if index is None:
+            index = self.trackIndexes[trackID] = len(self.trackIDs)
+            self.trackIDs.append(trackID)
+            self.trackHeads.append(-1)
+        return index
 
-        self.trackNodes[trackID].next[shuffleID] = nextID
-        self.trackNodes[trackID].prev[shuffleID] = prevID
+    def getSlotBounds(self, slot):
+        start = self.shuffleStarts[slot]
+        end = self.shuffleStarts[slot + 1] if slot + 1 < len(self.shuffleStarts) else len(self.allTracks)
+        return start, end
 
-        self.numShuffles = max(self.numShuffles, shuffleID)
+    def getSlot(self, occurrence):
+        return bisect_right(self.shuffleStarts, occurrence) - 1
+
+    def getPattern(self, slot):
+        start = self.patternStarts[slot]
+        return [self.trackIDs[t] for t in self.allTracks[start:start + self.patternLengths[slot]]]
+
+    @property
+    def allPatterns(self):
+        return {self.shuffleIDs[slot]: self.getPattern(slot)
+                for slot in range(len(self.shuffleIDs)) if self.patternLengths[slot] > 0}
 
     def getAllPatterns(self, shuffleIDs):
         res = []
 
         for shuffleID in shuffleIDs:
-            if shuffleID in self.allPatterns:
-                res.append(self.allPatterns[shuffleID])
-                
+            slot = self.shuffleSlots.get(shuffleID)
+            if slot is not None and self.patternLengths[slot] > 0:
+                res.append(self.getPattern(slot))
+
         return res
 
     def getAllTracksWithPatterns(self):
         return self.allTracksWithPatterns
-        
+
     def findAllPatterns(self, trackID):
-        getPrevTrack = lambda curTrackID, shuffleID: self.trackNodes[curTrackID].prev.get(shuffleID, "")
-        getNextTrack = lambda curTrackID, shuffleID: self.trackNodes[curTrackID].next.get(shuffleID, "")
+        # patterns are kept up to date as queues come in, so this is just a lookup
+        return {shuffleID: self.getPattern(self.shuffleSlots[shuffleID])
+                for shuffleID in self.getShuffleIDs(trackID)
+                if self.patternLengths[self.shuffleSlots[shuffleID]] > 0}
+
+    def updatePattern(self, slot, start, length):
+        # each shuffle keeps the longest run it shares with any other shuffle
+        previous = self.patternLengths[slot]
+        if length > previous:
+            # a run that's just grown by a track only adds that track
+            added = start + previous if start == self.patternStarts[slot] else start
+            self.patternStarts[slot] = start
+            self.patternLengths[slot] = length
+            # Helps in finding songs with patterns from the frontend
+            self.allTracksWithPatterns.update(self.trackIDs[t] for t in self.allTracks[added:start + length])
 
-        addToPatternPrev = lambda currentPattern, curTrackID: currentPattern.appendleft(curTrackID)
-        addToPatternNext = lambda currentPattern, curTrackID: currentPattern.append(curTrackID)
+    def findNewPatterns(self, tracks, base, slot):
+        # runs that matched up to the previous pair, occurrence in the other shuffle -> start index in tracks
+        activeRuns = {}
 
-        # both prev and next will share the same IDs since they're populated at the same time
-        shuffleIDs = self.getShuffleIDs(trackID)
-        
-        prevPatterns = self.findPatterns(trackID, getPrevTrack, addToPatternPrev, shuffleIDs)
-        nextPatterns = self.findPatterns(trackID, getNextTrack, addToPatternNext, shuffleIDs)
+        for i in range(len(tracks) - 1):
+            nextRuns = {}
 
-        for shuffleID in shuffleIDs:
-            prev = list(prevPatterns.get(shuffleID, []))[:-1]
-            next = list(nextPatterns.get(shuffleID, []))
-            self.allPatterns[shuffleID] = prev + next
+            # only occurrences of this exact pair can be part of a pattern here, newest first
+            occurrence = self.pairHeads.get(tracks[i], tracks[i + 1])
+            while occurrence != -1 and len(nextRuns) < MAX_PAIR_MATCHES:
+                start = activeRuns.get(occurrence - 1, i)
+                nextRuns[occurrence] = start
 
-            # Helps in finding songs with patterns from the frontend
-            if len(self.allPatterns[shuffleID]) > 1:
-                for patternTrackID in self.allPatterns[shuffleID]:
-                    self.allTracksWithPatterns.add(patternTrackID)
-
-        return self.allPatterns
-        
-    def findPatterns(self, trackID, getNextTrack, addToPattern, shuffleIDs):
-        shuffleIDToPattern = {}
-
-        self.findPatternsHelper(shuffleIDs, 
-                                trackID, 
-                                deque(), 
-                                shuffleIDToPattern, 
-                                getNextTrack, 
-                                addToPattern)
-        
-        return shuffleIDToPattern
-    
-    def findPatternsHelper(self, shuffleIDs, curTrackID, currentPattern, shuffleIDToPattern, getNextTrack, addToPattern):
-        # Base case, no more matches in this shuffleID
-        if len(shuffleIDs) == 1:
-            return
-        
-        # we got here, so at least 2 tracks match, which is a pattern!
-        addToPattern(currentPattern, curTrackID)
+                length = i + 2 - start
+                self.updatePattern(slot, base + start, length)
+                self.updatePattern(self.getSlot(occurrence), occurrence - (i - start), length)
 
-        trackIDToShuffleID = {}
+                occurrence = self.nextSamePair[occurrence]
 
-        for shuffleID in shuffleIDs:
-            # update the best pattern in this specific shuffle ID
-            shuffleIDToPattern[shuffleID] = currentPattern
-
-            # get the next track to look at in this specific shuffle
-            nextTrack = getNextTrack(curTrackID, shuffleID)
-            
-            # means we got to the end of the queue, so nothing more to do
-            if nextTrack == "":
-                continue
-            
-            if nextTrack not in trackIDToShuffleID:
-                trackIDToShuffleID[nextTrack] = []
-                
-            trackIDToShuffleID[nextTrack].append(shuffleID)
-
-        # spawn recursive calls for the current patterns
-        for trackID, shuffleIDs in trackIDToShuffleID.items():
-            self.findPatternsHelper(shuffleIDs, 
-                                    trackID, 
-                                    deque(currentPattern), 
-                                    shuffleIDToPattern, 
-                                    getNextTrack, 
-                                    addToPattern)
+            activeRuns = nextRuns
+
+    def indexPairs(self, tracks, base):
+        for i in range(len(tracks) - 1):
+            self.nextSamePair.append(self.pairHeads.swap(tracks[i], tracks[i + 1], base + i))
+
+        # the last track doesn't start a pair
+        self.nextSamePair.append(-1)
 
     def addShuffleQueue(self, q:deque, shuffleID):
         if len(q) == 0:
             return
-        
-        trackIDs = list(q)
-        
-        prev = ""
-        cur = q.popleft()
 
-        while len(q) > 0:
-            next = q.popleft()
-            self.addTrack(cur, next, prev, shuffleID)
+        tracks = [self.internTrack(trackID) for trackID in q]
+        base = len(self.allTracks)
+        slot = len(self.shuffleStarts)
 
-            prev = cur
-            cur = next
+        self.shuffleSlots[shuffleID] = slot
+        self.shuffleIDs.append(shuffleID)
+        self.shuffleStarts.append(base)
+        self.patternStarts.append(0)
+        self.patternLengths.append(0)
+        self.numShuffles = max(self.numShuffles, shuffleID)
 
-        self.addTrack(cur, "", prev, shuffleID)
+        for occurrence, track in enumerate(tracks, base):
+            self.nextSameTrack.append(self.trackHeads[track])
+            self.trackHeads[track] = occurrence
 
-        # only need to check a third of the tracks since each track searches left and right of themselves
-        for i in range(0, len(trackIDs) - 1, 3):
-            self.findAllPatterns(trackIDs[i])
+        # compare against what's already indexed first so the queue doesn't match itself
+        self.allTracks.extend(tracks)
+        self.findNewPatterns(tracks, base, slot)
+        self.indexPairs(tracks, base)
 
     def getShuffleQueue(self, shuffleID, trackID):
-        q = deque()
-
-        # get everything before the selected track
-        cur = trackID
-        while cur != "":
-            q.appendleft(cur)
-            cur = self.trackNodes[cur].prev.get(shuffleID, "")
-
-        # get everything after the selected track
-        cur = self.trackNodes[trackID].next.get(shuffleID, "")
-        while cur != "":
-            q.append(cur)
-            cur = self.trackNodes[cur].next.get(shuffleID, "")
-
-        return q
-    
+        slot = self.shuffleSlots.get(shuffleID)
+        index = self.trackIndexes.get(trackID)
+        if slot is None or index is None:
+            return deque()
+
+        start, end = self.getSlotBounds(slot)
+        shuffle = self.allTracks[start:end]
+        if index not in shuffle:
+            return deque()
+
+        return deque(self.trackIDs[t] for t in shuffle)
+
+    # (slot, first occurrence of the track) for each shuffle it's in, oldest shuffle first,
+    # optionally only for the given shuffles
+    def getTrackOccurrences(self, trackID, shuffleIDs=None):
+        index = self.trackIndexes.get(trackID)
+        if index is None:
+            return []
+
+        occurrences = {}
+        occurrence = self.trackHeads[index]
+        while occurrence != -1:
+            # the list runs newest first, so the last one seen for a slot is its first occurrence
+            occurrences[self.getSlot(occurrence)] = occurrence
+            occurrence = self.nextSameTrack[occurrence]
+
+        slots = sorted(occurrences)
+        if shuffleIDs is not None:
+            wanted = {self.shuffleSlots[shuffleID] for shuffleID in shuffleIDs if shuffleID in self.shuffleSlots}
+            slots = [slot for slot in slots if slot in wanted]
+        return [(slot, occurrences[slot]) for slot in slots]
+
+    # A shuffle order straight out of allTracks, cut down to window tracks either side of the occurrence
+    # when a window is given. Returns (shuffleID, position of the track, first position, track IDs)
+    def getShuffleOrder(self, slot, occurrence, window=None):
+        start, end = self.getSlotBounds(slot)
+        shuffleStart = start
+        if window is not None:
+            start, end = max(start, occurrence - window), min(end, occurrence + window + 1)
+
+        return (self.shuffleIDs[slot], occurrence - shuffleStart, start - shuffleStart,
+                [self.trackIDs[t] for t in self.allTracks[start:end]])
+
     def getShuffleIDs(self, trackID):
-        return [key for key in self.trackNodes[trackID].prev]
+        index = self.trackIndexes.get(trackID)
+        if index is None:
+            return []
+
+        # the list runs newest first, a track can be queued twice in the same shuffle
+        slots = []
+        occurrence = self.trackHeads[index]
+        while occurrence != -1:
+            slot = self.getSlot(occurrence)
+            if not slots or slots[-1] != slot:
+                slots.append(slot)
+            occurrence = self.nextSameTrack[occurrence]
+
+        return [self.shuffleIDs[slot] for slot in reversed(slots)]
+
+    # Bytes held by the trie, the ID strings aren't counted since the rest of the app holds them too
+    def estimateMemory(self):
+        arrays = (self.allTracks, self.shuffleStarts, self.shuffleIDs, self.nextSameTrack, self.nextSamePair,
+                  self.trackHeads, self.patternStarts, self.patternLengths)
+        containers = (self.trackIDs, self.trackIndexes, self.shuffleSlots, self.allTracksWithPatterns)
+        # ints past 256 are objects of their own: the track indexes, and the shuffle IDs and slots
+        numInts = max(0, len(self.trackIDs) - 257) + 2 * max(0, len(self.shuffleSlots) - 257)
+        return (sum(sys.getsizeof(a) for a in arrays) + sum(sys.getsizeof(c) for c in containers) +
+                self.pairHeads.estimateMemory() + numInts * sys.getsizeof(1 << 20))
 
     def __str__(self):
-        if not self.trackNodes:
+        if not self.shuffleSlots:
             return "Track Map is empty."
 
         map_string_parts = ["--- Track Map State ---"]
-        for trackID, node in self.trackNodes.items():
-            map_string_parts.append(f"TrackID: {trackID}")
-            map_string_parts.append(f"  {node}") 
+        for slot, shuffleID in enumerate(self.shuffleIDs):
+            start, end = self.getSlotBounds(slot)
+            map_string_parts.append(f"ShuffleID: {shuffleID}")
+            map_string_parts.append(f"  {[self.trackIDs[t] for t in self.allTracks[start:end]]}")
             map_string_parts.append("-" * 20)
         map_string_parts.append("-----------------------")
         map_string_parts.append("All trackIDs with patterns")
@@ -177,15 +299,11 @@ if __name__=="__main__":
     print(tracks.getShuffleQueue(4, "B"))
     print(tracks)
     print(str(tracks.allPatterns))
-    
-# Do each side separate
-    # go left
-    #     each shuffle index keeps track of their best and how many matched
-    # go right
-    #     each shuffle index keeps track of their best and how many matched
-    # combine the left and right for each shuffle
-
-
-# we get a new shuffle queue
-    # need to find and store all of it's patterns
-    # don't need to redo work that was already done, so check the
\ No newline at end of file
+
+# A pattern is a run of 2+ tracks that shows up in the same order in more than one shuffle
+    # every adjacent pair of every shuffle is indexed
+    # a new queue only looks up its own pairs, and at most MAX_PAIR_MATCHES earlier occurrences of each,
+    # so the work per queue doesn't grow with the number of shuffles
+    #     consecutive pair matches against the same shuffle get chained into a longer run
+    #     each shuffle keeps the longest run it shares with any other shuffle it was compared against
+    #     allTracksWithPatterns is every track that's been in one of those runs
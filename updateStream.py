@@ -0,0 +1,67 @@
+import json
+import queue
+import threading
+
+MAX_PENDING_UPDATES = 100 # a viewer this far behind just gets a fresh snapshot instead
+STATUS_CHECK_INTERVAL = 1.0 # how often an idle stream checks on the sampler
+KEEPALIVE_INTERVAL = 15.0 # comment lines so proxies don't close an idle stream
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def format_keepalive():
+    return ": keepalive\n\n"
+
+class UpdateSubscription:
+    def __init__(self, key):
+        self.key = key
+        self.updates = queue.Queue(maxsize=MAX_PENDING_UPDATES)
+        self.needs_snapshot = False
+
+    def get(self, timeout):
+        try:
+            return self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+# Fans the deltas for each key (a user's context) out to every stream watching it
+class UpdateBroadcaster:
+    def __init__(self):
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, key):
+        subscription = UpdateSubscription(key)
+        with self.lock:
+            self.subscriptions.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.key)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.key]
+
+    # lets the ingest path skip building a delta nobody is going to see
+    def has_subscribers(self, key):
+        return key in self.subscriptions
+
+    def publish(self, key, update):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(key, ()))
+
+        for subscription in subscriptions:
+            try:
+                subscription.updates.put_nowait(update)
+            except queue.Full:
+                subscription.needs_snapshot = True
+
+    def clear(self, matches=None):
+        # every open stream (or just those whose key matches) starts over from a snapshot of the (now empty) data
+        with self.lock:
+            subscriptions = [subscription for key, subscriptions in self.subscriptions.items()
+                             if matches is None or matches(key) for subscription in subscriptions]
+        for subscription in subscriptions:
+            subscription.needs_snapshot = True
@@ -0,0 +1,7 @@
+# Entry point for running under a WSGI server with several worker processes, e.g.
+#   gunicorn --workers 4 --threads 8 --worker-class gthread wsgi:app
+# Workers share the SQLite database (SHUFFLE_DB_PATH, in WAL mode) and each keeps its own copy of a user's data
+# that catches up with the others', so any worker can serve any user. Threaded workers keep /queue_stream
+# viewers from tying up a whole process. Every worker signs sessions with the same key, from FLASK_SECRET_KEY
+# or the key file the first worker to start writes.
+from main import app